@@ -0,0 +1,248 @@
+"""Real-time per-company aggregates over sliding windows, so the dashboard does not have to re-read raw batches.
+Each company keeps a ring of time buckets per window with its tweet count and the heavy hitter hashtags and terms
+of the bucket. Snapshots are written periodically as one small json object per company:
+
+    {"company": "APPLE", "generated_at": "2018-10-10T20:19:24Z",
+     "windows": {"1m": {"tweets": 42, "hashtags": [["#iphone", 7], ...], "terms": [["$aapl", 12], ...]}, ...}}
+"""
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from dedup import normalize_text
+from utils import DataPipelineException
+
+LOGGER = logging.getLogger(__name__)
+WINDOWS = (('1m', 60, 12), ('5m', 300, 10), ('1h', 3600, 60))  # (name, seconds, buckets) of each sliding window.
+TOP_N = 10  # Hashtags and terms reported per window.
+SUMMARY_CAPACITY = 50  # Counters kept per bucket by each heavy hitter summary. Higher is more accurate.
+SNAPSHOT_INTERVAL = 60  # Seconds between snapshots.
+SNAPSHOT_PREFIX = 'aggregates'  # S3 prefix of the snapshot objects.
+STOPWORDS = frozenset(('the', 'and', 'for', 'are', 'was', 'you', 'your', 'this', 'that', 'with', 'from', 'have',
+                       'has', 'not', 'but', 'they', 'will', 'just', 'its', 'all', 'can', 'about', 'out', 'what',
+                       'when', 'who', 'how', 'our', 'get', 'more', 'new', 'now', 'than', 'amp'))
+
+_TOKEN = re.compile(r'[#$]?\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Splits tweet text into hashtags and terms.
+    Terms are the lowercase words of at least 3 characters that are not stopwords, including cashtags like $aapl.
+    :return: (list of hashtags, list of terms).
+    """
+    hashtags = []
+    terms = []
+    for token in _TOKEN.findall(normalize_text(text)):
+        if token[0] == '#':
+            if len(token) > 1:
+                hashtags.append(token)
+        elif len(token) >= 3 and token not in STOPWORDS and not token.isdigit():
+            terms.append(token)
+    return hashtags, terms
+
+
+class SpaceSaving(object):
+    """Space-Saving heavy hitter summary: approximate counts of the most frequent items in `capacity` counters.
+    A new item replaces the smallest counter and inherits its count, so counts are over-estimated by at most
+    the smallest count, and every item more frequent than total / capacity is kept.
+    """
+
+    def __init__(self, capacity=SUMMARY_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self._heap = []  # (count, item) candidates for the smallest counter. Entries with an old count are stale.
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+        else:
+            smallest, victim = heapq.heappop(self._heap)
+            while self.counts.get(victim) != smallest:
+                smallest, victim = heapq.heappop(self._heap)
+            del self.counts[victim]
+            self.counts[item] = smallest + count
+        heapq.heappush(self._heap, (self.counts[item], item))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c, i) for i, c in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def top(self, n):
+        """Returns the n most frequent items as [item, count] lists."""
+        return _top(self.counts, n)
+
+
+class SlidingWindow(object):
+    """Ring buffer of time buckets covering the last `seconds`. Buckets are reused once they fall out of the window."""
+
+    def __init__(self, seconds, num_buckets, capacity=SUMMARY_CAPACITY):
+        self.seconds = seconds
+        self.num_buckets = num_buckets
+        self.capacity = capacity
+        self.bucket_seconds = float(seconds) / num_buckets
+        self._epochs = [None] * num_buckets  # Bucket number since the epoch that each slot currently holds.
+        self._counts = [0] * num_buckets
+        self._hashtags = [None] * num_buckets
+        self._terms = [None] * num_buckets
+
+    def add(self, now, hashtags, terms):
+        epoch = int(now // self.bucket_seconds)
+        i = epoch % self.num_buckets
+        if self._epochs[i] != epoch:
+            self._epochs[i] = epoch
+            self._counts[i] = 0
+            self._hashtags[i] = SpaceSaving(self.capacity)
+            self._terms[i] = SpaceSaving(self.capacity)
+        self._counts[i] += 1
+        for hashtag in hashtags:
+            self._hashtags[i].add(hashtag)
+        for term in terms:
+            self._terms[i].add(term)
+
+    def summary(self, now, top_n=TOP_N):
+        """Returns the tweet count and top hashtags and terms of the buckets still inside the window."""
+        oldest = int(now // self.bucket_seconds) - self.num_buckets
+        live = [i for i, epoch in enumerate(self._epochs) if epoch is not None and epoch > oldest]
+        return {'tweets': sum(self._counts[i] for i in live),
+                'hashtags': _merge_top([self._hashtags[i] for i in live], top_n),
+                'terms': _merge_top([self._terms[i] for i in live], top_n)}
+
+
+def _merge_top(summaries, top_n):
+    """Sums the counters of several SpaceSaving summaries and returns the top_n items."""
+    merged = {}
+    for summary in summaries:
+        for item, count in summary.counts.items():
+            merged[item] = merged.get(item, 0) + count
+    return _top(merged, top_n)
+
+
+def _top(counts, n):
+    """Returns the n largest entries of a dictionary of counts as [item, count] lists."""
+    return [[item, count] for item, count in heapq.nlargest(n, counts.items(), key=lambda ic: ic[1])]
+
+
+class Aggregator(object):
+    """Per-company sliding-window aggregates fed from the listener path, with periodic snapshots.
+    add() only tokenizes and bumps in-memory counters; snapshots are built and written on a background thread.
+    """
+
+    def __init__(self, snapshot_fn=None, interval=SNAPSHOT_INTERVAL, windows=WINDOWS, top_n=TOP_N,
+                 capacity=SUMMARY_CAPACITY):
+        """
+        :param snapshot_fn: callable(snapshots) persisting the list of company snapshots. None to not emit them.
+        :param interval: seconds between snapshots.
+        :param windows: (name, seconds, buckets) of each sliding window.
+        :param top_n: hashtags and terms reported per window.
+        :param capacity: counters per bucket of each heavy hitter summary.
+        """
+        self.snapshot_fn = snapshot_fn
+        self.interval = interval
+        self.windows = windows
+        self.top_n = top_n
+        self.capacity = capacity
+        self._companies = {}  # company -> list of SlidingWindow in the order of windows.
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        if snapshot_fn is not None:
+            self._thread = threading.Thread(target=self._run, name='aggregate-snapshots')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def add(self, company, text, now=None):
+        """Counts one tweet of a company.
+        :param company: company the tweet was collected for.
+        :param text: tweet text.
+        :param now: arrival time. None for the current time.
+        """
+        hashtags, terms = tokenize(text)
+        now = time.time() if now is None else now
+        with self._lock:
+            windows = self._companies.get(company)
+            if windows is None:
+                windows = self._companies[company] = [SlidingWindow(seconds, num_buckets, self.capacity)
+                                                      for _, seconds, num_buckets in self.windows]
+            for window in windows:
+                window.add(now, hashtags, terms)
+
+    def snapshot(self, now=None):
+        """Returns the current aggregates as a list with one snapshot dictionary per company."""
+        now = time.time() if now is None else now
+        generated_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))
+        with self._lock:
+            return [{'company': company, 'generated_at': generated_at,
+                     'windows': dict((name, window.summary(now, self.top_n))
+                                     for (name, _, _), window in zip(self.windows, windows))}
+                    for company, windows in sorted(self._companies.items())]
+
+    def stop(self):
+        """Stops the snapshot thread after writing a last snapshot."""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            stopping = self._stopping.wait(self.interval)
+            try:
+                self.snapshot_fn(self.snapshot())
+            except Exception:
+                LOGGER.exception('Failed to write aggregate snapshot')
+            if stopping:
+                return
+
+
+class S3SnapshotSink(object):
+    """snapshot_fn for Aggregator that overwrites one json object per company under an S3 prefix."""
+
+    def __init__(self, conn, s3_prefix=SNAPSHOT_PREFIX):
+        """
+        :param conn: S3Connection to upload to.
+        :param s3_prefix: prefix of the snapshot objects, e.g. aggregates/APPLE.json.
+        """
+        self.conn = conn
+        self.s3_prefix = s3_prefix
+
+    def __call__(self, snapshots):
+        for snapshot in snapshots:
+            self.conn.upload_bytes(json.dumps(snapshot).encode('utf-8'),
+                                   '{}/{}.json'.format(self.s3_prefix, snapshot['company']))
+
+
+class LocalSnapshotSink(object):
+    """snapshot_fn for Aggregator that atomically replaces one json file per company in a local directory."""
+
+    def __init__(self, local_dir):
+        self.local_dir = local_dir
+        if not os.path.exists(local_dir):
+            os.makedirs(local_dir)
+
+    def __call__(self, snapshots):
+        for snapshot in snapshots:
+            path = os.path.join(self.local_dir, snapshot['company'] + '.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.rename(path + '.tmp', path)  # Readers never see a partially written snapshot.
+
+
+def from_config(conn, info):
+    """Creates an Aggregator from the 'aggregate' section of the yaml config.
+    :param conn: S3Connection to write snapshots to, unless local_dir is set. May be None when it is.
+    :param info: dictionary of aggregate settings.
+    :return: a started Aggregator, or None if aggregation is disabled.
+    """
+    if not info.get('enabled', False):
+        return None
+    if info.get('local_dir'):
+        sink = LocalSnapshotSink(info['local_dir'])
+    elif conn is None:
+        raise DataPipelineException('aggregate snapshots need a local_dir when there is no S3 connection')
+    else:
+        sink = S3SnapshotSink(conn, info.get('s3_prefix') or SNAPSHOT_PREFIX)
+    return Aggregator(sink, interval=info.get('interval') or SNAPSHOT_INTERVAL, top_n=info.get('top_n') or TOP_N)
@@ -0,0 +1,338 @@
+"""asyncio ingestion engine for the filtered stream. Requires Python 3 and, for live streaming, aiohttp.
+A single event loop reads the chunked stream response (or a captured stream file in replay mode), parses each tweet,
+routes it to its companies and hands the records to async sinks:
+
+    python3 async_stream.py                            # live, companies from the many_company config
+    python3 async_stream.py --replay capture.jsonl     # offline, as fast as possible
+    python3 async_stream.py --replay capture.jsonl --rate 5000 --local-dir out/
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from urllib.parse import quote
+
+import aggregate
+import decoders
+import dedup
+import metrics
+import pipeline as batch_pipeline
+import s3_utils
+import settings
+from matcher import build_matcher
+
+try:
+    import aiohttp
+except ImportError:  # Only needed for live streaming.
+    aiohttp = None
+
+LOGGER = logging.getLogger(__name__)
+FILTER_URL = 'https://stream.twitter.com/1.1/statuses/filter.json'
+STALL_TIMEOUT = 90  # Twitter sends a keep-alive every 30 seconds; reconnect after this long without data.
+REPLAY_YIELD_EVERY = 1000  # Lines replayed between giving control back to the event loop.
+
+
+def oauth_header(method, url, params, cred):
+    """Builds an OAuth 1.0a HMAC-SHA1 Authorization header for a twitter API request.
+    :param method: HTTP method.
+    :param url: request url without query string.
+    :param params: dictionary of query or form parameters that are part of the signature.
+    :param cred: twitter credentials with consumer_key, consumer_secret, access_token and access_token_secret.
+    :return: the Authorization header value.
+    """
+    oauth = {'oauth_consumer_key': cred['consumer_key'], 'oauth_nonce': uuid.uuid4().hex,
+             'oauth_signature_method': 'HMAC-SHA1', 'oauth_timestamp': str(int(time.time())),
+             'oauth_token': cred['access_token'], 'oauth_version': '1.0'}
+    signed = dict(params, **oauth)
+    param_string = '&'.join('{}={}'.format(quote(k, safe=''), quote(str(signed[k]), safe=''))
+                            for k in sorted(signed))
+    base_string = '&'.join(quote(part, safe='') for part in (method.upper(), url, param_string))
+    key = '{}&{}'.format(quote(cred['consumer_secret'], safe=''), quote(cred['access_token_secret'], safe=''))
+    digest = hmac.new(key.encode('utf-8'), base_string.encode('utf-8'), hashlib.sha1).digest()
+    oauth['oauth_signature'] = base64.b64encode(digest).decode('ascii')
+    return 'OAuth ' + ', '.join('{}="{}"'.format(k, quote(v, safe='')) for k, v in sorted(oauth.items()))
+
+
+class Backoff(object):
+    """Reconnect delays following twitter's streaming guidelines: linear for network errors, exponential for HTTP
+    errors and a longer exponential wait when rate limited. Delays are jittered and reset after a good connection.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._network = 0
+        self._http = 0
+        self._rate_limited = 0
+
+    def network_error(self):
+        self._network = min(self._network + 0.25, 16)
+        return self._jitter(self._network)
+
+    def http_error(self, status):
+        if status in (420, 429):
+            self._rate_limited = min(self._rate_limited * 2 or 60, 960)
+            return self._jitter(self._rate_limited)
+        self._http = min(self._http * 2 or 5, 320)
+        return self._jitter(self._http)
+
+    @staticmethod
+    def _jitter(delay):
+        return delay * random.uniform(0.8, 1.2)
+
+
+class TwitterStreamSource(object):
+    """Async iterator over the raw tweet lines of the filtered stream. Reconnects with backoff forever."""
+
+    def __init__(self, cred, track):
+        """
+        :param cred: twitter credentials.
+        :param track: list of terms to track.
+        """
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for live streaming')
+        self.cred = cred
+        self.track = track
+        self.backoff = Backoff()
+        self.num_connects = 0
+
+    def __aiter__(self):
+        return self._lines()
+
+    async def _lines(self):
+        params = {'track': ','.join(self.track)}
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=STALL_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                headers = {'Authorization': oauth_header('POST', FILTER_URL, params, self.cred)}
+                try:
+                    async with session.post(FILTER_URL, data=params, headers=headers) as response:
+                        if response.status != 200:
+                            metrics.STREAM_ERRORS.inc(labels=(str(response.status),))
+                            delay = self.backoff.http_error(response.status)
+                            LOGGER.warning('Stream returned HTTP {}, reconnecting in {:.1f}s'.format(
+                                response.status, delay))
+                            await asyncio.sleep(delay)
+                            continue
+                        self.num_connects += 1
+                        self.backoff.reset()
+                        LOGGER.info('Connected to the filtered stream tracking {} terms'.format(len(self.track)))
+                        async for line in response.content:
+                            yield line
+                    metrics.STREAM_DISCONNECTS.inc(labels=('closed',))
+                    delay = self.backoff.network_error()
+                    LOGGER.warning('Stream closed by server, reconnecting in {:.1f}s'.format(delay))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    metrics.STREAM_DISCONNECTS.inc(labels=(type(e).__name__,))
+                    delay = self.backoff.network_error()
+                    LOGGER.warning('Stream error {!r}, reconnecting in {:.1f}s'.format(e, delay))
+                await asyncio.sleep(delay)
+
+
+class ReplaySource(object):
+    """Async iterator over the lines of a captured stream file, one raw tweet payload per line."""
+
+    def __init__(self, filepath, rate=None, loops=1):
+        """
+        :param filepath: captured stream file.
+        :param rate: max lines per second. None to replay as fast as possible.
+        :param loops: number of times to replay the file.
+        """
+        self.filepath = filepath
+        self.rate = rate
+        self.loops = loops
+
+    def __aiter__(self):
+        return self._lines()
+
+    async def _lines(self):
+        start = time.time()
+        num_lines = 0
+        for _ in range(self.loops):
+            with open(self.filepath, 'rb') as f:
+                for line in f:
+                    yield line
+                    num_lines += 1
+                    if num_lines % REPLAY_YIELD_EVERY == 0:
+                        ahead = num_lines / self.rate - (time.time() - start) if self.rate else 0
+                        await asyncio.sleep(max(ahead, 0))
+
+
+class Router(object):
+    """Turns a parsed tweet into the records of every company it mentions, like multi_company.MultiplexListener."""
+
+    def __init__(self, company_ary, stock_ary):
+        self.matcher, self.stock_by_company = build_matcher(company_ary, stock_ary)
+
+    def route(self, tweet):
+        """Returns a list of (company, record) for the tweet."""
+        if 'text' not in tweet:
+            return []
+        return [(company, {'Text': tweet['text'], 'Created at': tweet['created_at'], 'Company': company,
+                           'Stock': self.stock_by_company[company]})
+                for company in self.matcher.match(tweet['text'])]
+
+
+class PipelineSink(object):
+    """Async sink that hands records to a BatchPipeline (S3 upload) without blocking the event loop."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    async def write(self, company, record):
+        """Returns False if the pipeline dropped the record because its queue was full."""
+        # Drop policy never blocks. Under the block policy, only a full queue is waited on in a thread.
+        if self.pipeline.policy == batch_pipeline.POLICY_DROP or not self.pipeline.full():
+            return self.pipeline.put(company, record)
+        return await asyncio.get_event_loop().run_in_executor(None, self.pipeline.put, company, record)
+
+    async def close(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.pipeline.stop)
+
+
+class LocalJsonlSink(object):
+    """Async sink that appends records to one local jsonl file per company."""
+
+    def __init__(self, local_dir):
+        self.local_dir = local_dir
+        self._files = {}
+        if not os.path.exists(local_dir):
+            os.makedirs(local_dir)
+
+    async def write(self, company, record):
+        if company not in self._files:
+            self._files[company] = open(os.path.join(self.local_dir, company + '.jsonl'), 'a')
+        self._files[company].write(json.dumps(record) + '\n')
+
+    async def close(self):
+        for f in self._files.values():
+            f.close()
+
+
+class AggregateSink(object):
+    """Async sink that feeds records to an aggregate.Aggregator."""
+
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+
+    async def write(self, company, record):
+        self.aggregator.add(company, record['Text'])
+
+    async def close(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.aggregator.stop)
+
+
+class StreamEngine(object):
+    """Reads raw lines from a source, parses and routes them, and writes the records to every sink."""
+
+    def __init__(self, source, router, sinks, decode=json.loads, deduplicator=None):
+        """
+        :param source: async iterable of raw stream lines.
+        :param router: Router that turns a tweet into company records.
+        :param sinks: list of async sinks with write(company, record) and close(). write returns False when the
+            sink had to drop the record, which is counted as queue_full.
+        :param decode: function parsing one raw line into a tweet dictionary.
+        :param deduplicator: optional dedup.Deduplicator dropping repeated tweets before routing.
+        """
+        self.source = source
+        self.router = router
+        self.sinks = sinks
+        self.decode = decode
+        self.dedup = deduplicator
+        self.stats = {'lines': 0, 'tweets': 0, 'records': 0, 'keep_alives': 0, 'parse_errors': 0, 'duplicates': 0,
+                      'queue_full': 0}
+
+    async def run(self):
+        """Consumes the source until it ends, then closes the sinks.
+        :return: the engine stats.
+        """
+        start = time.time()
+        try:
+            async for line in self.source:
+                self.stats['lines'] += 1
+                if not line.strip():
+                    self.stats['keep_alives'] += 1
+                    continue
+                line_start = time.time()
+                try:
+                    tweet = self.decode(line)
+                except ValueError:
+                    self.stats['parse_errors'] += 1
+                    metrics.TWEETS_DROPPED.inc(labels=('', 'parse_error'))
+                    continue
+                if 'text' in tweet:
+                    metrics.TWEETS_RECEIVED.inc()
+                if self.dedup is not None and 'text' in tweet and self.dedup.is_duplicate(tweet):
+                    self.stats['duplicates'] += 1
+                    metrics.TWEETS_DROPPED.inc(labels=('', 'duplicate'))
+                    continue
+                records = self.router.route(tweet)
+                if records:
+                    self.stats['tweets'] += 1
+                elif 'text' in tweet:
+                    metrics.TWEETS_DROPPED.inc(labels=('', 'unmatched'))
+                for company, record in records:
+                    self.stats['records'] += 1
+                    kept = True
+                    for sink in self.sinks:
+                        if await sink.write(company, record) is False:
+                            kept = False
+                    if kept:
+                        metrics.TWEETS_KEPT.inc(labels=(company,))
+                    else:
+                        self.stats['queue_full'] += 1
+                        metrics.TWEETS_DROPPED.inc(labels=(company, 'queue_full'))
+                metrics.ON_DATA_SECONDS.observe(time.time() - line_start)
+        finally:
+            for sink in self.sinks:
+                await sink.close()
+            self.stats['seconds'] = time.time() - start
+        return self.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replay', help='captured stream file to replay instead of connecting to twitter')
+    parser.add_argument('--rate', type=float, help='max replayed lines per second')
+    parser.add_argument('--loops', type=int, default=1, help='number of times to replay the file')
+    parser.add_argument('--local-dir', help='also write records to jsonl files in this directory')
+    parser.add_argument('--no-s3', action='store_true', help='do not upload batches to S3')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    config = settings.load()
+    metrics.from_config(config.section('metrics'))
+    router = Router([c.name for c in config.companies], [c.stock for c in config.companies])
+    if args.replay:
+        source = ReplaySource(args.replay, args.rate, args.loops)
+    else:
+        source = TwitterStreamSource(config.twitter, router.matcher.terms())
+    sinks = []
+    conn = None
+    if not args.no_s3:
+        conn = s3_utils.S3Connection.from_config(config.aws)
+        sinks.append(PipelineSink(batch_pipeline.from_config(conn, config.section('pipeline'))))
+    if args.local_dir:
+        sinks.append(LocalJsonlSink(args.local_dir))
+    aggregator = aggregate.from_config(conn, config.section('aggregate'))
+    if aggregator is not None:
+        sinks.append(AggregateSink(aggregator))
+    decoder_info = config.section('decoder')
+    decode = decoders.get_decoder(decoder_info.get('backend') or decoders.BACKEND_AUTO,
+                                  decoders.TWEET_FIELDS if decoder_info.get('project', True) else None)
+    deduplicator = dedup.from_config(config.section('dedup'))
+    stats = asyncio.run(StreamEngine(source, router, sinks, decode, deduplicator).run())
+    LOGGER.info('{} lines, {} tweets routed, {:.0f} lines/sec'.format(
+        stats['lines'], stats['tweets'], stats['lines'] / max(stats['seconds'], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Policy deciding when BatchPipeline flushes an open batch.
+Hard limits bound memory and freshness: max_records, max_bytes and max_age. Between them, batches aim for
+target_bytes per object. A company that fills its target faster than min_interval keeps its batch open until
+min_interval has passed, so its batches grow with its arrival rate: spikes make larger objects instead of more of
+them, and quiet companies still flush within max_age.
+"""
+import logging
+
+from utils import DataPipelineException
+
+LOGGER = logging.getLogger(__name__)
+MAX_AGE = 15 * 60  # Default max seconds a batch stays open, which bounds how stale data in S3 can be.
+TARGET_BYTES = 8 * 1024 * 1024  # Default object size batches aim for.
+MAX_BYTES = 64 * 1024 * 1024  # Default hard cap on a batch, whatever the arrival rate.
+MIN_INTERVAL = 60  # Default min seconds between size triggered flushes of one batch key.
+REASON_RECORDS = 'records'
+REASON_BYTES = 'bytes'
+REASON_AGE = 'age'
+REASON_TARGET = 'target'
+REASON_EXPLICIT = 'explicit'  # flush() or stop() of the pipeline.
+
+
+class BatchPolicy(object):
+    """Decides from a batch's record count, size and age whether it is flushed. Stateless, so one policy is
+    shared by every batch key.
+    """
+
+    def __init__(self, max_records=None, max_bytes=None, max_age=None, target_bytes=None, min_interval=0):
+        """
+        :param max_records: flush once a batch has this many records. None for no limit.
+        :param max_bytes: flush once a batch has this many bytes. None for no limit.
+        :param max_age: flush once a batch has been open this many seconds. None for no limit.
+        :param target_bytes: flush once a batch has this many bytes and has been open min_interval seconds.
+            None to only flush on the hard limits.
+        :param min_interval: seconds a batch stays open at least before target_bytes flushes it.
+        """
+        if max_age is not None and min_interval > max_age:
+            raise DataPipelineException('min_interval {} is longer than max_age {}'.format(min_interval, max_age))
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.target_bytes = target_bytes
+        self.min_interval = min_interval
+
+    @property
+    def tracks_bytes(self):
+        """True if the policy needs batch sizes in bytes."""
+        return self.max_bytes is not None or self.target_bytes is not None
+
+    def flush_reason(self, num_records, num_bytes, age):
+        """Checks whether a batch is due.
+        :param num_records: records in the batch.
+        :param num_bytes: size of the batch in bytes, exact or estimated.
+        :param age: seconds since the batch was opened.
+        :return: one of the REASON_ constants, or None to keep the batch open.
+        """
+        if self.max_records is not None and num_records >= self.max_records:
+            return REASON_RECORDS
+        if self.max_bytes is not None and num_bytes >= self.max_bytes:
+            return REASON_BYTES
+        if self.max_age is not None and age >= self.max_age:
+            return REASON_AGE
+        if self.target_bytes is not None and num_bytes >= self.target_bytes and age >= self.min_interval:
+            return REASON_TARGET
+        return None
+
+    def __repr__(self):
+        return 'BatchPolicy(max_records={}, max_bytes={}, max_age={}, target_bytes={}, min_interval={})'.format(
+            self.max_records, self.max_bytes, self.max_age, self.target_bytes, self.min_interval)
+
+
+def from_config(info, max_records=None, max_age=None):
+    """Creates a BatchPolicy from the 'pipeline' section of the yaml config. Unset values use the defaults above.
+    :param info: dictionary with optionally max_records, max_bytes, max_age, target_bytes and min_interval.
+        A limit set to 0 is disabled. An unset min_interval defaults to MIN_INTERVAL, or to max_age if shorter.
+    :param max_records: max_records when the config has none. None for no record limit.
+    :param max_age: max_age when the config has none. None for MAX_AGE.
+    :return: a BatchPolicy.
+    """
+    max_age = _limit(info, 'max_age', MAX_AGE if max_age is None else max_age)
+    min_interval = info.get('min_interval')
+    if min_interval is None:
+        min_interval = MIN_INTERVAL if max_age is None else min(MIN_INTERVAL, max_age)
+    policy = BatchPolicy(max_records=_limit(info, 'max_records', max_records),
+                         max_bytes=_limit(info, 'max_bytes', MAX_BYTES),
+                         max_age=max_age,
+                         target_bytes=_limit(info, 'target_bytes', TARGET_BYTES),
+                         min_interval=min_interval)
+    LOGGER.info('Batching with {}'.format(policy))
+    return policy
+
+
+def _limit(info, name, default):
+    """Returns a limit of the config: default when unset, None for no limit when set to 0."""
+    value = info.get(name)
+    if value is None:
+        return default
+    return value or None
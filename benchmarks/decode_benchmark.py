@@ -0,0 +1,53 @@
+"""Measures records/sec of each available json decoder, with and without field projection, over a tweet corpus.
+The corpus is a captured stream file with one raw tweet payload per line:
+
+    python benchmarks/decode_benchmark.py capture.jsonl
+    python benchmarks/decode_benchmark.py capture.jsonl --repeat 5 --fields text created_at user.screen_name
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import decoders  # noqa: E402
+
+
+def load_corpus(filepath):
+    """Reads the non-empty lines of the corpus as raw bytes."""
+    with open(filepath, 'rb') as f:
+        return [line for line in f if line.strip()]
+
+
+def bench(decode, corpus, repeat):
+    """Decodes the corpus `repeat` times and returns the best records/sec."""
+    best = 0.0
+    for _ in range(repeat):
+        start = time.time()
+        for raw in corpus:
+            decode(raw)
+        best = max(best, len(corpus) / (time.time() - start))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', help='captured stream file, one tweet per line')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the corpus per decoder, best is kept')
+    parser.add_argument('--fields', nargs='+', default=list(decoders.TWEET_FIELDS), help='fields to project')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    avg_size = sum(len(raw) for raw in corpus) / float(len(corpus))
+    print('{} tweets, {:.0f} bytes on average'.format(len(corpus), avg_size))
+    baseline = None
+    for backend in reversed(decoders.available_backends()):
+        for fields in (None, args.fields):
+            rate = bench(decoders.get_decoder(backend, fields), corpus, args.repeat)
+            baseline = rate if baseline is None else baseline
+            print('{:>8} {:>9}: {:>10.0f} records/sec ({:.1f}x json)'.format(
+                backend, 'projected' if fields else 'full', rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
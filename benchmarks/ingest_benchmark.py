@@ -0,0 +1,120 @@
+"""Offline throughput benchmark of the collector hot path, without twitter or AWS credentials.
+Recorded or synthetic payloads are fed straight into the multi_company listeners' on_data, batched by the real
+pipeline and uploaded to an in-process S3 stand-in. Each configuration runs in its own process and reports
+end-to-end tweets/sec (until the last batch is uploaded), on_data latency percentiles, peak RSS and bytes uploaded.
+The listener modules read config/cred.yaml on import, so copy config/cred.sample.yaml there first; its credentials
+are never used.
+
+    python benchmarks/ingest_benchmark.py --tweets 100000
+    python benchmarks/ingest_benchmark.py --replay capture.jsonl --modes multiplex --formats jsonl --rate 5000
+    python benchmarks/ingest_benchmark.py --decoders json orjson simdjson --dedup on off --latency 0.05
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from local_s3 import LocalS3Connection  # noqa: E402
+from tweetgen import COMPANIES, STOCKS, TweetGenerator  # noqa: E402
+
+timer = getattr(time, 'perf_counter', time.time)
+PACE_EVERY = 100  # Payloads between rate limiting sleeps.
+
+
+def load_payloads(args):
+    """Returns the payloads to feed, without keep-alives, which tweepy never passes to on_data."""
+    if args.replay:
+        with open(args.replay, 'rb') as f:
+            payloads = [line.strip().decode('utf-8') for line in f if line.strip()]
+        return payloads[:args.tweets] if args.tweets else payloads
+    generator = TweetGenerator(match_rate=args.match_rate, retweet_rate=args.retweet_rate, seed=args.seed)
+    return [line for line in generator.lines(args.tweets or 100000) if line]
+
+
+def make_listener(mode, batches, deduplicator):
+    """Creates the listener multi_company would run in the given mode."""
+    import multi_company
+    from matcher import build_matcher
+    if mode == 'multiplex':
+        matcher, stock_by_company = build_matcher(COMPANIES, STOCKS)
+        return multi_company.MultiplexListener(matcher=matcher, stock_by_company=stock_by_company, pipeline=batches,
+                                               deduplicator=deduplicator)
+    return multi_company.StdOutListener(company=COMPANIES[0], pipeline=batches, time_end=float('inf'),
+                                        deduplicator=deduplicator, stock=STOCKS[0])
+
+
+def run_config(config, payloads, args, results):
+    """Runs one configuration in the current process and puts its report on the results queue."""
+    import decoders
+    import dedup
+    import multi_company
+    import pipeline
+    mode, output_format, backend, use_dedup = config
+    multi_company.decode = decoders.get_decoder(backend, decoders.TWEET_FIELDS)
+    s3 = LocalS3Connection(latency=args.latency)
+    batches = pipeline.from_config(s3, {'format': output_format, 'flush_workers': args.flush_workers},
+                                   batch_size=args.batch_size)
+    listener = make_listener(mode, batches, dedup.Deduplicator() if use_dedup else None)
+    latencies = []
+    start = timer()
+    for i, payload in enumerate(payloads):
+        call_start = timer()
+        listener.on_data(payload)
+        latencies.append(timer() - call_start)
+        if args.rate and i % PACE_EVERY == 0:
+            ahead = i / args.rate - (timer() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    batches.stop()
+    seconds = timer() - start
+    latencies.sort()
+    results.put({'config': '{}/{}/{}/dedup {}'.format(mode, output_format, backend, 'on' if use_dedup else 'off'),
+                 'tweets_per_sec': len(payloads) / seconds,
+                 'p50_us': latencies[len(latencies) // 2] * 1e6,
+                 'p99_us': latencies[int(len(latencies) * 0.99)] * 1e6,
+                 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                 'records': batches.stats()['enqueued'],
+                 'uploads': s3.num_uploads,
+                 'uploaded_mb': s3.num_bytes / 1024.0 / 1024.0})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replay', help='captured stream file to feed instead of synthetic payloads')
+    parser.add_argument('--tweets', type=int, help='payloads to feed, 100000 synthetic ones by default')
+    parser.add_argument('--rate', type=float, help='max payloads per second. Default: as fast as possible')
+    parser.add_argument('--modes', nargs='+', default=['round_robin', 'multiplex'], help='listeners to benchmark')
+    parser.add_argument('--formats', nargs='+', default=['json', 'jsonl'], help='pipeline batch formats')
+    parser.add_argument('--decoders', nargs='+', default=['auto'], help='json decoder backends')
+    parser.add_argument('--dedup', nargs='+', default=['on'], choices=['on', 'off'], help='deduplication')
+    parser.add_argument('--batch-size', type=int, default=3000, help='records per batch')
+    parser.add_argument('--flush-workers', type=int, default=1, help='concurrent batch uploads')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds each stand-in S3 upload takes')
+    parser.add_argument('--match-rate', type=float, default=0.9, help='share of synthetic tweets to a company')
+    parser.add_argument('--retweet-rate', type=float, default=0.3, help='share of synthetic retweets')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic payloads')
+    args = parser.parse_args()
+
+    payloads = load_payloads(args)
+    print('{} payloads, {:.0f} bytes on average'.format(
+        len(payloads), sum(len(p) for p in payloads) / float(len(payloads))))
+    print('{:<40} {:>10} {:>9} {:>9} {:>9} {:>9} {:>8} {:>9}'.format(
+        'configuration', 'tweets/s', 'p50 us', 'p99 us', 'rss MB', 'records', 'uploads', 'up MB'))
+    configs = itertools.product(args.modes, args.formats, args.decoders, [d == 'on' for d in args.dedup])
+    for config in configs:
+        results = multiprocessing.Queue()
+        # A fresh process per configuration keeps peak RSS and module state from leaking between runs.
+        process = multiprocessing.Process(target=run_config, args=(config, payloads, args, results))
+        process.start()
+        report = results.get()
+        process.join()
+        print('{config:<40} {tweets_per_sec:>10.0f} {p50_us:>9.1f} {p99_us:>9.1f} {peak_rss_mb:>9.1f} '
+              '{records:>9} {uploads:>8} {uploaded_mb:>9.1f}'.format(**report))
+
+
+if __name__ == '__main__':
+    main()
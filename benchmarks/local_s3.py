@@ -0,0 +1,74 @@
+"""In-process stand-in for the upload side of S3Connection, for benchmarks and failure drills without AWS.
+Uploads are counted and optionally kept in memory or written under a local directory. Failures, hangs and outages
+can be injected to exercise retry paths.
+"""
+import os
+import random
+import threading
+import time
+
+
+class LocalS3Connection(object):
+    """Implements upload_bytes, upload_stream, upload_file and upload_files like S3Connection."""
+
+    def __init__(self, local_dir=None, keep=False, latency=0.0, fail_rate=0.0, hang_rate=0.0, hang_seconds=0.0,
+                 outage=0.0, seed=None):
+        """
+        :param local_dir: directory to write uploaded objects to, under their key. None to not write them.
+        :param keep: keep uploaded objects in the objects dictionary.
+        :param latency: seconds every upload takes, to mimic the network round trip.
+        :param fail_rate: share of uploads that raise IOError.
+        :param hang_rate: share of uploads that take hang_seconds longer.
+        :param hang_seconds: duration of a hanging upload.
+        :param outage: seconds from now during which every upload fails.
+        :param seed: random seed of the injected failures.
+        """
+        self.local_dir = local_dir
+        self.keep = keep
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.down_until = time.time() + outage
+        self.objects = {}
+        self.num_uploads = 0
+        self.num_bytes = 0
+        self.num_failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def upload_bytes(self, data, s3_key, part_size=None, parallel_parts=None):
+        with self._lock:
+            fail = time.time() < self.down_until or self._random.random() < self.fail_rate
+            hang = self._random.random() < self.hang_rate
+            if fail:
+                self.num_failures += 1
+        if fail:
+            raise IOError('Injected upload failure of {}'.format(s3_key))
+        time.sleep(self.latency + (self.hang_seconds if hang else 0))
+        if self.local_dir is not None:
+            path = os.path.join(self.local_dir, s3_key)
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # Already created, possibly by a concurrent upload.
+            with open(path, 'wb') as f:
+                f.write(data)
+        with self._lock:
+            self.num_uploads += 1
+            self.num_bytes += len(data)
+            if self.keep:
+                self.objects[s3_key] = data
+        return s3_key
+
+    def upload_stream(self, stream, s3_key, part_size=None, parallel_parts=None):
+        data = stream.read() if hasattr(stream, 'read') else b''.join(stream)
+        return self.upload_bytes(data, s3_key)
+
+    def upload_file(self, filename, s3_key=None):
+        with open(filename, 'rb') as f:
+            return self.upload_bytes(f.read(), s3_key or os.path.basename(filename))
+
+    def upload_files(self, filepath_list, s3_key_list=None):
+        s3_key_list = s3_key_list or [os.path.basename(f) for f in filepath_list]
+        return [self.upload_file(f, key) for f, key in zip(filepath_list, s3_key_list)]
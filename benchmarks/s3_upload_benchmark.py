@@ -0,0 +1,97 @@
+"""Compares parallel upload throughput of S3Connection against the old per-file session implementation.
+Runs against an S3 compatible endpoint such as MinIO, or against an in-process moto mock when no endpoint is given:
+
+    python benchmarks/s3_upload_benchmark.py --files 2000 --calls 10
+    python benchmarks/s3_upload_benchmark.py --endpoint-url http://localhost:9000 --bucket bench
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+import boto3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s3_utils  # noqa: E402
+
+
+def legacy_upload_files(conn, filepath_list, s3_key_list):
+    """The previous upload_files: a new thread pool per call and a new boto session and client per file."""
+    access_key = conn.get_aws_access_key_id()
+    secret_key = conn.get_aws_secret_access_key()
+
+    def upload(info):
+        filename, s3_key = info
+        session = boto3.session.Session(access_key, secret_key)
+        session.client('s3', endpoint_url=conn.endpoint_url).upload_file(filename, conn.bucket_name, s3_key)
+        return s3_key
+
+    pool = ThreadPool(processes=s3_utils.PARALLEL_PROCESSES)
+    uploaded = pool.map(upload, list(zip(filepath_list, s3_key_list)))
+    pool.close()
+    pool.join()
+    return uploaded
+
+
+def make_files(num_files, file_size):
+    """Writes num_files small batch-like files to a temporary directory."""
+    local_dir = tempfile.mkdtemp()
+    filepaths = []
+    for i in range(num_files):
+        filepath = os.path.join(local_dir, 'batch{}.txt'.format(i))
+        with open(filepath, 'wb') as f:
+            f.write(os.urandom(file_size))
+        filepaths.append(filepath)
+    return local_dir, filepaths
+
+
+def run(conn, filepaths, calls, upload_fn, label):
+    """Uploads the files in `calls` separate calls, like a collector flushing batches, and prints files/sec."""
+    per_call = max(1, len(filepaths) // calls)
+    start = time.time()
+    for i in range(0, len(filepaths), per_call):
+        chunk = filepaths[i:i + per_call]
+        upload_fn(chunk, ['bench/{}/{}'.format(label, os.path.basename(f)) for f in chunk])
+    elapsed = time.time() - start
+    print('{:>8}: {} files in {:.2f}s, {:.1f} files/sec'.format(label, len(filepaths), elapsed,
+                                                               len(filepaths) / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint-url', help='S3 compatible endpoint. Uses an in-process moto mock if omitted.')
+    parser.add_argument('--bucket', default='tweetstream-benchmark')
+    parser.add_argument('--files', type=int, default=1000, help='total number of files to upload')
+    parser.add_argument('--file-size', type=int, default=4096, help='bytes per file')
+    parser.add_argument('--calls', type=int, default=10, help='number of upload_files calls to spread files over')
+    parser.add_argument('--parallel-processes', type=int, default=s3_utils.PARALLEL_PROCESSES)
+    args = parser.parse_args()
+
+    mock = None
+    if args.endpoint_url is None:
+        from moto import mock_aws
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        mock = mock_aws()
+        mock.start()
+    local_dir, filepaths = make_files(args.files, args.file_size)
+    try:
+        conn = s3_utils.S3Connection(args.bucket, endpoint_url=args.endpoint_url,
+                                     parallel_processes=args.parallel_processes)
+        if args.bucket not in [b['Name'] for b in conn.s3_client.list_buckets()['Buckets']]:
+            conn.s3_client.create_bucket(Bucket=args.bucket)
+        run(conn, filepaths, args.calls, lambda files, keys: legacy_upload_files(conn, files, keys), 'before')
+        with conn:
+            run(conn, filepaths, args.calls, conn.upload_files, 'after')
+    finally:
+        shutil.rmtree(local_dir)
+        if mock is not None:
+            mock.stop()
+
+
+if __name__ == '__main__':
+    main()
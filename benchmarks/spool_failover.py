@@ -0,0 +1,70 @@
+"""Checks that the spool keeps the ingest rate and loses nothing while S3 fails.
+Records are pushed through a jsonl pipeline whose S3 is a local stand-in that fails a share of the uploads, hangs on
+some and is down entirely for the first seconds. At the end every record must have been uploaded exactly once:
+
+    python benchmarks/spool_failover.py
+    python benchmarks/spool_failover.py --records 200000 --fail-rate 0.5 --outage 10
+"""
+import argparse
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pipeline  # noqa: E402
+from local_s3 import LocalS3Connection  # noqa: E402
+
+
+def count_records(objects):
+    """Returns the ids of the records held by the uploaded gzipped jsonl objects."""
+    ids = []
+    for data in objects.values():
+        for line in gzip.GzipFile(fileobj=io.BytesIO(data)):
+            if line.strip():
+                ids.append(json.loads(line.decode('utf-8'))['Id'])
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=50000, help='records to push')
+    parser.add_argument('--batch-size', type=int, default=1000, help='records per batch')
+    parser.add_argument('--fail-rate', type=float, default=0.3, help='share of uploads that fail')
+    parser.add_argument('--hang-rate', type=float, default=0.05, help='share of uploads that hang first')
+    parser.add_argument('--hang-seconds', type=float, default=2.0, help='how long a hanging upload takes')
+    parser.add_argument('--outage', type=float, default=3.0, help='seconds S3 is down at the start')
+    parser.add_argument('--spool-max-bytes', type=int, default=None, help='spool quota, evictions count as loss')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)  # Every injected failure would log a traceback.
+
+    spool_dir = tempfile.mkdtemp()
+    s3 = LocalS3Connection(keep=True, fail_rate=args.fail_rate, hang_rate=args.hang_rate,
+                           hang_seconds=args.hang_seconds, outage=args.outage)
+    try:
+        batches = pipeline.from_config(s3, {'format': 'jsonl', 'spool_dir': spool_dir, 'spool_max_backoff': 1,
+                                            'spool_max_bytes': args.spool_max_bytes}, batch_size=args.batch_size)
+        start = time.time()
+        for i in range(args.records):
+            batches.put('APPLE', {'Id': i, 'Text': 'tweet {}'.format(i), 'Company': 'APPLE'})
+        ingest_seconds = time.time() - start
+        batches.stop()
+        spool_stats = batches.stats()['spool']
+        ids = count_records(s3.objects)
+        print('ingest: {:.0f} records/sec'.format(args.records / ingest_seconds))
+        print('drained in {:.1f}s with {} injected failures'.format(time.time() - start, s3.num_failures))
+        print('spool: {}'.format(spool_stats))
+        missing = args.records - len(set(ids))
+        print('uploaded {} records, {} missing, {} duplicated'.format(len(ids), missing, len(ids) - len(set(ids))))
+        sys.exit(1 if missing and not spool_stats['evicted'] else 0)
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+if __name__ == '__main__':
+    main()
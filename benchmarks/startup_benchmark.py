@@ -0,0 +1,62 @@
+"""Cold start time of the collectors: imports each collector module in a fresh interpreter, the way a restarted
+worker does, and reports the import time and the whole process time. Also times utils.rel_path, which every module
+calls while loading its config. The collectors read config/cred.yaml on import, so copy config/cred.sample.yaml
+there first; no connection is made.
+
+    python benchmarks/startup_benchmark.py
+    python benchmarks/startup_benchmark.py --modules multi_company supervisor --runs 20
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+timer = getattr(time, 'perf_counter', time.time)
+IMPORT_CODE = 'import time; start = time.time(); import {}; print(time.time() - start)'
+
+
+def time_import(module):
+    """Imports module in a new interpreter.
+    :return: (seconds spent importing, seconds until the interpreter exited).
+    """
+    start = timer()
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_CODE.format(module)], cwd=ROOT)
+    return float(output.decode('utf-8').strip().splitlines()[-1]), timer() - start
+
+
+def time_rel_path(calls):
+    """Returns the average seconds per utils.rel_path call."""
+    from utils import rel_path
+    start = timer()
+    for _ in range(calls):
+        rel_path('config/cred.yaml')
+    return (timer() - start) / calls
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=['tweetstream', 'multi_company', 'supervisor'],
+                        help='modules to import')
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters per module')
+    args = parser.parse_args()
+
+    print('{:<16} {:>12} {:>12} {:>12}'.format('module', 'import ms', 'min ms', 'process ms'))
+    for module in args.modules:
+        time_import(module)  # Warms the OS file cache and writes bytecode.
+        runs = [time_import(module) for _ in range(args.runs)]
+        print('{:<16} {:>12.1f} {:>12.1f} {:>12.1f}'.format(module, median([r[0] for r in runs]) * 1e3,
+                                                            min(r[0] for r in runs) * 1e3,
+                                                            median([r[1] for r in runs]) * 1e3))
+    print('rel_path: {:.1f} us per call'.format(time_rel_path(1000) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Synthetic tweet payloads shaped like the filtered stream's, for offline benchmarks and replays.
+Payloads carry the full v1.1 tweet object (user, entities, nested retweets) so their size and parse cost match
+the live stream. Writes a capture file that ingest_benchmark.py, decode_benchmark.py and async_stream --replay read:
+
+    python benchmarks/tweetgen.py capture.jsonl --tweets 100000
+    python benchmarks/tweetgen.py capture.jsonl --tweets 100000 --match-rate 0.5 --retweet-rate 0.4
+"""
+import argparse
+import json
+import random
+import time
+
+COMPANIES = ('APPLE', 'AMAZON', 'GOOGLE', 'MICROSOFT', 'FACEBOOK', 'ORACLE', 'INTEL', 'CISCO', 'IBM')
+STOCKS = ('$APPL', '$AMZN', '$GOOGLE', '$MSFT', '$FB', '$ORCL', '$INTC', '$CSCO', '$IBM')
+WORDS = ('stock', 'market', 'earnings', 'buy', 'sell', 'today', 'new', 'price', 'shares', 'growth', 'cloud',
+         'phone', 'launch', 'report', 'quarter', 'investors', 'ceo', 'deal', 'data', 'store', 'update', 'week',
+         'big', 'love', 'great', 'why', 'think', 'just', 'now', 'going', 'up', 'down', 'the', 'a', 'is', 'to')
+HASHTAGS = ('tech', 'stocks', 'investing', 'news', 'ai', 'cloud', 'iphone', 'earnings', 'nasdaq', 'trading')
+URL_CHARS = 'abcdefghijkmnpqrstuvwxyz0123456789'
+TWITTER_TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+
+class TweetGenerator(object):
+    """Generates raw tweet payloads. The same seed always produces the same payloads."""
+
+    def __init__(self, companies=COMPANIES, stocks=STOCKS, match_rate=0.9, retweet_rate=0.3, duplicate_rate=0.02,
+                 keep_alive_rate=0.01, seed=0):
+        """
+        :param companies: company names mentioned by matching tweets.
+        :param stocks: stock symbols mentioned by matching tweets.
+        :param match_rate: share of tweets mentioning a company or stock.
+        :param retweet_rate: share of tweets that are retweets, which are about twice as large.
+        :param duplicate_rate: share of payloads that are re-deliveries of an earlier payload.
+        :param keep_alive_rate: share of lines that are blank keep-alives.
+        :param seed: random seed.
+        """
+        self.terms = list(companies) + list(stocks)
+        self.match_rate = match_rate
+        self.retweet_rate = retweet_rate
+        self.duplicate_rate = duplicate_rate
+        self.keep_alive_rate = keep_alive_rate
+        self.random = random.Random(seed)
+        self._next_id = 1050118621198921728
+        self._recent = []
+
+    def lines(self, num_tweets):
+        """Yields num_tweets raw payloads, interleaved with keep-alive lines.
+        :return: iterator of json strings, or '' for keep-alives.
+        """
+        for _ in range(num_tweets):
+            if self.random.random() < self.keep_alive_rate:
+                yield ''
+            if self._recent and self.random.random() < self.duplicate_rate:
+                yield self.random.choice(self._recent)
+                continue
+            payload = json.dumps(self.tweet())
+            self._recent.append(payload)
+            if len(self._recent) > 1000:  # Re-deliveries come from the last thousand payloads.
+                self._recent.pop(0)
+            yield payload
+
+    def tweet(self):
+        """Returns one tweet object, a retweet with the original nested in retweeted_status retweet_rate times."""
+        if self.random.random() < self.retweet_rate:
+            original = self._status(self._text())
+            retweet = self._status('RT @{}: {}'.format(original['user']['screen_name'], original['text'])[:140])
+            retweet['retweeted_status'] = original
+            return retweet
+        return self._status(self._text())
+
+    def _text(self):
+        rnd = self.random
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(5, 16))]
+        if rnd.random() < self.match_rate:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(self.terms))
+        words.extend('#' + rnd.choice(HASHTAGS) for _ in range(rnd.randint(0, 2)))
+        if rnd.random() < 0.4:
+            words.append('https://t.co/' + ''.join(rnd.choice(URL_CHARS) for _ in range(10)))
+        return ' '.join(words)
+
+    def _status(self, text):
+        rnd = self.random
+        self._next_id += rnd.randint(1, 10 ** 6)
+        user_id = rnd.randint(10 ** 6, 10 ** 18)
+        screen_name = 'user{}'.format(user_id % 10 ** 8)
+        now = time.time()
+        return {
+            'created_at': time.strftime(TWITTER_TIME_FORMAT, time.gmtime(now)),
+            'id': self._next_id, 'id_str': str(self._next_id), 'text': text,
+            'source': '<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>',
+            'truncated': False, 'in_reply_to_status_id': None, 'in_reply_to_status_id_str': None,
+            'in_reply_to_user_id': None, 'in_reply_to_user_id_str': None, 'in_reply_to_screen_name': None,
+            'user': {
+                'id': user_id, 'id_str': str(user_id), 'name': screen_name.title(), 'screen_name': screen_name,
+                'location': rnd.choice(('New York, NY', 'San Francisco, CA', 'London', None)), 'url': None,
+                'description': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(0, 20))),
+                'translator_type': 'none', 'protected': False, 'verified': rnd.random() < 0.02,
+                'followers_count': rnd.randint(0, 100000), 'friends_count': rnd.randint(0, 5000),
+                'listed_count': rnd.randint(0, 500), 'favourites_count': rnd.randint(0, 50000),
+                'statuses_count': rnd.randint(1, 200000), 'created_at': 'Sat Mar 14 17:03:51 +0000 2015',
+                'utc_offset': None, 'time_zone': None, 'geo_enabled': rnd.random() < 0.3, 'lang': 'en',
+                'contributors_enabled': False, 'is_translator': False, 'profile_background_color': 'C0DEED',
+                'profile_background_image_url': 'http://abs.twimg.com/images/themes/theme1/bg.png',
+                'profile_background_image_url_https': 'https://abs.twimg.com/images/themes/theme1/bg.png',
+                'profile_background_tile': False, 'profile_link_color': '1DA1F2',
+                'profile_sidebar_border_color': 'C0DEED', 'profile_sidebar_fill_color': 'DDEEF6',
+                'profile_text_color': '333333', 'profile_use_background_image': True,
+                'profile_image_url': 'http://pbs.twimg.com/profile_images/{}/avatar_normal.jpg'.format(user_id),
+                'profile_image_url_https': 'https://pbs.twimg.com/profile_images/{}/avatar_normal.jpg'.format(user_id),
+                'profile_banner_url': 'https://pbs.twimg.com/profile_banners/{}/1500000000'.format(user_id),
+                'default_profile': True, 'default_profile_image': False, 'following': None,
+                'follow_request_sent': None, 'notifications': None},
+            'geo': None, 'coordinates': None, 'place': None, 'contributors': None, 'is_quote_status': False,
+            'quote_count': 0, 'reply_count': 0, 'retweet_count': 0, 'favorite_count': 0,
+            'entities': {
+                'hashtags': [{'text': word[1:], 'indices': [0, len(word)]} for word in text.split() if word[0] == '#'],
+                'urls': [{'url': word, 'expanded_url': 'https://example.com/article',
+                          'display_url': 'example.com/article', 'indices': [0, len(word)]}
+                         for word in text.split() if word.startswith('https://t.co/')],
+                'user_mentions': [], 'symbols': [{'text': word[1:], 'indices': [0, len(word)]}
+                                                 for word in text.split() if word[0] == '$']},
+            'favorited': False, 'retweeted': False, 'filter_level': 'low', 'lang': 'en',
+            'timestamp_ms': str(int(now * 1000))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help='capture file to write, one payload per line')
+    parser.add_argument('--tweets', type=int, default=100000, help='payloads to generate')
+    parser.add_argument('--match-rate', type=float, default=0.9, help='share of tweets mentioning a company')
+    parser.add_argument('--retweet-rate', type=float, default=0.3, help='share of retweets')
+    parser.add_argument('--duplicate-rate', type=float, default=0.02, help='share of re-delivered payloads')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    generator = TweetGenerator(match_rate=args.match_rate, retweet_rate=args.retweet_rate,
+                               duplicate_rate=args.duplicate_rate, seed=args.seed)
+    num_bytes = 0
+    with open(args.output, 'w') as f:
+        for line in generator.lines(args.tweets):
+            f.write(line + '\r\n')
+            num_bytes += len(line) + 2
+    print('Wrote {} tweets, {:.0f} bytes on average, to {}'.format(args.tweets, num_bytes / float(args.tweets),
+                                                                   args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""Compacts the small batch objects of each finished hour partition into one gzipped jsonl object.
+Works on the partitioned key layout (company=X/date=YYYY-MM-DD/hour=HH/). Parquet files are left untouched.
+The keys merged into each compacted object are recorded under _compaction/, so an interrupted or partly failed run
+never merges the same batch twice.
+
+    python compact.py APPLE                               # every finished hour of APPLE
+    python compact.py APPLE --date 2018-10-10 --hour 20   # a single hour
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import uuid
+
+import botocore.exceptions
+
+import partitioning
+import s3_utils
+import settings
+from utils import DataPipelineException, compress_to_gz
+from writers import JsonlBatch, read_batch_file
+
+LOGGER = logging.getLogger(__name__)
+GRACE_HOURS = 1  # Hours to wait after a partition's hour ends before compacting it, so late batches are included.
+COMPACTED_SUFFIX = '_compacted.jsonl.gz'
+SOURCES_PREFIX = '_compaction/'  # Records of the keys merged into each compacted object, outside the partitions.
+
+
+def list_partitions(conn, company):
+    """Lists the batch keys of every hour partition of a company. Always lists S3 itself: late batches are written
+    below keys a manifest cache has already listed.
+    :param conn: S3Connection to list.
+    :param company: company to list partitions for.
+    :return: dictionary of partition prefix (ending with /) to the list of its json batch keys in key order.
+    """
+    partitions = {}
+    for key in conn.list_keys('company={}/'.format(company), use_manifest=False):
+        partition = partitioning.parse_partition(key)
+        if partition is None or key.endswith('.parquet'):
+            continue
+        prefix = 'company={company}/date={date}/hour={hour}/'.format(**partition)
+        partitions.setdefault(prefix, []).append(key)
+    return partitions
+
+
+def is_finished(prefix, grace_hours=GRACE_HOURS):
+    """Checks whether a partition's hour ended at least grace_hours ago (UTC)."""
+    partition = partitioning.parse_partition(prefix)
+    hour_start = datetime.datetime.strptime('{date} {hour}'.format(**partition), '%Y-%m-%d %H')
+    return hour_start + datetime.timedelta(hours=1 + grace_hours) <= datetime.datetime.utcnow()
+
+
+def sources_key(compacted_key):
+    """Returns the key recording which batches were merged into a compacted object."""
+    return SOURCES_PREFIX + compacted_key + '.json'
+
+
+def read_sources(conn, compacted_key):
+    """Returns the set of keys merged into a compacted object. Empty if they were not recorded."""
+    try:
+        return set(json.loads(conn.get_key_contents(sources_key(compacted_key)).decode('utf-8')))
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return set()
+
+
+def compact_partition(conn, prefix, keys, local_dir=None, threads=1):
+    """Merges the batches of one partition into a single gzipped jsonl object and deletes the originals.
+    A previously compacted object is merged like any other batch, so compaction can be re-run as late batches arrive.
+    The merged keys are recorded before the compacted object is uploaded. Originals that are still listed after a
+    crash or a failed delete are then known to be in a compacted object: they are deleted again, not merged again.
+    :param conn: S3Connection holding the partition.
+    :param prefix: partition prefix ending with /.
+    :param keys: batch keys of the partition in key order.
+    :param local_dir: working directory. None to use a temporary system directory.
+    :param threads: threads gzipping the merged object.
+    :return: the key of the compacted object, or None if there was nothing to compact.
+    :raises DataPipelineException: if some originals could not be deleted. The next run deletes them.
+    """
+    merged_keys = set()
+    for key in keys:
+        if key.endswith(COMPACTED_SUFFIX):
+            merged_keys.update(read_sources(conn, key))
+    # The sources records of compacted objects are deleted along with them.
+    obsolete = list(keys) + [sources_key(key) for key in keys if key.endswith(COMPACTED_SUFFIX)]
+    to_merge = [key for key in keys if key not in merged_keys]
+    if len(to_merge) < 2:
+        keep = set(to_merge) | set(sources_key(key) for key in to_merge)
+        left_over = [key for key in obsolete if key not in keep]
+        if left_over:
+            LOGGER.info('Deleting {} already compacted keys of {}'.format(len(left_over), prefix))
+            _delete_compacted(conn, prefix, left_over)
+        return None
+    work_dir = tempfile.mkdtemp(dir=local_dir)
+    try:
+        # Keep each file's original name: it tells read_batch_file which format the batch is in.
+        file_list = [os.path.join(work_dir, '{:06d}_{}'.format(i, os.path.basename(key)))
+                     for i, key in enumerate(to_merge)]
+        LOGGER.info('Compacting {} batches of {}'.format(len(to_merge), prefix))
+        conn.download_parallel(to_merge, file_list)
+        compacted_key = partitioning.object_key(prefix.rstrip('/'), COMPACTED_SUFFIX, uuid.uuid4().hex[:8])
+        # Merged uncompressed, then gzipped on several cores at once.
+        merged = JsonlBatch(os.path.join(work_dir, os.path.basename(compacted_key)[:-len('.gz')]))
+        for filepath in file_list:
+            for record in read_batch_file(filepath):
+                merged.append(record)
+        merged_path = compress_to_gz(merged.close(), delete_original=True, threads=threads)
+        # Every listed key, merged now or by an earlier compacted object, ends up in compacted_key.
+        conn.upload_bytes(json.dumps(sorted(keys)).encode('utf-8'), sources_key(compacted_key))
+        conn.upload_files([merged_path], [compacted_key])
+        LOGGER.info('Compacted {} records of {} into {}'.format(len(merged), prefix, compacted_key))
+        _delete_compacted(conn, prefix, obsolete)
+        return compacted_key
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def _delete_compacted(conn, prefix, keys):
+    """Deletes keys whose records are in a compacted object.
+    :raises DataPipelineException: if some keys could not be deleted.
+    """
+    deleted = set(conn.delete_key_list(keys))
+    failed = [key for key in keys if key not in deleted]
+    if failed:
+        raise DataPipelineException('Could not delete {} compacted keys of {}, the next compaction deletes them: {}'
+                                    .format(len(failed), prefix, ', '.join(failed)))
+
+
+def compact_company(conn, company, date=None, hour=None, grace_hours=GRACE_HOURS, threads=1):
+    """Compacts every finished partition of a company, optionally restricted to one date and hour.
+    :param threads: threads gzipping each compacted object.
+    :return: list of the compacted object keys.
+    """
+    compacted = []
+    for prefix, keys in sorted(list_partitions(conn, company).items()):
+        partition = partitioning.parse_partition(prefix)
+        if (date is not None and partition['date'] != date) or (hour is not None and partition['hour'] != hour):
+            continue
+        if not is_finished(prefix, grace_hours):
+            continue
+        compacted_key = compact_partition(conn, prefix, keys, threads=threads)
+        if compacted_key is not None:
+            compacted.append(compacted_key)
+    return compacted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('companies', nargs='+', help='companies to compact')
+    parser.add_argument('--date', help='only compact this date, YYYY-MM-DD')
+    parser.add_argument('--hour', help='only compact this hour, HH')
+    parser.add_argument('--grace-hours', type=float, default=GRACE_HOURS,
+                        help='hours to wait after a partition ends before compacting it')
+    parser.add_argument('--threads', type=int, default=multiprocessing.cpu_count(),
+                        help='threads gzipping each compacted object. Default: one per core')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    with s3_utils.S3Connection.from_config(settings.load().aws) as conn:
+        for company in args.companies:
+            compacted = compact_company(conn, company.upper(), args.date, args.hour, args.grace_hours,
+                                        args.threads)
+            LOGGER.info('Compacted {} partitions of {}'.format(len(compacted), company))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Pluggable json decoders for raw stream payloads.
+orjson and pysimdjson are optional. Without them everything falls back to the standard library json module.
+"""
+import json
+import logging
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+from utils import DataPipelineException
+
+LOGGER = logging.getLogger(__name__)
+
+BACKEND_AUTO = 'auto'  # Fastest available backend for the requested projection.
+BACKEND_JSON = 'json'
+BACKEND_ORJSON = 'orjson'
+BACKEND_SIMDJSON = 'simdjson'
+TWEET_FIELDS = ('text', 'created_at', 'id_str', 'retweeted_status.id_str')  # Fields the collectors use.
+
+
+def available_backends():
+    """Returns the names of the backends that can be used in this environment, fastest projection first."""
+    backends = []
+    if simdjson is not None:
+        backends.append(BACKEND_SIMDJSON)
+    if orjson is not None:
+        backends.append(BACKEND_ORJSON)
+    backends.append(BACKEND_JSON)
+    return backends
+
+
+def get_decoder(backend=BACKEND_AUTO, fields=None):
+    """Returns a function that decodes one raw json payload into a dictionary.
+    :param backend: one of BACKEND_AUTO, BACKEND_JSON, BACKEND_ORJSON or BACKEND_SIMDJSON.
+    :param fields: optional iterable of fields to project, e.g. ('text', 'created_at', 'user.screen_name').
+        Nested fields are separated with dots. The result only holds the fields present in the payload, keyed by
+        the given names. With simdjson only those fields are materialized; the other backends parse the whole payload.
+    :return: callable(raw) -> dict. Raises ValueError on invalid json.
+    """
+    if backend == BACKEND_AUTO:
+        # simdjson only wins when it can skip most of the payload; orjson is faster at building full objects.
+        backends = available_backends()
+        if fields is None and BACKEND_ORJSON in backends:
+            backend = BACKEND_ORJSON
+        else:
+            backend = backends[0]
+    if backend not in available_backends():
+        raise DataPipelineException('json backend {} is not available'.format(backend))
+    LOGGER.debug('Using {} json decoder with projection {}'.format(backend, fields))
+    if backend == BACKEND_SIMDJSON:
+        return _SimdjsonDecoder(fields)
+    loads = orjson.loads if backend == BACKEND_ORJSON else json.loads
+    if fields is None:
+        return loads
+    paths = [(field, field.split('.')) for field in fields]
+
+    def decode(raw):
+        return _project(loads(raw), paths)
+    return decode
+
+
+def _project(obj, paths):
+    """Picks the dotted paths out of a decoded payload."""
+    projected = {}
+    if not isinstance(obj, dict):
+        return projected
+    for field, path in paths:
+        value = obj
+        for part in path:
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            projected[field] = value
+    return projected
+
+
+class _SimdjsonDecoder(object):
+    """Decodes with pysimdjson, which parses lazily so projected fields are the only Python objects created.
+    Parsers are reused per thread because a parser cannot be shared while its document is in use.
+    """
+
+    def __init__(self, fields):
+        self.pointers = [(field, '/' + field.replace('.', '/')) for field in fields] if fields is not None else None
+        self._local = threading.local()
+
+    def __call__(self, raw):
+        parser = getattr(self._local, 'parser', None)
+        if parser is None:
+            parser = self._local.parser = simdjson.Parser()
+        if isinstance(raw, str) and not isinstance(raw, bytes):
+            raw = raw.encode('utf-8')
+        doc = parser.parse(raw)
+        if self.pointers is None:
+            return doc.as_dict() if isinstance(doc, simdjson.Object) else doc
+        projected = {}
+        if isinstance(doc, simdjson.Object):
+            for field, pointer in self.pointers:
+                try:
+                    value = doc.at_pointer(pointer)
+                except (KeyError, IndexError, TypeError, ValueError):
+                    continue
+                projected[field] = value.as_dict() if isinstance(value, simdjson.Object) else (
+                    value.as_list() if isinstance(value, simdjson.Array) else value)
+        return projected
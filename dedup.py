@@ -0,0 +1,136 @@
+"""Bounded memory deduplication of retweets and repeated stream deliveries."""
+import logging
+import math
+import re
+import threading
+import time
+
+from utils import DataPipelineException, hash_string_to_int
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024  # Memory ceiling shared by both bloom filter generations.
+DEFAULT_ERROR_RATE = 0.001  # False positive rate of a full generation, i.e. unique tweets wrongly dropped.
+
+_RETWEET_PREFIX = re.compile(r'^rt @\w+:\s*')
+_URL = re.compile(r'https?://\S+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """Normalizes tweet text so retweets and re-deliveries of the same text compare equal.
+    Lowercases, strips the 'RT @user:' prefix and links (t.co links differ per tweet) and collapses whitespace.
+    """
+    text = _RETWEET_PREFIX.sub('', text.lower().strip())
+    text = _URL.sub('', text)
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+class RotatingBloomFilter(object):
+    """Set membership with a fixed memory ceiling. Keys are added to the current generation; once it holds
+    `capacity` keys, or is older than `window` seconds, it becomes the previous generation and the one before is
+    dropped. Lookups check both, so a key is remembered for at least one full generation.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, error_rate=DEFAULT_ERROR_RATE, window=None):
+        """
+        :param max_bytes: total memory of the two generations.
+        :param error_rate: target false positive rate of a full generation.
+        :param window: max seconds a generation stays current. None to rotate on capacity only.
+        """
+        if max_bytes < 16 or not 0 < error_rate < 1:
+            raise DataPipelineException('Invalid bloom filter settings: {} bytes, {} error rate'.format(
+                max_bytes, error_rate))
+        self.num_bits = (max_bytes // 2) * 8
+        self.capacity = int(self.num_bits * math.log(2) ** 2 / -math.log(error_rate))
+        self.num_hashes = max(1, int(round(self.num_bits / float(self.capacity) * math.log(2))))
+        self.window = window
+        self._current = bytearray(self.num_bits // 8)
+        self._previous = bytearray(self.num_bits // 8)
+        self._count = 0
+        self._started = time.time()
+        self.num_rotations = 0
+
+    def add(self, key):
+        """Adds key to the filter.
+        :param key: byte string to add.
+        :return: True if the key was new, False if it was (probably) seen before.
+        """
+        if self._count >= self.capacity or (self.window is not None and time.time() - self._started > self.window):
+            self._rotate()
+        positions = self._positions(key)
+        if all(self._is_set(self._current, p) for p in positions) or all(
+                self._is_set(self._previous, p) for p in positions):
+            return False
+        for p in positions:
+            self._current[p >> 3] |= 1 << (p & 7)
+        self._count += 1
+        return True
+
+    def _positions(self, key):
+        # Double hashing: two 32 bit halves of one digest generate all num_hashes positions.
+        digest = hash_string_to_int(key, 2 ** 64)
+        h1, h2 = digest & 0xffffffff, (digest >> 32) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    @staticmethod
+    def _is_set(bits, position):
+        return bits[position >> 3] & (1 << (position & 7))
+
+    def _rotate(self):
+        self._previous, self._current = self._current, self._previous
+        self._current[:] = bytearray(len(self._current))
+        self._count = 0
+        self._started = time.time()
+        self.num_rotations += 1
+        LOGGER.debug('Rotated dedup bloom filter generation {}'.format(self.num_rotations))
+
+
+class Deduplicator(object):
+    """Drops tweets whose id, retweeted id or normalized text was already seen."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, error_rate=DEFAULT_ERROR_RATE, window=None):
+        """Same parameters as RotatingBloomFilter. The memory ceiling covers both ids and texts."""
+        self._filter = RotatingBloomFilter(max_bytes, error_rate, window)
+        self._lock = threading.Lock()
+        self._stats = {'passed': 0, 'dropped_id': 0, 'dropped_text': 0}
+
+    def is_duplicate(self, tweet):
+        """Checks a tweet against everything seen so far and remembers it.
+        :param tweet: decoded tweet with text and, if available, id_str and retweeted_status.id_str.
+        :return: True if the tweet should be dropped.
+        """
+        tweet_id = tweet.get('id_str')
+        retweeted_id = tweet.get('retweeted_status.id_str') or (tweet.get('retweeted_status') or {}).get('id_str')
+        text = normalize_text(tweet.get('text') or '')
+        with self._lock:
+            # Every key is added even when an earlier one matched, so later copies are caught by any of them.
+            new_id = self._filter.add(b'id:' + tweet_id.encode('utf-8')) if tweet_id else True
+            new_retweet = self._filter.add(b'id:' + retweeted_id.encode('utf-8')) if retweeted_id else True
+            new_text = self._filter.add(b'text:' + text.encode('utf-8')) if text else True
+            if not new_id or not new_retweet:
+                self._stats['dropped_id'] += 1
+                return True
+            if not new_text:
+                self._stats['dropped_text'] += 1
+                return True
+            self._stats['passed'] += 1
+            return False
+
+    def stats(self):
+        """Returns the passed and dropped counters."""
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot['rotations'] = self._filter.num_rotations
+        return snapshot
+
+
+def from_config(info):
+    """Creates a Deduplicator from the 'dedup' section of the yaml config.
+    :param info: dictionary of dedup settings. Dedup is off unless enabled is true, since it also drops distinct
+        tweets that share the same normalized text.
+    :return: a Deduplicator, or None if dedup is disabled.
+    """
+    if not info.get('enabled', False):
+        return None
+    return Deduplicator(info.get('max_bytes') or DEFAULT_MAX_BYTES, info.get('error_rate') or DEFAULT_ERROR_RATE,
+                        info.get('window'))
@@ -0,0 +1,73 @@
+"""Keyword matching used to route tweets from a shared stream to company buckets."""
+import logging
+import re
+
+LOGGER = logging.getLogger(__name__)
+
+
+class KeywordMatcher(object):
+    """Matches tweet text against a fixed set of tracked terms using a single precompiled regex.
+    Each term maps to one or more labels (e.g. company names). Matching is case insensitive and a term only
+    matches on its own, not as a part of a longer word, which mirrors how the streaming API tracks terms.
+    """
+
+    def __init__(self):
+        self._labels_by_term = {}
+        self._pattern = None
+
+    def add(self, term, label):
+        """Registers a term that should be routed to label.
+        :param term: tracked term, e.g. 'APPLE' or '$AAPL'.
+        :param label: label returned when the term is found, e.g. the company name.
+        """
+        term = term.strip()
+        if not term:
+            return
+        self._labels_by_term.setdefault(term.lower(), set()).add(label)
+        self._pattern = None  # Recompile lazily on next match.
+
+    def terms(self):
+        """Returns the list of registered terms, suitable for Stream.filter(track=...)."""
+        return sorted(self._labels_by_term.keys())
+
+    def labels(self):
+        """Returns the set of every label that can be matched."""
+        return set(label for labels in self._labels_by_term.values() for label in labels)
+
+    def match(self, text):
+        """Finds every label whose terms appear in text.
+        :param text: tweet text to scan.
+        :return: set of matched labels. Empty if nothing matched.
+        """
+        if not text or not self._labels_by_term:
+            return set()
+        if self._pattern is None:
+            self._pattern = self._compile()
+        matched = set()
+        for term in self._pattern.findall(text):
+            matched.update(self._labels_by_term[term.lower()])
+        return matched
+
+    def _compile(self):
+        """Builds one alternation over all terms. Longer terms go first so they win over their prefixes."""
+        terms = sorted(self._labels_by_term.keys(), key=len, reverse=True)
+        alternation = '|'.join(re.escape(term) for term in terms)
+        LOGGER.debug('Compiling matcher over {} terms'.format(len(terms)))
+        return re.compile(r'(?<!\w)(?:{})(?!\w)'.format(alternation), re.IGNORECASE | re.UNICODE)
+
+
+def build_matcher(company_ary, stock_ary):
+    """Builds the matcher routing tweets to companies by company name or stock symbol.
+    :param company_ary: company names.
+    :param stock_ary: stock symbol of each company.
+    :return: (KeywordMatcher labelling matches with the upper cased company, dictionary of company to stock).
+    """
+    matcher = KeywordMatcher()
+    stock_by_company = {}
+    for company, stock in zip(company_ary, stock_ary):
+        company = company.strip().upper()
+        stock = stock.strip().upper()
+        matcher.add(company, company)
+        matcher.add(stock, company)
+        stock_by_company[company] = stock
+    return matcher, stock_by_company
@@ -0,0 +1,335 @@
+"""Prometheus-style metrics for the collectors and S3Connection, served in the text exposition format.
+Only the standard library is used. With the metrics server started:
+
+    curl http://127.0.0.1:9108/metrics               # counters, gauges and histograms
+    curl http://127.0.0.1:9108/profile?seconds=30    # samples every thread's stack, collapsed for flame graphs
+"""
+import bisect
+import collections
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+from utils import DataPipelineException
+
+LOGGER = logging.getLogger(__name__)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300)  # Seconds.
+SIZE_BUCKETS = (1024, 16 * 1024, 256 * 1024, 1024 * 1024, 8 * 1024 * 1024, 64 * 1024 * 1024,
+                256 * 1024 * 1024)  # Bytes.
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples of the sampling profiler.
+MAX_PROFILE_SECONDS = 300  # Longest profile that can be requested over HTTP.
+
+
+class _Metric(object):
+    """A named metric with one value per combination of label values."""
+    type_name = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+
+    def render(self):
+        """Returns the metric in the Prometheus text exposition format."""
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} {}'.format(self.name, self.type_name)]
+        for suffix, labels, value in self._samples():
+            lines.append(u'{}{}{} {}'.format(self.name, suffix, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _samples(self):
+        """Yields (name suffix, [(label name, label value)], value) of every sample."""
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield '', list(zip(self.labelnames, labels)), value
+
+    def _check(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise DataPipelineException('{} takes labels {}, got {}'.format(self.name, self.labelnames, labels))
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+    type_name = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        """Adds amount to the counter of the label values."""
+        with self._lock:
+            if labels not in self._values:
+                self._check(labels)
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, either set directly or read from a function at scrape time."""
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super(Gauge, self).__init__(name, help_text, labelnames)
+        self._functions = {}
+
+    def set(self, value, labels=()):
+        self._check(labels)
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, fn, labels=()):
+        """Reports fn() as the gauge value of the label values on every scrape."""
+        self._check(labels)
+        with self._lock:
+            self._functions[labels] = fn
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for labels, fn in functions.items():
+            try:
+                values[labels] = fn()
+            except Exception:
+                LOGGER.exception('Failed to read gauge {}'.format(self.name))
+        for labels, value in sorted(values.items()):
+            yield '', list(zip(self.labelnames, labels)), value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over cumulative buckets, with their sum and count."""
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        """Records one observation for the label values."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                self._check(labels)
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][i] += 1
+            state[1] += value
+
+    def time(self, labels=()):
+        """Returns a context manager observing the seconds spent in its block."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            label_pairs = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', label_pairs + [('le', bound)], cumulative
+            yield '_sum', label_pairs, total
+            yield '_count', label_pairs, cumulative
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start, self.labels)
+
+
+def timed(histogram):
+    """Decorator observing the duration of every call of the decorated function in histogram."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.time() - start)
+        return wrapper
+    return decorator
+
+
+class Registry(object):
+    """Set of metrics rendered together. Asking for an existing name returns the registered metric."""
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._get_or_create(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._get_or_create(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(metric.render() for metric in metrics)
+
+    def _get_or_create(self, cls, name, help_text, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise DataPipelineException('Metric {} is already registered differently'.format(name))
+            return metric
+
+
+REGISTRY = Registry()  # Default registry served by start_server.
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+# Collector metrics shared by tweetstream, multi_company and async_stream.
+TWEETS_RECEIVED = counter('tweets_received_total', 'Tweets received from the stream.')
+TWEETS_KEPT = counter('tweets_kept_total', 'Tweet records handed to the batch pipeline.', ('company',))
+TWEETS_DROPPED = counter('tweets_dropped_total', 'Tweets dropped, by reason. company is empty before matching.',
+                         ('company', 'reason'))
+ON_DATA_SECONDS = histogram('on_data_seconds', 'Time spent handling one stream payload.')
+STREAM_ERRORS = counter('stream_errors_total', 'Error statuses returned by the stream.', ('code',))
+STREAM_DISCONNECTS = counter('stream_disconnects_total', 'Stream connections lost to timeouts or exceptions.',
+                             ('reason',))
+
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    """Sampling profiler: periodically records the stack of every other thread.
+    Works on running threads without restarting or slowing them down, unlike cProfile which has to be enabled on
+    the profiled thread.
+    :param seconds: how long to sample.
+    :param interval: seconds between samples.
+    :return: collapsed stacks, one 'thread;outer;...;inner count' line per distinct stack, most frequent first.
+    """
+    own_id = threading.current_thread().ident
+    counts = collections.Counter()
+    end = time.time() + seconds
+    while time.time() < end:
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in counts.most_common())
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serves /metrics and /profile?seconds=N."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            body = self.server.registry.render()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif url.path == '/profile':
+            try:
+                seconds = float(parse_qs(url.query).get('seconds', ['10'])[0])
+            except ValueError:
+                self.send_error(400, 'seconds must be a number')
+                return
+            body = sample_stacks(min(seconds, MAX_PROFILE_SECONDS))
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        LOGGER.debug('Metrics request: ' + format % args)
+
+
+def start_server(port, host='127.0.0.1', registry=REGISTRY):
+    """Serves the registry over HTTP on a daemon thread.
+    :param port: port to listen on. 0 to pick a free one.
+    :param host: interface to listen on. Defaults to local connections only.
+    :param registry: Registry to serve.
+    :return: the running server. Its server_address holds the bound port; call shutdown() to stop it.
+    """
+    server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    LOGGER.info('Serving metrics on http://{}:{}/metrics'.format(*server.server_address[:2]))
+    return server
+
+
+def from_config(info, port_offset=0):
+    """Starts the metrics server from the 'metrics' section of the yaml config.
+    :param info: dictionary with port and optionally host.
+    :param port_offset: added to the port, so several processes of one deployment get their own port.
+    :return: the running server, or None if no port is configured.
+    """
+    if not info.get('port'):
+        return None
+    return start_server(info['port'] + port_offset, info.get('host') or '127.0.0.1')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return u'{' + u','.join(u'{}="{}"'.format(name, _escape(_format_value(value) if name == 'le' else value))
+                            for name, value in labels) + u'}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    """Escapes a label value. Byte strings are decoded as utf-8, so non-ascii company names render on Python 2."""
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    elif not isinstance(value, type(u'')):
+        value = u'{}'.format(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -3,75 +3,197 @@ from tweepy import OAuthHandler
 from tweepy import Stream
 import sys
 import os
+import signal
 import time
 import json
-import yaml
 import s3_utils
-from utils import rel_path
+import aggregate
+import decoders
+import dedup
+import metrics
+import settings
+from matcher import build_matcher
+import pipeline as batch_pipeline
 
-company_info = yaml.safe_load(file(rel_path('config/cred.yaml')))['many_company']
-companys = company_info['company_name']
-stocks = company_info['stock']
+config = settings.load()
+pipeline_info = config.section('pipeline')
+decoder_info = config.section('decoder')
+decode = decoders.get_decoder(decoder_info.get('backend') or 'auto',
+                              decoders.TWEET_FIELDS if decoder_info.get('project', True) else None)
+dedup_info = config.section('dedup')
+aggregate_info = config.section('aggregate')
+metrics_info = config.section('metrics')
 DIRECTORY = os.path.dirname(os.path.abspath(__file__))
-json_data = {}
 class StdOutListener(StreamListener):
 
-    def __init__(self, company, filename, time_end, api=None):
+    def __init__(self, company, pipeline, time_end, deduplicator=None, aggregator=None, stock=None, api=None):
         super(StdOutListener, self).__init__()
         self.num_tweets = 0
         self.company = company
-        # self.filename = company+'rongbin.dashboard'+time.strftime("%Y%m%d%H%M%S")+'.txt'
-        self.filename = filename
+        self.stock = stock
+        self.pipeline = pipeline
         self.time_end = time_end
-        # self.conn = s3_utils.S3Connection.from_yaml(rel_path('config/cred.yaml'), 'aws')
+        self.dedup = deduplicator
+        self.aggregator = aggregator
 
+    @metrics.timed(metrics.ON_DATA_SECONDS)
     def on_data(self, data):
-        global json_data
-    	data = json.loads(data)
+        data = decode(data)
         if 'text' in data and time.time()<self.time_end:
+            metrics.TWEETS_RECEIVED.inc()
+            if self.dedup is not None and self.dedup.is_duplicate(data):
+                metrics.TWEETS_DROPPED.inc(labels=(self.company, 'duplicate'))
+                return True
             text = data['text']
             created_at = data['created_at']
             record = {}
             record['Text'] = text
             record['Created at'] = created_at
             record['Company'] = self.company
-            record['Stock'] = stock
-            json_data[str(self.num_tweets)] = record
+            record['Stock'] = self.stock
+            if self.pipeline.put(self.company, record):
+                metrics.TWEETS_KEPT.inc(labels=(self.company,))
+            else:
+                metrics.TWEETS_DROPPED.inc(labels=(self.company, 'queue_full'))
+            if self.aggregator is not None:
+                self.aggregator.add(self.company, text)
             self.num_tweets += 1
             return True
         else:
             return False
 
     def on_error(self, status):
+        metrics.STREAM_ERRORS.inc(labels=(str(status),))
         print status
+        print self.pipeline.stats()
+        if self.dedup is not None:
+            print self.dedup.stats()
+
+    def on_timeout(self):
+        metrics.STREAM_DISCONNECTS.inc(labels=('timeout',))
+
+    def on_exception(self, exception):
+        metrics.STREAM_DISCONNECTS.inc(labels=(type(exception).__name__,))
+
+
+class MultiplexListener(StreamListener):
+    """Listens to a single stream tracking every company and routes each tweet to the matching company batches."""
+
+    def __init__(self, matcher, stock_by_company, pipeline, deduplicator=None, aggregator=None, api=None):
+        super(MultiplexListener, self).__init__()
+        self.matcher = matcher
+        self.stock_by_company = stock_by_company
+        self.pipeline = pipeline
+        self.dedup = deduplicator
+        self.aggregator = aggregator
+        self.num_tweets = 0
+        self.num_unmatched = 0
+
+    @metrics.timed(metrics.ON_DATA_SECONDS)
+    def on_data(self, data):
+        data = decode(data)
+        if 'text' in data:
+            self.num_tweets += 1
+            metrics.TWEETS_RECEIVED.inc()
+            if self.dedup is not None and self.dedup.is_duplicate(data):
+                metrics.TWEETS_DROPPED.inc(labels=('', 'duplicate'))
+                return True
+            companies = self.matcher.match(data['text'])
+            if not companies:
+                self.num_unmatched += 1
+                metrics.TWEETS_DROPPED.inc(labels=('', 'unmatched'))
+            for company in companies:
+                record = {}
+                record['Text'] = data['text']
+                record['Created at'] = data['created_at']
+                record['Company'] = company
+                record['Stock'] = self.stock_by_company[company]
+                if self.pipeline.put(company, record):
+                    metrics.TWEETS_KEPT.inc(labels=(company,))
+                else:
+                    metrics.TWEETS_DROPPED.inc(labels=(company, 'queue_full'))
+                if self.aggregator is not None:
+                    self.aggregator.add(company, data['text'])
+        return True
+
+    def on_error(self, status):
+        metrics.STREAM_ERRORS.inc(labels=(str(status),))
+        print status
+        print "Skipped "+str(self.num_unmatched)+" tweets without a tracked term in the text"
+        print self.pipeline.stats()
+        if self.dedup is not None:
+            print self.dedup.stats()
+
+    def on_timeout(self):
+        metrics.STREAM_DISCONNECTS.inc(labels=('timeout',))
+
+    def on_exception(self, exception):
+        metrics.STREAM_DISCONNECTS.inc(labels=(type(exception).__name__,))
+
+
+def multiplex(conn, company_ary, stock_ary, tweet_cred=None, on_start=None):
+    """Collects every company at once on one stream instead of rotating through them.
+    :param conn: S3Connection to upload batches to.
+    :param company_ary: company names to track.
+    :param stock_ary: stock symbol of each company.
+    :param tweet_cred: twitter credentials to stream with. None to use the twitter section of the config.
+    :param on_start: optional callable(listener) invoked before the stream connects.
+    """
+    matcher, stock_by_company = build_matcher(company_ary, stock_ary)
+    print "Collecting data for companies "+",".join(sorted(stock_by_company))
+    pipeline = batch_pipeline.from_config(conn, pipeline_info)
+    aggregator = aggregate.from_config(conn, aggregate_info)
+    l = MultiplexListener(matcher=matcher, stock_by_company=stock_by_company, pipeline=pipeline,
+                          deduplicator=dedup.from_config(dedup_info), aggregator=aggregator)
+    config = settings.load()
+    if tweet_cred is None:
+        tweet_cred = config.twitter
+    auth = OAuthHandler(tweet_cred['consumer_key'], tweet_cred['consumer_secret'])
+    auth.set_access_token(tweet_cred['access_token'], tweet_cred['access_token_secret'])
+    if on_start is not None:
+        on_start(l)
+    stream = Stream(auth, l, timeout=config.stream_timeout)
+    try:
+        stream.filter(track=matcher.terms(), languages=config.languages)
+    finally:
+        pipeline.stop()
+        if aggregator is not None:
+            aggregator.stop()
 
 
 if __name__ == '__main__':
-    company_ary =  companys.split(",")
-    stock_ary = stocks.split(",")
-    company_len = len(company_ary)
-    conn = s3_utils.S3Connection.from_yaml(rel_path('config/cred.yaml'), 'aws')
-    start_index = 0
-    while start_index<company_len:
-        company = company_ary[start_index].upper()
-        stock = stock_ary[start_index].upper()
-        print "Collecting data for company "+company
-        time_end = time.time() + 60 * 15
-        filename = company+'rongbin.dashboard'+time.strftime("%Y%m%d%H%M%S")+'.txt'
-        l = StdOutListener(company=company,filename=filename,time_end=time_end)
-        tweet_cred = yaml.safe_load(file(rel_path('config/cred.yaml')))['twitter']
-        auth = OAuthHandler(tweet_cred['consumer_key'], tweet_cred['consumer_secret'])
-        auth.set_access_token(tweet_cred['access_token'], tweet_cred['access_token_secret'])
-        stream = Stream(auth, l)
-        stream.filter(track=[company, stock])
-        with open(filename,'w') as tf:
-            json.dump(json_data, tf)
-        conn.upload_file(filename, company+'/'+filename)
-        os.remove(filename)
-        json_data = {}
-        start_index = start_index+1
-        if start_index == company_len:
-            start_index = 0
+    # Exit through the finally blocks on SIGTERM too, so open batches are flushed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    conn = s3_utils.S3Connection.from_config(config.aws)
+    metrics.from_config(metrics_info)
+    if config.mode == settings.MODE_MULTIPLEX:
+        multiplex(conn, [c.name for c in config.companies], [c.stock for c in config.companies])
+        sys.exit(0)
+    pipeline = batch_pipeline.from_config(conn, pipeline_info)
+    deduplicator = dedup.from_config(dedup_info)  # Shared across rotations.
+    aggregator = aggregate.from_config(conn, aggregate_info)
+    rotation = 0
+    try:
+        while True:
+            # Reloaded at every rotation, so edits to the companies or credentials apply without a restart.
+            config = settings.load()
+            companies = config.companies
+            company, stock = companies[rotation % len(companies)]
+            rotation = rotation + 1
+            print "Collecting data for company "+company
+            time_end = time.time() + config.rotation_seconds
+            l = StdOutListener(company=company,pipeline=pipeline,time_end=time_end,deduplicator=deduplicator,
+                               aggregator=aggregator,stock=stock)
+            tweet_cred = config.twitter
+            auth = OAuthHandler(tweet_cred['consumer_key'], tweet_cred['consumer_secret'])
+            auth.set_access_token(tweet_cred['access_token'], tweet_cred['access_token_secret'])
+            stream = Stream(auth, l, timeout=config.stream_timeout)
+            # The company's open batch is flushed by the batching policy, at the latest max_age after it opened.
+            stream.filter(track=[company, stock], languages=config.languages)
+    finally:
+        pipeline.stop()
+        if aggregator is not None:
+            aggregator.stop()
 
 
 
@@ -0,0 +1,62 @@
+"""S3 key layouts for tweet batches.
+flat:        APPLE/APPLErongbin.dashboard20181010201924_1f3a9c2e.txt
+partitioned: company=APPLE/date=2018-10-10/hour=20/APPLErongbin.dashboard20181010201924_1f3a9c2e.txt
+The partitioned layout is derived from each tweet's Created at, so query engines can prune by company, date and hour.
+"""
+import datetime
+import re
+import time
+
+from utils import DataPipelineException
+from writers import parse_created_at
+
+LAYOUT_FLAT = 'flat'
+LAYOUT_PARTITIONED = 'partitioned'
+_PARTITION = re.compile(r'^company=(?P<company>[^/]+)/date=(?P<date>\d{4}-\d{2}-\d{2})/hour=(?P<hour>\d{2})')
+
+
+def partition_prefix(company, created_at):
+    """Returns the partition of a tweet, e.g. company=APPLE/date=2018-10-10/hour=20
+    :param company: company of the tweet.
+    :param created_at: the tweet's created_at string. The current UTC time is used if it cannot be parsed.
+    """
+    created = parse_created_at(created_at) or datetime.datetime.utcnow()
+    return 'company={}/date={:%Y-%m-%d}/hour={:%H}'.format(company, created, created)
+
+
+def parse_partition(key):
+    """Extracts the partition of a partitioned key or prefix.
+    :return: dictionary with company, date and hour, or None for keys in the flat layout.
+    """
+    match = _PARTITION.match(key)
+    return match.groupdict() if match is not None else None
+
+
+def batch_key_fn(layout):
+    """Returns the BatchPipeline key_fn for a layout, mapping (company, record) to the key batches are grouped by.
+    :param layout: LAYOUT_FLAT or LAYOUT_PARTITIONED.
+    :return: callable, or None for the flat layout where batches are grouped by company.
+    """
+    if layout == LAYOUT_FLAT:
+        return None
+    if layout == LAYOUT_PARTITIONED:
+        return lambda company, record: partition_prefix(company, record.get('Created at'))
+    raise DataPipelineException('Unknown key layout {}'.format(layout))
+
+
+def company_of(batch_key):
+    """Returns the company of a batch key in either layout."""
+    partition = parse_partition(batch_key)
+    return partition['company'] if partition is not None else batch_key
+
+
+def object_key(batch_key, suffix, unique=None):
+    """Builds the S3 key of a batch.
+    :param batch_key: company (flat layout) or partition prefix the batch was grouped by.
+    :param suffix: file extension, e.g. '.txt' or '.jsonl.gz'.
+    :param unique: optional string appended to the timestamp to keep keys written in the same second apart.
+    :return: the full S3 key.
+    """
+    filename = '{}rongbin.dashboard{}{}{}'.format(company_of(batch_key), time.strftime("%Y%m%d%H%M%S"),
+                                                  '_' + unique if unique else '', suffix)
+    return batch_key + '/' + filename
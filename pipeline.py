@@ -0,0 +1,403 @@
+"""Producer/consumer pipeline that batches records off the stream thread."""
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import batching
+import metrics
+import partitioning
+import spool as batch_spool
+from utils import DataPipelineException
+from writers import JsonlBatch, write_parquet
+
+LOGGER = logging.getLogger(__name__)
+
+POLICY_BLOCK = 'block'  # Producers wait for room in the queue.
+POLICY_DROP = 'drop'  # Records are dropped when the queue is full.
+FORMAT_JSON = 'json'  # One json object per batch, keyed by record index.
+FORMAT_JSONL = 'jsonl'  # One json record per line, optionally gzipped.
+_FLUSH = object()  # Queue marker asking the batcher to flush every pending batch.
+_STOP = object()  # Queue marker asking the batcher to flush and exit.
+SWEEP_INTERVAL = 1  # Seconds between checks of every open batch's age.
+SIZE_SAMPLE_EVERY = 32  # Records per size sample of batches that do not track their bytes.
+BLOCK_POLL_SECONDS = 1  # Max seconds a blocked put() waits before checking that the batcher is still running.
+QUEUE_DEPTH = metrics.gauge('pipeline_queue_depth', 'Records waiting for the batcher.')
+DROPPED = metrics.counter('pipeline_dropped_total', 'Records dropped because the queue was full.')
+RECORD_ERRORS = metrics.counter('pipeline_record_errors_total', 'Records dropped because batching them failed.')
+BLOCKED_SECONDS = metrics.counter('pipeline_blocked_seconds_total', 'Time producers waited for room in the queue.')
+FLUSH_SECONDS = metrics.histogram('batch_flush_seconds', 'Time to serialize and persist one batch.')
+FLUSH_ERRORS = metrics.counter('batch_flush_errors_total', 'Batches that failed to flush.')
+SERIALIZE_SECONDS = metrics.histogram('batch_serialize_seconds', 'Time to serialize one batch.', ('format',))
+FLUSHES = metrics.counter('batch_flushes_total', 'Batches closed, by the batching limit that closed them.',
+                          ('reason',))
+
+
+class BatchPipeline(object):
+    """Bounded queue between the stream callback and a background batcher thread.
+    The stream thread only calls put(), which never does any I/O. The batcher groups records per key and hands
+    complete batches to a pool of flush workers that call flush_fn(key, batch). A BatchPolicy decides when a batch
+    is complete. A record the batcher fails to batch is logged and dropped. Any other batcher error stops the
+    pipeline: put(), flush() and stop() then raise DataPipelineException instead of waiting on a dead thread.
+    """
+
+    def __init__(self, flush_fn, batch_size=3000, max_age=None, queue_size=10000, policy=POLICY_BLOCK,
+                 block_timeout=None, flush_workers=1, batch_factory=None, max_bytes=None, key_fn=None, spool=None,
+                 batch_policy=None):
+        """
+        :param flush_fn: callable(key, batch) that persists a batch. Runs on a flush worker thread.
+        :param batch_size: number of records per batch, unless batch_policy is given. None to only flush on age,
+            bytes or explicit flush().
+        :param max_age: max seconds a batch may stay open, unless batch_policy is given. None to never flush on age.
+        :param queue_size: max number of records waiting for the batcher.
+        :param policy: POLICY_BLOCK or POLICY_DROP, what put() does when the queue is full.
+        :param block_timeout: with POLICY_BLOCK, max seconds to wait before dropping. None to wait forever.
+        :param flush_workers: number of batches that may be flushed concurrently.
+        :param batch_factory: callable(key) returning a new batch supporting append() and len(). None for a list.
+        :param max_bytes: max size of a batch, unless batch_policy is given. None to never flush on size.
+        :param key_fn: optional callable(key, record) returning the key to batch the record under instead of key.
+            Runs on the batcher thread.
+        :param spool: optional SpoolUploader that flush_fn writes through. It is drained and stopped after the last
+            flush, and its counters are reported by stats().
+        :param batch_policy: BatchPolicy deciding when batches are flushed. None for one with batch_size, max_bytes
+            and max_age as its hard limits. The size of batches without a num_bytes attribute is estimated from
+            sampled records.
+        """
+        if policy not in (POLICY_BLOCK, POLICY_DROP):
+            raise DataPipelineException('Unknown queue policy {}'.format(policy))
+        self.flush_fn = flush_fn
+        self.batch_policy = batch_policy if batch_policy is not None else batching.BatchPolicy(
+            max_records=batch_size, max_bytes=max_bytes, max_age=max_age)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.batch_factory = batch_factory
+        self.key_fn = key_fn
+        self.spool = spool
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batches = {}  # key -> (open time, batch). Only touched by the batcher thread.
+        self._next_sweep = 0
+        self._num_added = 0
+        self._sampled = [0, 0]  # Records and bytes of the size samples.
+        self._flush_pool = ThreadPool(processes=flush_workers)
+        # Caps batches waiting on flush workers so a slow sink pushes back on the queue instead of piling up.
+        self._in_flight = threading.BoundedSemaphore(flush_workers * 2)
+        self._stats_lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'dropped': 0, 'blocked_seconds': 0.0, 'max_queue_depth': 0,
+                       'flushed_batches': 0, 'flushed_records': 0, 'flush_errors': 0, 'record_errors': 0}
+        self._error = None  # Exception that stopped the batcher thread.
+        QUEUE_DEPTH.set_function(self._queue.qsize)
+        self._thread = threading.Thread(target=self._run, name='batch-pipeline')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, key, record):
+        """Queues a record for batching under key. Never blocks under POLICY_DROP.
+        :param key: batch key, e.g. the company name.
+        :param record: record to batch.
+        :return: True if the record was queued, False if it was dropped.
+        :raises DataPipelineException: if the batcher stopped after an error.
+        """
+        self._check_running()
+        try:
+            if self.policy == POLICY_DROP:
+                self._queue.put_nowait((key, record))
+            else:
+                try:
+                    self._queue.put_nowait((key, record))
+                except queue.Full:
+                    start = time.time()
+                    try:
+                        self._put_blocking((key, record), self.block_timeout)
+                    finally:
+                        self._add_stat('blocked_seconds', time.time() - start)
+                        BLOCKED_SECONDS.inc(time.time() - start)
+        except queue.Full:
+            self._add_stat('dropped', 1)
+            DROPPED.inc()
+            return False
+        with self._stats_lock:
+            self._stats['enqueued'] += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], self._queue.qsize())
+        return True
+
+    def full(self):
+        """Returns True if put() would currently have to block or drop."""
+        return self._queue.full()
+
+    def flush(self):
+        """Asks the batcher to flush every pending batch once the records queued so far are batched.
+        :raises DataPipelineException: if the batcher stopped after an error.
+        """
+        self._put_blocking(_FLUSH)
+
+    def stop(self, timeout=None):
+        """Flushes everything that was queued and waits for the flush workers to finish.
+        :param timeout: max seconds to wait for the batcher thread.
+        :raises DataPipelineException: if the batcher stopped after an error. Batches it already handed to the
+            flush workers are still flushed.
+        """
+        try:
+            self._put_blocking(_STOP)
+            self._thread.join(timeout)
+        finally:
+            self._flush_pool.close()
+            self._flush_pool.join()
+            if self.spool is not None:
+                self.spool.stop()
+        self._check_running()
+
+    def stats(self):
+        """Returns a snapshot of the backpressure and flush counters."""
+        with self._stats_lock:
+            snapshot = dict(self._stats)
+        snapshot['queue_depth'] = self._queue.qsize()
+        if self.spool is not None:
+            snapshot['spool'] = self.spool.stats()
+        return snapshot
+
+    def _add_stat(self, name, amount):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def _check_running(self):
+        """Raises DataPipelineException if the batcher thread stopped after an error."""
+        if self._error is not None:
+            raise DataPipelineException('Batch pipeline stopped after an error: {!r}'.format(self._error))
+
+    def _put_blocking(self, item, timeout=None):
+        """Queues an item, waiting for room in the queue while the batcher is running.
+        :param timeout: max seconds to wait. None to wait as long as the batcher runs.
+        :raises queue.Full: if there was no room within timeout.
+        :raises DataPipelineException: if the batcher stopped after an error.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            self._check_running()
+            wait = BLOCK_POLL_SECONDS if deadline is None else min(BLOCK_POLL_SECONDS, deadline - time.time())
+            try:
+                self._queue.put(item, timeout=max(wait, 0))
+                return
+            except queue.Full:
+                if deadline is not None and time.time() >= deadline:
+                    raise
+
+    def _run(self):
+        """Batcher thread. Stops the pipeline if the batcher loop fails, flushing what it can."""
+        try:
+            self._batch_loop()
+        except Exception as e:
+            self._error = e
+            LOGGER.exception('Batcher stopped, the pipeline no longer accepts records')
+            try:
+                self._flush_all()
+            except Exception:
+                LOGGER.exception('Failed to flush the open batches of the stopped batcher')
+
+    def _batch_loop(self):
+        """Batcher loop. Wakes up at least once a second to check batch ages."""
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._flush_all()
+                return
+            elif item is _FLUSH:
+                self._flush_all()
+            elif item is not None:
+                key, record = item
+                try:
+                    self._add(key, record)
+                except Exception:
+                    self._add_stat('record_errors', 1)
+                    RECORD_ERRORS.inc()
+                    LOGGER.exception('Failed to batch a record for {}'.format(key))
+            now = time.time()
+            if now >= self._next_sweep:
+                self._next_sweep = now + SWEEP_INTERVAL
+                for key in list(self._batches.keys()):
+                    self._check(key, now)
+
+    def _add(self, key, record):
+        """Appends a record to the open batch of its key, opening one if needed, and flushes it if it is due."""
+        if self.key_fn is not None:
+            key = self.key_fn(key, record)
+        if key not in self._batches:
+            batch = self.batch_factory(key) if self.batch_factory is not None else []
+            self._batches[key] = (time.time(), batch)
+        batch = self._batches[key][1]
+        batch.append(record)
+        if self.batch_policy.tracks_bytes and not hasattr(batch, 'num_bytes'):
+            self._sample_size(record)
+        self._check(key, time.time())
+
+    def _check(self, key, now):
+        """Submits the batch of key if the batching policy says it is due."""
+        opened, batch = self._batches[key]
+        reason = self.batch_policy.flush_reason(len(batch), self._num_bytes(batch), now - opened)
+        if reason is not None:
+            self._submit(key, reason)
+
+    def _num_bytes(self, batch):
+        """Returns the size of a batch, estimated from the size samples if the batch does not track it."""
+        num_bytes = getattr(batch, 'num_bytes', None)
+        if num_bytes is not None:
+            return num_bytes
+        num_records, sampled_bytes = self._sampled
+        return len(batch) * sampled_bytes // num_records if num_records else 0
+
+    def _sample_size(self, record):
+        """Measures the serialized size of every SIZE_SAMPLE_EVERY-th record."""
+        self._num_added += 1
+        if self._num_added % SIZE_SAMPLE_EVERY != 1:
+            return
+        try:
+            size = len(json.dumps(record))
+        except (TypeError, ValueError):
+            return
+        self._sampled[0] += 1
+        self._sampled[1] += size
+
+    def _flush_all(self):
+        for key in list(self._batches.keys()):
+            self._submit(key, batching.REASON_EXPLICIT)
+
+    def _submit(self, key, reason):
+        _, batch = self._batches.pop(key)
+        if len(batch):
+            FLUSHES.inc(labels=(reason,))
+            self._in_flight.acquire()
+            self._flush_pool.apply_async(self._flush, (key, batch))
+        elif hasattr(batch, 'discard'):
+            batch.discard()
+
+    def _flush(self, key, batch):
+        try:
+            with FLUSH_SECONDS.time():
+                self.flush_fn(key, batch)
+            with self._stats_lock:
+                self._stats['flushed_batches'] += 1
+                self._stats['flushed_records'] += len(batch)
+        except Exception:
+            self._add_stat('flush_errors', 1)
+            FLUSH_ERRORS.inc()
+            LOGGER.exception('Failed to flush batch of {} records for {}'.format(len(batch), key))
+        finally:
+            self._in_flight.release()
+        LOGGER.info('Pipeline stats: {}'.format(self.stats()))
+
+
+def upload_parquet(conn, s3_key, records):
+    """Writes records as a parquet file in memory and uploads it next to the json batch.
+    :param conn: S3Connection or SpoolUploader to upload to.
+    :param s3_key: key of the json batch. The parquet file takes the same key with a .parquet extension.
+    :param records: iterable of the batch records.
+    """
+    if s3_key.endswith('.gz'):
+        s3_key = s3_key[:-len('.gz')]
+    buf = io.BytesIO()
+    with SERIALIZE_SECONDS.time(('parquet',)):
+        write_parquet(records, buf)
+    conn.upload_bytes(buf.getvalue(), os.path.splitext(s3_key)[0] + '.parquet')
+
+
+class S3BatchSink(object):
+    """flush_fn for BatchPipeline that serializes a batch as a json object and uploads it under the key's prefix."""
+
+    def __init__(self, conn, parquet=False):
+        """
+        :param conn: S3Connection or SpoolUploader to upload to.
+        :param parquet: also upload each batch as a parquet file.
+        """
+        self.conn = conn
+        self.parquet = parquet
+
+    def __call__(self, batch_key, records):
+        # Batches of one key can close within the same second, so the timestamp alone would overwrite them.
+        s3_key = partitioning.object_key(batch_key, '.txt', uuid.uuid4().hex[:8])
+        with SERIALIZE_SECONDS.time((FORMAT_JSON,)):
+            data = json.dumps(dict((str(i), record) for i, record in enumerate(records))).encode('utf-8')
+        self.conn.upload_bytes(data, s3_key)
+        if self.parquet:
+            upload_parquet(self.conn, s3_key, records)
+
+
+class S3JsonlSink(object):
+    """flush_fn and batch_factory for BatchPipeline that stream records into jsonl batches and upload them.
+    Use as BatchPipeline(sink, batch_factory=sink.new_batch).
+    """
+
+    def __init__(self, conn, local_dir=None, compress=True, parquet=False):
+        """
+        :param conn: S3Connection or SpoolUploader to upload to.
+        :param local_dir: directory for the rolling batch files. None to keep batches in memory.
+        :param compress: gzip the batch files.
+        :param parquet: also upload each batch as a parquet file.
+        """
+        self.conn = conn
+        self.local_dir = local_dir
+        self.compress = compress
+        self.parquet = parquet
+
+    def new_batch(self, batch_key):
+        """Opens a new rolling batch named after the S3 key it will be uploaded to."""
+        # Size based rotation can close several batches a second, so the timestamp alone is not unique.
+        s3_key = partitioning.object_key(batch_key, '.jsonl.gz' if self.compress else '.jsonl', uuid.uuid4().hex[:8])
+        if self.local_dir is None:
+            return JsonlBatch(compress=self.compress, name=s3_key)
+        fd, local_path = tempfile.mkstemp(suffix=os.path.basename(s3_key), dir=self.local_dir)
+        os.close(fd)
+        return JsonlBatch(local_path, compress=self.compress, name=s3_key)
+
+    def __call__(self, batch_key, batch):
+        try:
+            with batch.open() as content:
+                self.conn.upload_stream(content, batch.name)
+            if self.parquet:
+                upload_parquet(self.conn, batch.name, batch.records())
+        finally:
+            batch.discard()
+
+
+def from_config(conn, info, batch_size=None, max_age=None):
+    """Creates a BatchPipeline uploading to conn from the 'pipeline' section of the yaml config.
+    :param conn: S3Connection to upload batches to.
+    :param info: dictionary of pipeline settings. Missing values use the defaults.
+        max_records, max_bytes, max_age, target_bytes and min_interval set the batching policy, see batching.
+        layout selects the S3 key layout, see partitioning.
+        spool_dir makes batches go through a durable local spool before S3, see spool.
+    :param batch_size: records per batch when the config sets no max_records. None to not flush on record count.
+    :param max_age: max seconds a batch may stay open when the config sets none. None for the batching default.
+    :return: a started BatchPipeline.
+    """
+    output_format = info.get('format') or FORMAT_JSON
+    uploader = batch_spool.from_config(conn, info)
+    target = uploader if uploader is not None else conn
+    if output_format == FORMAT_JSON:
+        sink = S3BatchSink(target, parquet=info.get('parquet', False))
+        batch_factory = None
+    elif output_format == FORMAT_JSONL:
+        sink = S3JsonlSink(target, local_dir=info.get('local_dir'), compress=info.get('compress', True),
+                           parquet=info.get('parquet', False))
+        batch_factory = sink.new_batch
+    else:
+        raise DataPipelineException('Unknown batch format {}'.format(output_format))
+    return BatchPipeline(sink, batch_policy=batching.from_config(info, max_records=batch_size, max_age=max_age),
+                         queue_size=info.get('queue_size') or 10000,
+                         policy=info.get('policy') or POLICY_BLOCK,
+                         block_timeout=info.get('block_timeout'),
+                         flush_workers=info.get('flush_workers') or 1,
+                         batch_factory=batch_factory,
+                         key_fn=partitioning.batch_key_fn(info.get('layout') or partitioning.LAYOUT_FLAT),
+                         spool=uploader)
@@ -0,0 +1,176 @@
+"""Local SQLite manifest of S3 listings and downloaded files."""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT NOT NULL,
+    last_modified TEXT,
+    PRIMARY KEY (bucket, key)
+);
+CREATE TABLE IF NOT EXISTS listings (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    last_key TEXT NOT NULL,
+    listed_at REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, prefix)
+);
+CREATE TABLE IF NOT EXISTS local_files (
+    path TEXT PRIMARY KEY,
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+'''
+
+
+class ManifestCache(object):
+    """Remembers which S3 objects were listed under each prefix and which of them are downloaded locally.
+    A prefix is either listed in full, which replaces what is known about it, or incrementally from its last listed
+    key. Incremental listings miss keys written below that key, so S3Connection.refresh_manifest falls back to a full
+    listing once the last one is older than its manifest_full_list_interval.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: path of the SQLite database file. Created if it does not exist.
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(listings)')]
+        if 'listed_at' not in columns:  # Manifest written before full listings were tracked.
+            with self._db:
+                self._db.execute('ALTER TABLE listings ADD COLUMN listed_at REAL NOT NULL DEFAULT 0')
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self._db.close()
+
+    def last_key(self, bucket, prefix):
+        """Returns the last key listed under the prefix, or None if it was never listed."""
+        with self._lock:
+            row = self._db.execute('SELECT last_key FROM listings WHERE bucket = ? AND prefix = ?',
+                                   (bucket, prefix)).fetchone()
+        return row[0] if row is not None else None
+
+    def listed_at(self, bucket, prefix):
+        """Returns the time of the last full listing of the prefix, or None if it was never listed in full."""
+        with self._lock:
+            row = self._db.execute('SELECT listed_at FROM listings WHERE bucket = ? AND prefix = ?',
+                                   (bucket, prefix)).fetchone()
+        return row[0] if row is not None and row[0] else None
+
+    def add_objects(self, bucket, prefix, objects):
+        """Stores incrementally listed objects and advances the prefix's last seen key.
+        :param bucket: bucket the objects were listed from.
+        :param prefix: prefix that was listed.
+        :param objects: iterable of list_objects_v2 object dicts in listing order.
+        :return: number of objects stored.
+        """
+        rows = [(bucket, obj['Key'], obj['Size'], obj['ETag'], str(obj.get('LastModified'))) for obj in objects]
+        if not rows:
+            return 0
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)', rows)
+            self._db.execute('INSERT OR IGNORE INTO listings (bucket, prefix, last_key) VALUES (?, ?, ?)',
+                             (bucket, prefix, ''))
+            self._db.execute('UPDATE listings SET last_key = ? WHERE bucket = ? AND prefix = ?',
+                             (max(row[1] for row in rows), bucket, prefix))
+        return len(rows)
+
+    def replace_objects(self, bucket, prefix, objects):
+        """Stores a full listing of a prefix. Objects that are no longer listed are forgotten.
+        :param bucket: bucket the objects were listed from.
+        :param prefix: prefix that was listed.
+        :param objects: iterable of every list_objects_v2 object dict under the prefix.
+        :return: number of listed objects that were new or changed.
+        """
+        rows = [(bucket, obj['Key'], obj['Size'], obj['ETag'], str(obj.get('LastModified'))) for obj in objects]
+        with self._lock, self._db:
+            known = dict(self._db.execute('SELECT key, etag FROM objects WHERE bucket = ? AND key >= ? AND key < ?',
+                                          (bucket, prefix, prefix + u'\uffff')).fetchall())
+            self._db.execute('DELETE FROM objects WHERE bucket = ? AND key >= ? AND key < ?',
+                             (bucket, prefix, prefix + u'\uffff'))
+            self._db.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?)', rows)
+            self._db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                             (bucket, prefix, max(row[1] for row in rows) if rows else '', time.time()))
+        return sum(1 for row in rows if known.get(row[1]) != row[3])
+
+    def reset_prefix(self, bucket, prefix):
+        """Forgets the listing of a prefix so the next listing starts from the beginning."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM objects WHERE bucket = ? AND key >= ? AND key < ?',
+                             (bucket, prefix, prefix + u'\uffff'))
+            self._db.execute('DELETE FROM listings WHERE bucket = ? AND prefix = ?', (bucket, prefix))
+
+    def objects(self, bucket, prefix):
+        """Returns the known objects under a prefix in key order, as dicts with Key, Size, ETag and LastModified."""
+        with self._lock:
+            rows = self._db.execute('SELECT key, size, etag, last_modified FROM objects '
+                                    'WHERE bucket = ? AND key >= ? AND key < ? ORDER BY key',
+                                    (bucket, prefix, prefix + u'\uffff')).fetchall()
+        return [{'Key': key, 'Size': size, 'ETag': etag, 'LastModified': last_modified}
+                for key, size, etag, last_modified in rows]
+
+    def remove_objects(self, bucket, keys):
+        """Forgets deleted objects."""
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM objects WHERE bucket = ? AND key = ?', [(bucket, key) for key in keys])
+
+    def is_cached(self, path, etag):
+        """Checks whether path holds a downloaded copy with this ETag, and marks it as recently used if so."""
+        with self._lock:
+            row = self._db.execute('SELECT etag FROM local_files WHERE path = ?', (path,)).fetchone()
+            if row is None or row[0] != etag or not os.path.exists(path):
+                return False
+            with self._db:
+                self._db.execute('UPDATE local_files SET last_access = ? WHERE path = ?', (time.time(), path))
+        return True
+
+    def add_local_file(self, path, bucket, key, etag, size):
+        """Records that key was downloaded to path."""
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO local_files VALUES (?, ?, ?, ?, ?, ?)',
+                             (path, bucket, key, etag, size, time.time()))
+
+    def evict(self, max_bytes, keep=()):
+        """Deletes the least recently used local files until the cached files total at most max_bytes.
+        :param max_bytes: max total size of the cached files.
+        :param keep: local paths that are never evicted, e.g. the files a caller is about to read. They count
+            towards max_bytes, so the other files are evicted first.
+        :return: list of the local paths that were deleted.
+        """
+        keep = set(keep)
+        with self._lock:
+            rows = self._db.execute('SELECT path, size FROM local_files ORDER BY last_access DESC').fetchall()
+            total = sum(size for path, size in rows if path in keep)
+            if total > max_bytes:
+                LOGGER.warning('Kept files total {} bytes, over the {} bytes cache limit'.format(total, max_bytes))
+            evicted = []
+            for path, size in rows:
+                if path in keep:
+                    continue
+                total += size
+                if total > max_bytes:
+                    evicted.append(path)
+            with self._db:
+                self._db.executemany('DELETE FROM local_files WHERE path = ?', [(path,) for path in evicted])
+        for path in evicted:
+            if os.path.exists(path):
+                os.remove(path)
+        if evicted:
+            LOGGER.info('Evicted {} files from the local S3 cache'.format(len(evicted)))
+        return evicted
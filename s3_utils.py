@@ -1,15 +1,42 @@
 """S3 related utility functions."""
+import datetime
 import logging
+import multiprocessing
 import boto3
-import yaml
+import boto3.s3.transfer
+import botocore.config
 import re
 from multiprocessing.pool import ThreadPool
+import io
 import os
 import tempfile
+import threading
+import time
 import uuid
 
+import metrics
+import partitioning
+import utils
+import writers
+from s3_cache import ManifestCache
+from utils import DataPipelineException
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
 LOGGER = logging.getLogger(__name__)
 PARALLEL_PROCESSES = 10  # Number of processes to use for parallel code.
+MAX_RETRIES = 5  # Attempts per S3 request before giving up, including the first one.
+MULTIPART_PART_SIZE = 8 * 1024 * 1024  # Bytes per multipart upload part. S3 requires at least 5MB except the last.
+MULTIPART_COPY_THRESHOLD = 64 * 1024 * 1024  # Objects at least this large are copied with parallel part copies.
+DELETE_BATCH_SIZE = 1000  # Max keys per delete_objects request.
+UPLOAD_SECONDS = metrics.histogram('s3_upload_seconds', 'Duration of S3 uploads.')
+UPLOAD_BYTES = metrics.histogram('s3_upload_bytes', 'Size of S3 uploads.', buckets=metrics.SIZE_BUCKETS)
+UPLOAD_ERRORS = metrics.counter('s3_upload_errors_total', 'S3 uploads that failed.')
+PREFETCH_OBJECTS = 20  # Objects iter_records downloads ahead of the one being decoded.
+FULL_LIST_INTERVAL = 0  # Default max seconds between full listings of a manifest prefix. 0 lists in full every time.
 
 
 class S3Connection(object):
@@ -19,25 +46,90 @@ class S3Connection(object):
     def from_yaml(cls, file_path, *yaml_scope):
         """Returns a new S3Connection instance from the yaml file.
         Required values: bucket_name
-        Optional values: aws_access_key_id, aws_secret_access_key
-            * If both are not specified, boto3 will attempt to resolve it.
+        Optional values: aws_access_key_id, aws_secret_access_key, endpoint_url, parallel_processes, max_retries,
+            manifest_path, manifest_full_list_interval
+            * If both keys are not specified, boto3 will attempt to resolve it.
+            * endpoint_url points the connection at an S3 compatible store such as MinIO.
+            * parallel_processes sizes the connection's worker thread pool and HTTP connection pool.
+            * manifest_path enables the local listing manifest, see ManifestCache.
+            * manifest_full_list_interval allows incremental listings of the manifest, see refresh_manifest.
         :param file_path: path to the yaml configuration file.
         :param yaml_scope: the section of the yaml file to look into.
         :return: a new S3Connection instance.
         """
         LOGGER.debug('Creating S3Connection from {}[{}]'.format(file_path, '->'.join(yaml_scope)))
-        info = yaml.safe_load(file(file_path))
+        info = utils.read_yaml(file_path)
         for scope in yaml_scope:
             info = info[scope]
+        return cls.from_config(info)
+
+    @classmethod
+    def from_config(cls, info):
+        """Returns a new S3Connection instance from an already parsed config section, e.g. settings.load().aws
+        :param info: dictionary with the values described in from_yaml.
+        :return: a new S3Connection instance.
+        """
         return S3Connection(info['bucket_name'], info.get('aws_access_key_id', None),
-                            info.get('aws_secret_access_key', None))
+                            info.get('aws_secret_access_key', None), info.get('endpoint_url', None),
+                            info.get('parallel_processes') or PARALLEL_PROCESSES,
+                            info.get('max_retries') or MAX_RETRIES, info.get('manifest_path', None),
+                            info.get('manifest_full_list_interval') or FULL_LIST_INTERVAL)
 
-    def __init__(self, bucket_name, aws_access_key_id=None, aws_secret_access_key=None):
+    def __init__(self, bucket_name, aws_access_key_id=None, aws_secret_access_key=None, endpoint_url=None,
+                 parallel_processes=PARALLEL_PROCESSES, max_retries=MAX_RETRIES, manifest_path=None,
+                 manifest_full_list_interval=FULL_LIST_INTERVAL):
+        self.parallel_processes = parallel_processes
+        # Shared by every client of this connection. Each client keeps enough pooled connections for all workers.
+        self.client_config = botocore.config.Config(max_pool_connections=parallel_processes + 1,
+                                                    retries={'max_attempts': max_retries, 'mode': 'standard'})
         self.session = boto3.Session(aws_access_key_id, aws_secret_access_key)
-        self.s3_client = self.session.client('s3')
-        self.s3_resource = self.session.resource('s3')
+        self.s3_client = self.session.client('s3', endpoint_url=endpoint_url, config=self.client_config)
+        self.s3_resource = self.session.resource('s3', endpoint_url=endpoint_url, config=self.client_config)
         self.s3_bucket = self.s3_resource.Bucket(name=bucket_name)
+        self.transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=MULTIPART_COPY_THRESHOLD,
+                                                                multipart_chunksize=MULTIPART_PART_SIZE)
         self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._thread_clients = threading.local()
+        # When set, listings are read from the local manifest after refreshing it, see refresh_manifest.
+        self.manifest_cache = ManifestCache(manifest_path) if manifest_path is not None else None
+        self.manifest_full_list_interval = manifest_full_list_interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shuts down the worker thread pool. It is recreated if the connection is used again."""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if self.manifest_cache is not None:
+            self.manifest_cache.close()
+
+    def _get_pool(self):
+        """Returns the worker thread pool of this connection, creating it on first use."""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(processes=self.parallel_processes)
+            return self._pool
+
+    def _get_thread_client(self):
+        """Returns the s3 client cached for the calling worker thread.
+        Clients are created once per thread and reused across calls, which keeps their connections alive.
+        """
+        client = getattr(self._thread_clients, 'client', None)
+        if client is None:
+            with self._pool_lock:  # boto3 sessions are not thread safe, clients are.
+                client = self.session.client('s3', endpoint_url=self.endpoint_url, config=self.client_config)
+            self._thread_clients.client = client
+        return client
 
     def get_aws_access_key_id(self):
         """Gets the access key that is currently being used."""
@@ -54,7 +146,88 @@ class S3Connection(object):
         """
         s3_key = '{}_{}'.format(uuid.uuid4(), os.path.basename(filename)) if s3_key is None else s3_key
         LOGGER.info('Uploading {} to s3://{}/{}'.format(filename, self.s3_bucket.name, s3_key))
-        self.s3_client.upload_file(filename, self.s3_bucket.name, s3_key)
+        start = time.time()
+        try:
+            self.s3_client.upload_file(filename, self.s3_bucket.name, s3_key)
+        except Exception:
+            UPLOAD_ERRORS.inc()
+            raise
+        UPLOAD_SECONDS.observe(time.time() - start)
+        UPLOAD_BYTES.observe(os.path.getsize(filename))
+
+    def upload_bytes(self, data, s3_key, part_size=MULTIPART_PART_SIZE, parallel_parts=PARALLEL_PROCESSES):
+        """Upload in-memory bytes to this bucket under the s3_key without writing a local file.
+        :param data: bytes to upload.
+        :param s3_key: key that the data will be uploaded to s3 as.
+        :param part_size: bytes per part. Data larger than this is uploaded with a multipart upload.
+        :param parallel_parts: max number of parts uploaded at the same time.
+        :return: the s3 key that was uploaded.
+        """
+        return self.upload_stream(io.BytesIO(data), s3_key, part_size, parallel_parts)
+
+    def upload_stream(self, stream, s3_key, part_size=MULTIPART_PART_SIZE, parallel_parts=PARALLEL_PROCESSES):
+        """Upload a file-like object or an iterator of byte chunks to this bucket under the s3_key.
+        Streams smaller than part_size are sent with a single put. Larger streams use a multipart upload whose parts
+        are uploaded in parallel while the stream is still being read; at most parallel_parts parts are held in memory.
+        :param stream: file-like object with read() or an iterable of byte strings.
+        :param s3_key: key that the stream will be uploaded to s3 as.
+        :param part_size: bytes per part. Must be at least 5MB for multipart uploads.
+        :param parallel_parts: max number of parts uploaded at the same time.
+        :return: the s3 key that was uploaded.
+        """
+        start = time.time()
+        try:
+            num_bytes = self._upload_stream(stream, s3_key, part_size, parallel_parts)
+        except Exception:
+            UPLOAD_ERRORS.inc()
+            raise
+        UPLOAD_SECONDS.observe(time.time() - start)
+        UPLOAD_BYTES.observe(num_bytes)
+        return s3_key
+
+    def _upload_stream(self, stream, s3_key, part_size, parallel_parts):
+        """Uploads a stream with a single put or a parallel multipart upload, see upload_stream.
+        :return: number of bytes uploaded.
+        """
+        parts = _iter_parts(stream, part_size)
+        first_part = next(parts, b'')
+        second_part = next(parts, None)
+        if second_part is None:
+            LOGGER.info('Uploading {} bytes to s3://{}/{}'.format(len(first_part), self.bucket_name, s3_key))
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=s3_key, Body=first_part)
+            return len(first_part)
+        LOGGER.info('Multipart uploading stream to s3://{}/{}'.format(self.bucket_name, s3_key))
+        num_bytes = 0
+        upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=s3_key)['UploadId']
+        pool = self._get_pool()
+        in_flight = threading.BoundedSemaphore(parallel_parts)
+        results = []
+        try:
+            for part_number, body in enumerate(_chain_parts(first_part, second_part, parts), 1):
+                num_bytes += len(body)
+                in_flight.acquire()
+                results.append(pool.apply_async(self._upload_part, (s3_key, upload_id, part_number, body, in_flight)))
+            completed = [result.get() for result in results]
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket_name, Key=s3_key, UploadId=upload_id,
+                                                     MultipartUpload={'Parts': completed})
+        except Exception:
+            LOGGER.exception('Aborting multipart upload of s3://{}/{}'.format(self.bucket_name, s3_key))
+            for result in results:
+                result.wait()  # Let the remaining parts finish before their upload is aborted.
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=s3_key, UploadId=upload_id)
+            raise
+        return num_bytes
+
+    def _upload_part(self, s3_key, upload_id, part_number, body, in_flight):
+        """Uploads one multipart part and releases its in_flight slot.
+        :return: the part descriptor expected by complete_multipart_upload.
+        """
+        try:
+            response = self._get_thread_client().upload_part(Bucket=self.bucket_name, Key=s3_key, UploadId=upload_id,
+                                                  PartNumber=part_number, Body=body)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            in_flight.release()
 
     def upload_files(self, filepath_list, s3_key_list=None):
         """Parallel upload a list of files to S3.
@@ -64,16 +237,9 @@ class S3Connection(object):
         """
         s3_key_list = ['{}_{}'.format(uuid.uuid4(), os.path.basename(f)) for f in
                        filepath_list] if s3_key_list is None else s3_key_list
-        access_key = self.get_aws_access_key_id()
-        secret_key = self.get_aws_secret_access_key()
-        upload_info = [(filepath_list[i], self.bucket_name, s3_key_list[i], access_key, secret_key) for i, _ in
-                       enumerate(filepath_list)]
+        upload_info = [(filepath_list[i], s3_key_list[i]) for i, _ in enumerate(filepath_list)]
         LOGGER.info('Uploading {} files to S3'.format(len(filepath_list)))
-        pool = ThreadPool(processes=PARALLEL_PROCESSES)
-        uploaded_files = pool.map(_upload_file, upload_info)
-        pool.close()
-        pool.join()
-        return uploaded_files
+        return self._get_pool().map(self._upload_file, upload_info)
 
     def download_key(self, s3_key, filename=None):
         """Download s3_key from this bucket to the specified file path.
@@ -93,16 +259,9 @@ class S3Connection(object):
         """
         file_list = [tempfile.NamedTemporaryFile(suffix=key.split('/')[-1], delete=False).name for key in
                      s3_key_list] if file_list is None else file_list
-        access_key = self.get_aws_access_key_id()
-        secret_key = self.get_aws_secret_access_key()
-        download_info = [(self.bucket_name, s3_key_list[i], file_list[i], access_key, secret_key) for i, _ in
-                         enumerate(s3_key_list)]
+        download_info = [(s3_key_list[i], file_list[i]) for i, _ in enumerate(s3_key_list)]
         LOGGER.info('Downloading {} keys from S3'.format(len(s3_key_list)))
-        pool = ThreadPool(processes=PARALLEL_PROCESSES)
-        downloaded_files = pool.map(_download_file, download_info)
-        pool.close()
-        pool.join()
-        return downloaded_files
+        return self._get_pool().map(self._download_file, download_info)
 
     def get_key_contents(self, s3_key, num_bytes=-1):
         """Get the contents of the s3_key.
@@ -112,6 +271,84 @@ class S3Connection(object):
         """
         return self.s3_bucket.Object(key=s3_key).get()['Body'].read(num_bytes)
 
+    def iter_key_chunks(self, s3_key):
+        """Streams the raw contents of s3_key without a local file.
+        :param s3_key: key to read.
+        :return: iterator of byte strings.
+        """
+        body = self.s3_bucket.Object(key=s3_key).get()['Body']
+        try:
+            for chunk in utils.iter_chunks(body):
+                yield chunk
+        finally:
+            body.close()
+
+    def iter_key_records(self, s3_key, dictionary=None):
+        """Streams the records of a batch object in any format the collectors upload, decompressing on the fly.
+        :param s3_key: key of the batch.
+        :param dictionary: zstd dictionary the batch was compressed with, if any.
+        :return: iterator of records.
+        """
+        return writers.iter_batch_records(self.iter_key_chunks(s3_key), s3_key, dictionary)
+
+    def iter_records(self, s3_prefix, since=None, until=None, file_regex=None, prefetch=PREFETCH_OBJECTS,
+                     processes=None, dictionary=None):
+        """Lazily yields the records of every batch under a prefix, in key order, without local files.
+        prefetch objects are downloaded ahead on the connection's thread pool while earlier ones are decoded, so
+        memory holds at most that many batches however much data the prefix has. Legacy json and jsonl batches,
+        gzipped or not, are supported; parquet files are skipped.
+        :param s3_prefix: prefix to read, e.g. company=APPLE/ or APPLE/
+        :param since: only yield records created at or after this naive UTC datetime. None for no lower bound.
+        :param until: only yield records created before this naive UTC datetime. None for no upper bound.
+            Partitioned objects are pruned by their partition hour before download. Flat layout objects are all
+            read, since a batch can be uploaded any time after its tweets were created, e.g. when a spool replays.
+        :param file_regex: only read objects whose filename matches this pattern.
+        :param prefetch: objects downloaded ahead of the one being decoded.
+        :param processes: decode batches on a pool of this many processes, for CPU bound scans. None to decode
+            in the calling thread. The processes are spawned, never forked: this process runs the connection's and
+            boto3's threads, and a child forked from a multithreaded process can deadlock on a lock one of them held.
+            Python 2 can only fork, so there the batches are decoded on the connection's thread pool instead.
+        :param dictionary: zstd dictionary the batches were compressed with, if any.
+        :return: generator of records.
+        """
+        decode_pool = _spawn_pool(processes) if processes else None
+        try:
+            objects = self._iter_objects_between(s3_prefix, since, until, file_regex)
+            fetched = utils.imap_ordered(self._get_pool(), self._get_object, (obj['Key'] for obj in objects),
+                                         prefetch)
+            if not processes:
+                batches = (writers.iter_batch_records([data], s3_key, dictionary) for s3_key, data in fetched)
+            else:
+                batches = utils.imap_ordered(decode_pool or self._get_pool(), _decode_batch,
+                                             ((s3_key, data, dictionary) for s3_key, data in fetched), processes * 2)
+            for records in batches:
+                for record in _records_between(records, since, until):
+                    yield record
+        finally:
+            if decode_pool is not None:
+                decode_pool.terminate()
+
+    def _iter_objects_between(self, s3_prefix, since, until, file_regex):
+        """Lists the batch objects under a prefix that may hold records created between since and until."""
+        start_after = _partition_start_after(s3_prefix, since)
+        for obj in self.iter_objects(s3_prefix, file_regex, start_after=start_after):
+            if obj['Key'].endswith('.parquet'):
+                continue
+            partition = partitioning.parse_partition(obj['Key'])
+            if partition is None:
+                yield obj
+                continue
+            start = datetime.datetime.strptime('{date} {hour}'.format(**partition), '%Y-%m-%d %H')
+            end = start + datetime.timedelta(hours=1)
+            if (since is None or end > since) and (until is None or start < until):
+                yield obj
+
+    def _get_object(self, s3_key):
+        """Helper method for parallel reads. Returns (s3_key, contents)."""
+        LOGGER.debug('[Parallel] Reading s3://{}/{}'.format(self.bucket_name, s3_key))
+        body = self._get_thread_client().get_object(Bucket=self.bucket_name, Key=s3_key)['Body']
+        return s3_key, body.read()
+
     # TODO: rename method to something else
     def download_keys(self, s3_prefix, local_dir=None, file_regex=None, ignored_s3_files=(), max_num_to_pull=None):
         """Downloads multiple S3 key values.
@@ -121,21 +358,21 @@ class S3Connection(object):
         :param file_regex: only download files such that the S3 filename matches this pattern.
         :param ignored_s3_files: iterable of s3 filenames to ignore.
         :param max_num_to_pull: maximum number of files to download for this call.
-        :return: list of local filepaths downloaded to.
+        :return: list of local filepaths downloaded to. Note: not necessarily in listing order.
+        """
+        return list(self.iter_download_keys(s3_prefix, local_dir, file_regex, ignored_s3_files, max_num_to_pull))
+
+    def iter_download_keys(self, s3_prefix, local_dir=None, file_regex=None, ignored_s3_files=(),
+                           max_num_to_pull=None):
+        """Generator version of download_keys that yields each local filepath as soon as its download completes.
+        Downloads run on the connection's thread pool while the prefix is still being listed.
+        Same parameters as download_keys.
         """
         local_dir = tempfile.mkdtemp() if local_dir is None else local_dir
-        s3_objects = self.s3_bucket.objects.filter(Prefix=s3_prefix)
-        downloaded_local_files = []
-        for obj in s3_objects:
-            if max_num_to_pull is not None and len(downloaded_local_files) >= max_num_to_pull:
-                break
-            filename = os.path.basename(obj.key)
-            does_match_regex = re.search(file_regex, filename) if file_regex is not None else True
-            if does_match_regex and filename not in ignored_s3_files:
-                local_file_path = os.path.join(local_dir, filename)
-                self.download_key(obj.key, local_file_path)
-                downloaded_local_files.append(local_file_path)
-        return downloaded_local_files
+        objects = self.iter_objects(s3_prefix, file_regex, ignored_s3_files, max_num_to_pull)
+        download_info = ((obj['Key'], os.path.join(local_dir, os.path.basename(obj['Key']))) for obj in objects)
+        for filepath in self._imap_unordered(self._download_file, download_info):
+            yield filepath
 
     def copy_keys(self, from_prefix, to_prefix, file_regex=None, ignored_s3_files=(), to_other_bucket=None,
                   max_num_to_pull=None):
@@ -146,62 +383,237 @@ class S3Connection(object):
         :param ignored_s3_files: iterable of s3 filenames to ignore.
         :param to_other_bucket: the target bucket to copy files to. If None, will copy to this same bucket.
         :param max_num_to_pull: maximum number of keys to copy for this call.
-        :return: list of the new s3 keys.
+        :return: list of the new s3 keys. Note: not necessarily in listing order.
         """
-        to_bucket = to_other_bucket if to_other_bucket is not None else self.bucket_name  # default to same bucket.
-        s3_objects = self.s3_bucket.objects.filter(Prefix=from_prefix)
-        new_keys = []
-        for obj in s3_objects:
-            if max_num_to_pull is not None and len(new_keys) >= max_num_to_pull:
-                break
-            filename = os.path.basename(obj.key)
-            does_match_regex = re.search(file_regex, filename) if file_regex is not None else True
-            if does_match_regex and filename not in ignored_s3_files:
-                copy_from = '{}/{}'.format(self.bucket_name, obj.key)  # copy_from requires bucket name.
-                to_key = to_prefix + filename
-                self.s3_resource.Object(to_bucket, to_key).copy_from(CopySource=copy_from)
-                new_keys.append(to_key)
+        new_keys = list(self.iter_copy_keys(from_prefix, to_prefix, file_regex, ignored_s3_files, to_other_bucket,
+                                            max_num_to_pull))
         if len(new_keys) == 0:
             LOGGER.info('No keys were copied.')
         return new_keys
 
+    def iter_copy_keys(self, from_prefix, to_prefix, file_regex=None, ignored_s3_files=(), to_other_bucket=None,
+                       max_num_to_pull=None):
+        """Generator version of copy_keys that yields each new s3 key as soon as its copy completes.
+        Copies are server side. Objects larger than MULTIPART_COPY_THRESHOLD are copied in parallel parts.
+        Same parameters as copy_keys.
+        """
+        to_bucket = to_other_bucket if to_other_bucket is not None else self.bucket_name  # default to same bucket.
+        objects = self.iter_objects(from_prefix, file_regex, ignored_s3_files, max_num_to_pull)
+        copy_info = ((obj['Key'], obj['Size'], to_bucket, to_prefix + os.path.basename(obj['Key'])) for obj in objects)
+        for to_key in self._imap_unordered(self._copy_key, copy_info):
+            yield to_key
+
     def delete_key(self, s3_key):
         """Deletes a specific s3 key from this bucket.
         :param s3_key: s3 key string to delete.
         :return: the s3 key that was deleted.
         """
         self.s3_resource.Object(self.s3_bucket.name, s3_key).delete()
+        if self.manifest_cache is not None:
+            self.manifest_cache.remove_objects(self.bucket_name, [s3_key])
         return s3_key
 
     def delete_keys(self, s3_prefix):
         """Deletes all s3 keys matching a prefix.
+        Keys are deleted in batches of up to 1000 per request while the prefix is still being listed. The prefix is
+        listed on S3 itself, never from the manifest cache, so keys the manifest has not seen are deleted too.
         :param s3_prefix: s3 key prefix to match for deletion. Warning: if '', will delete everything in the bucket.
         :return: a list of s3 keys that were deleted.
         """
-        s3_objects = self.s3_bucket.objects.filter(Prefix=s3_prefix)
-        deleted_keys = []
-        for obj in s3_objects:
-            deleted_keys.append(obj.key)
-        s3_objects.delete()
+        deleted_keys = self.delete_key_list(obj['Key'] for obj in self.iter_objects(s3_prefix, use_manifest=False))
         if len(deleted_keys) == 0:
             LOGGER.info('No keys were deleted.')
         return deleted_keys
 
-    def list_keys(self, s3_prefix, s3_suffix='', ignored_s3_files=()):
+    def delete_key_list(self, s3_key_list):
+        """Deletes specific s3 keys from this bucket, up to 1000 per request and in parallel.
+        :param s3_key_list: iterable of s3 keys to delete.
+        :return: a list of s3 keys that were deleted.
+        """
+        deleted_keys = []
+        for deleted in self._imap_unordered(self._delete_batch, _iter_partitions(s3_key_list, DELETE_BATCH_SIZE)):
+            deleted_keys.extend(deleted)
+            if self.manifest_cache is not None:
+                self.manifest_cache.remove_objects(self.bucket_name, deleted)
+        return deleted_keys
+
+    def list_keys(self, s3_prefix, s3_suffix='', ignored_s3_files=(), use_manifest=True):
         """List available s3 keys in this bucket.
         :param s3_prefix: s3 key prefix to filter on.
         :param s3_suffix: s3 keys must end with this to be matched.
         :param ignored_s3_files: iterable of s3 filenames to not include in the result.
+        :param use_manifest: False to list S3 directly even with a manifest cache.
         :return: list of s3 keys matching the criteria.
         """
-        s3_keys = []
-        s3_objects = self.s3_bucket.objects.filter(Prefix=s3_prefix)
-        for obj in s3_objects:
-            key = obj.key
-            filename = os.path.basename(key)
-            if filename not in ignored_s3_files and key.endswith(s3_suffix):
-                s3_keys.append(key)
-        return s3_keys
+        return [obj['Key'] for obj in self.iter_objects(s3_prefix, ignored_s3_files=ignored_s3_files,
+                                                        use_manifest=use_manifest)
+                if obj['Key'].endswith(s3_suffix)]
+
+    def iter_objects(self, s3_prefix, file_regex=None, ignored_s3_files=(), max_num_to_pull=None, start_after=None,
+                     use_manifest=True):
+        """Lazily lists the objects under a prefix, one page at a time, filtering while listing.
+        With a manifest cache, the manifest is refreshed and the objects are read from it, see refresh_manifest.
+        :param s3_prefix: s3 key prefix to list.
+        :param file_regex: only yield objects whose filename matches this pattern.
+        :param ignored_s3_files: iterable of s3 filenames to skip.
+        :param max_num_to_pull: maximum number of objects to yield.
+        :param start_after: only list keys that sort after this key. Bypasses the manifest cache.
+        :param use_manifest: False to list S3 directly even with a manifest cache, e.g. before deleting what is listed.
+        :return: generator of object dicts with Key, Size, ETag and LastModified.
+        """
+        if self.manifest_cache is not None and use_manifest and start_after is None:
+            self.refresh_manifest(s3_prefix)
+            objects = self.manifest_cache.objects(self.bucket_name, s3_prefix)
+        else:
+            objects = self._list_objects(s3_prefix, start_after)
+        for obj in _filter_objects(objects, file_regex, ignored_s3_files, max_num_to_pull):
+            yield obj
+
+    def refresh_manifest(self, s3_prefix, full_refresh=False):
+        """Updates the manifest cache with the objects under a prefix.
+        Keys are not always written in key order: random key suffixes, late hour partitions, compaction and spool
+        replays all add keys below the last one listed, which a listing starting after that key misses. So the prefix
+        is listed in full, forgetting deleted keys, once its last full listing is older than
+        manifest_full_list_interval, and only keys past the last one seen are fetched in between. The default
+        interval of 0 always lists in full; only raise it for prefixes that are written in key order.
+        :param s3_prefix: s3 key prefix to list.
+        :param full_refresh: list the whole prefix whatever the interval.
+        :return: number of new or changed objects found.
+        """
+        if self.manifest_cache is None:
+            raise DataPipelineException('S3Connection has no manifest cache')
+        listed_at = self.manifest_cache.listed_at(self.bucket_name, s3_prefix)
+        if full_refresh or listed_at is None or time.time() - listed_at >= self.manifest_full_list_interval:
+            num_new = self.manifest_cache.replace_objects(self.bucket_name, s3_prefix, self._list_objects(s3_prefix))
+        else:
+            start_after = self.manifest_cache.last_key(self.bucket_name, s3_prefix)
+            num_new = 0
+            for page in self._list_pages(s3_prefix, start_after):
+                num_new += self.manifest_cache.add_objects(self.bucket_name, s3_prefix, page)
+        LOGGER.debug('Found {} new keys under s3://{}/{}'.format(num_new, self.bucket_name, s3_prefix))
+        return num_new
+
+    def sync_prefix(self, s3_prefix, local_dir, file_regex=None, max_local_bytes=None, full_refresh=False):
+        """Mirrors the objects under a prefix into local_dir, downloading only what is new or changed.
+        Requires the manifest cache. A local file is reused when the ETag it was downloaded with still matches.
+        Important: filename refers to the right-most portion of the key. test/file.csv --> file.csv
+        :param s3_prefix: prefix of files to sync.
+        :param local_dir: local directory to sync the S3 files to.
+        :param file_regex: only sync files such that the S3 filename matches this pattern.
+        :param max_local_bytes: after syncing, evict least recently used cached files above this total size. Files
+            of this prefix are not evicted, even if they alone exceed it.
+        :param full_refresh: list the whole prefix, see refresh_manifest.
+        :return: list of local filepaths for the prefix, in key order.
+        """
+        if self.manifest_cache is None:
+            raise DataPipelineException('sync_prefix requires an S3Connection with a manifest_path')
+        if not os.path.exists(local_dir):
+            os.makedirs(local_dir)
+        self.refresh_manifest(s3_prefix, full_refresh)
+        local_files = []
+        to_download = {}  # local filepath -> object to download there.
+        for obj in _filter_objects(self.manifest_cache.objects(self.bucket_name, s3_prefix), file_regex):
+            filepath = os.path.join(local_dir, os.path.basename(obj['Key']))
+            local_files.append(filepath)
+            if not self.manifest_cache.is_cached(filepath, obj['ETag']):
+                to_download[filepath] = obj
+        LOGGER.info('Syncing {} of {} keys under {}'.format(len(to_download), len(local_files), s3_prefix))
+        download_info = ((obj['Key'], filepath) for filepath, obj in to_download.items())
+        for filepath in self._imap_unordered(self._download_file, download_info):
+            obj = to_download[filepath]
+            self.manifest_cache.add_local_file(filepath, self.bucket_name, obj['Key'], obj['ETag'], obj['Size'])
+        if max_local_bytes is not None:
+            self.manifest_cache.evict(max_local_bytes, keep=local_files)
+        return local_files
+
+    def _list_objects(self, s3_prefix, start_after=None):
+        """Yields the raw object dicts under a prefix, one listing page at a time."""
+        for page in self._list_pages(s3_prefix, start_after):
+            for obj in page:
+                yield obj
+
+    def _list_pages(self, s3_prefix, start_after=None):
+        """Yields the object dicts of each list_objects_v2 page under a prefix."""
+        list_args = {'Bucket': self.bucket_name, 'Prefix': s3_prefix}
+        if start_after:
+            list_args['StartAfter'] = start_after
+        for page in self.s3_client.get_paginator('list_objects_v2').paginate(**list_args):
+            yield page.get('Contents', [])
+
+    def _imap_unordered(self, func, items, max_in_flight=None):
+        """Runs func over items on the connection's thread pool and yields results in completion order.
+        Items are pulled lazily, so at most max_in_flight calls are queued or running at a time.
+        :param func: function of one argument.
+        :param items: iterable of arguments, e.g. a generator over a paginated listing.
+        :param max_in_flight: max calls submitted but not yet yielded. None for twice the pool size.
+        """
+        max_in_flight = self.parallel_processes * 2 if max_in_flight is None else max_in_flight
+        pool = self._get_pool()
+        completed = queue.Queue()
+
+        def run(item):
+            try:
+                return True, func(item)
+            except Exception as e:
+                LOGGER.exception('Parallel S3 call failed for {}'.format(item))
+                return False, e
+
+        num_pending = 0
+        for item in items:
+            if num_pending >= max_in_flight:
+                yield _unwrap_result(completed.get())
+                num_pending -= 1
+            pool.apply_async(run, (item,), callback=completed.put)
+            num_pending += 1
+        while num_pending:
+            yield _unwrap_result(completed.get())
+            num_pending -= 1
+
+    def _upload_file(self, upload_tuple):
+        """Helper method for parallel S3 upload.
+        :param upload_tuple: tuple containing: (filename, s3_key)
+        """
+        filename, s3_key = upload_tuple
+        LOGGER.info('[Parallel] Uploading {} to s3://{}/{}'.format(filename, self.bucket_name, s3_key))
+        self._get_thread_client().upload_file(filename, self.bucket_name, s3_key)
+        return s3_key
+
+    def _download_file(self, download_tuple):
+        """Helper method for parallel S3 download.
+        :param download_tuple: tuple containing: (s3_key, filepath)
+        """
+        s3_key, filepath = download_tuple
+        LOGGER.info('[Parallel] Downloading s3://{}/{} to {}'.format(self.bucket_name, s3_key, filepath))
+        self._get_thread_client().download_file(self.bucket_name, s3_key, filepath)
+        return filepath
+
+    def _copy_key(self, copy_tuple):
+        """Helper method for parallel server side copy.
+        :param copy_tuple: tuple containing: (s3_key, size, to_bucket, to_key)
+        """
+        s3_key, size, to_bucket, to_key = copy_tuple
+        copy_source = {'Bucket': self.bucket_name, 'Key': s3_key}
+        client = self._get_thread_client()
+        if size < MULTIPART_COPY_THRESHOLD:
+            client.copy_object(CopySource=copy_source, Bucket=to_bucket, Key=to_key)
+        else:
+            LOGGER.info('[Parallel] Multipart copying s3://{}/{} to s3://{}/{}'.format(
+                self.bucket_name, s3_key, to_bucket, to_key))
+            client.copy(copy_source, to_bucket, to_key, Config=self.transfer_config)
+        return to_key
+
+    def _delete_batch(self, s3_keys):
+        """Helper method for parallel deletes. Deletes up to 1000 keys in one request.
+        :param s3_keys: list of s3 keys to delete.
+        :return: list of the keys that were deleted.
+        """
+        response = self._get_thread_client().delete_objects(
+            Bucket=self.bucket_name, Delete={'Objects': [{'Key': key} for key in s3_keys], 'Quiet': True})
+        failed = set()
+        for error in response.get('Errors', []):
+            LOGGER.warning('Could not delete {}: {}'.format(error['Key'], error.get('Message')))
+            failed.add(error['Key'])
+        return [key for key in s3_keys if key not in failed]
 
     def s3_string(self, key):
         """Gets the full S3 path string of the key in this bucket.
@@ -211,25 +623,104 @@ class S3Connection(object):
         return 's3://{}/{}'.format(self.bucket_name, key)
 
 
-def _upload_file(upload_tuple):
-    """Helper method for parallel S3 upload.
-    :param upload_tuple: tuple containing: (filename, bucket, s3_key, aws_access_key_id, aws_secret_access_key)
+def _unwrap_result(result):
+    """Returns the value of a (success, value) result from _imap_unordered, re-raising failures."""
+    success, value = result
+    if not success:
+        raise value
+    return value
+
+
+def _filter_objects(objects, file_regex=None, ignored_s3_files=(), max_num_to_pull=None):
+    """Yields the listed objects whose filename matches file_regex and is not ignored, up to max_num_to_pull."""
+    pattern = re.compile(file_regex) if file_regex is not None else None
+    ignored_s3_files = set(ignored_s3_files)
+    num_yielded = 0
+    for obj in objects:
+        if max_num_to_pull is not None and num_yielded >= max_num_to_pull:
+            return
+        filename = os.path.basename(obj['Key'])
+        if (pattern is None or pattern.search(filename)) and filename not in ignored_s3_files:
+            num_yielded += 1
+            yield obj
+
+
+def _iter_partitions(iterable, partition_size):
+    """Lazily splits an iterable into lists of up to partition_size items."""
+    partition = []
+    for item in iterable:
+        partition.append(item)
+        if len(partition) >= partition_size:
+            yield partition
+            partition = []
+    if partition:
+        yield partition
+
+
+def _iter_parts(stream, part_size):
+    """Re-chunks a file-like object or an iterable of byte strings into parts of at least part_size bytes.
+    The last part may be smaller.
+    """
+    if hasattr(stream, 'read'):
+        read = stream.read
+        stream = iter(lambda: read(part_size), b'')  # read() may return short chunks, so they are buffered too.
+    buffered = []
+    buffered_size = 0
+    for chunk in stream:
+        buffered.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size >= part_size:
+            yield b''.join(buffered)
+            buffered = []
+            buffered_size = 0
+    if buffered_size:
+        yield b''.join(buffered)
+
+
+def _chain_parts(first_part, second_part, remaining_parts):
+    """Yields the parts that were already read to check the stream size, then the rest."""
+    yield first_part
+    yield second_part
+    for part in remaining_parts:
+        yield part
+
+
+def _spawn_pool(processes):
+    """Starts a pool of spawned processes.
+    :return: the pool, or None on Python 2, which has no spawn start method.
     """
-    filename, bucket, s3_key, aws_access_key_id, aws_secret_access_key = upload_tuple
-    LOGGER.info('[Parallel] Uploading {} to s3://{}/{}'.format(filename, bucket, s3_key))
-    # Create new boto session for each thread.
-    session = boto3.session.Session(aws_access_key_id, aws_secret_access_key)
-    session.client('s3').upload_file(filename, bucket, s3_key)
-    return s3_key
+    if not hasattr(multiprocessing, 'get_context'):
+        LOGGER.warning('Cannot spawn decode processes on Python 2, decoding on the connection thread pool')
+        return None
+    return multiprocessing.get_context('spawn').Pool(processes)
 
 
-def _download_file(download_tuple):
-    """Helper method for parallel S3 download.
-    :param download_tuple: tuple containing: bucket, s3_key, filepath, aws_access_key_id, aws_secret_access_key
+def _decode_batch(batch_tuple):
+    """Helper function for decoding on a process or thread pool.
+    :param batch_tuple: tuple containing: (s3_key, contents, zstd dictionary or None)
+    :return: list of the batch's records.
     """
-    bucket, s3_key, filepath, aws_access_key_id, aws_secret_access_key = download_tuple
-    LOGGER.info('[Parallel] Downloading s3://{}/{} to {}'.format(bucket, s3_key, filepath))
-    # Create new boto session for each thread.
-    session = boto3.session.Session(aws_access_key_id, aws_secret_access_key)
-    session.client('s3').download_file(bucket, s3_key, filepath)
-    return filepath
+    s3_key, data, dictionary = batch_tuple
+    return list(writers.iter_batch_records([data], s3_key, dictionary))
+
+
+def _records_between(records, since, until):
+    """Yields the records created between since and until. Records without a parsable Created at are kept."""
+    if since is None and until is None:
+        return records
+    return (record for record in records if _created_between(record, since, until))
+
+
+def _created_between(record, since, until):
+    created = writers.parse_created_at(record.get('Created at'))
+    return created is None or ((since is None or created >= since) and (until is None or created < until))
+
+
+def _partition_start_after(s3_prefix, since):
+    """Returns the StartAfter key skipping the hour partitions of a company prefix before since, or None."""
+    match = re.match(r'^company=[^/]+/', s3_prefix)
+    if since is None or match is None:
+        return None
+    start_after = '{}date={:%Y-%m-%d}/hour={:%H}'.format(match.group(0), since, since)
+    return start_after if start_after > s3_prefix else None
+
@@ -0,0 +1,142 @@
+"""Typed access to config/cred.yaml, parsed once per process.
+load() caches the parsed file and parses it again only after its modification time changes, so collectors call it
+whenever they need a setting and pick up edits without a restart: round robin re-reads the tracked companies at
+every rotation and the supervisor restarts its workers when the companies or twitter accounts change.
+multi_company in multiplex mode without the supervisor keeps streaming the companies it started with until it is
+restarted, since changing them means reconnecting the stream.
+"""
+import collections
+import logging
+import os
+import threading
+
+from utils import DataPipelineException, read_yaml, rel_path
+
+LOGGER = logging.getLogger(__name__)
+CONFIG_PATH = rel_path('config/cred.yaml')
+MODE_ROUND_ROBIN = 'round_robin'  # Streams one company at a time, rotating through them.
+MODE_MULTIPLEX = 'multiplex'  # Streams every company on one connection.
+ROTATION_SECONDS = 15 * 60  # Default seconds each company is streamed in round robin mode.
+RELOAD_INTERVAL = 30  # Default seconds between checks for config changes by the supervisor.
+STREAM_TIMEOUT = 300.0  # Default seconds without data before the stream reconnects, same as tweepy's.
+Company = collections.namedtuple('Company', ('name', 'stock'))
+_STRING_TYPES = (str, type(u''))
+_configs = {}  # path -> last loaded Config
+_lock = threading.Lock()
+
+
+class Config(object):
+    """Parsed config file. Sections consumed whole by the from_config factories are returned as dictionaries."""
+
+    def __init__(self, data, path=None, mtime=None):
+        """
+        :param data: dictionary parsed from the yaml file.
+        :param path: file the config was parsed from.
+        :param mtime: modification time of the file when it was parsed.
+        """
+        self.data = data or {}
+        self.path = path
+        self.mtime = mtime
+
+    def section(self, name):
+        """Returns a section as a dictionary, empty if it is missing or blank."""
+        return self.data.get(name) or {}
+
+    def required(self, name):
+        """Returns a section that must be configured.
+        :raises DataPipelineException: if the section is missing or blank.
+        """
+        section = self.data.get(name)
+        if not section:
+            raise DataPipelineException('Config {} has no {} section'.format(self.path, name))
+        return section
+
+    @property
+    def aws(self):
+        """S3 settings for S3Connection.from_config."""
+        return self.required('aws')
+
+    @property
+    def twitter(self):
+        """Twitter credentials: consumer_key, consumer_secret, access_token and access_token_secret."""
+        return self.required('twitter')
+
+    @property
+    def twitter_accounts(self):
+        """Every twitter credential set: twitter_accounts, or the single twitter section if none of them is filled in.
+        Accounts without a consumer_key, such as blank copies of the sample, are skipped.
+        """
+        accounts = [account for account in self.data.get('twitter_accounts') or []
+                    if account and account.get('consumer_key')]
+        return accounts or [self.twitter]
+
+    @property
+    def company(self):
+        """The Company streamed by tweetstream."""
+        info = self.required('company')
+        return Company(info['company_name'], info['stock'])
+
+    @property
+    def companies(self):
+        """The Companies streamed by multi_company, upper cased, in config order."""
+        info = self.required('many_company')
+        names = _text(info['company_name']).split(',')
+        stocks = _text(info['stock']).split(',')
+        if len(names) != len(stocks):
+            raise DataPipelineException('{} companies but {} stocks in many_company'.format(len(names), len(stocks)))
+        return [Company(name.strip().upper(), stock.strip().upper())
+                for name, stock in zip(names, stocks) if name.strip()]
+
+    @property
+    def mode(self):
+        """How multi_company streams its companies, MODE_ROUND_ROBIN or MODE_MULTIPLEX."""
+        mode = self.section('many_company').get('mode') or MODE_ROUND_ROBIN
+        if mode not in (MODE_ROUND_ROBIN, MODE_MULTIPLEX):
+            raise DataPipelineException('Unknown many_company mode {}'.format(mode))
+        return mode
+
+    @property
+    def rotation_seconds(self):
+        """Seconds each company is streamed in round robin mode."""
+        return float(self.section('many_company').get('rotation_seconds') or ROTATION_SECONDS)
+
+    @property
+    def reload_interval(self):
+        """Seconds between checks for config changes by the supervisor."""
+        return float(self.section('supervisor').get('reload_interval') or RELOAD_INTERVAL)
+
+    @property
+    def stream_timeout(self):
+        """Seconds without data before the stream reconnects."""
+        return float(self.section('stream').get('timeout') or STREAM_TIMEOUT)
+
+    @property
+    def languages(self):
+        """Languages the stream is filtered to, or None for every language."""
+        languages = self.section('stream').get('languages')
+        if not languages:
+            return None
+        if isinstance(languages, list):
+            return languages
+        return [language.strip() for language in _text(languages).split(',')]
+
+
+def _text(value):
+    """Returns yaml strings as they are, so non-ascii names survive on Python 2, and other scalars as str."""
+    return value if isinstance(value, _STRING_TYPES) else str(value)
+
+
+def load(path=CONFIG_PATH):
+    """Returns the config parsed from path. The file is only parsed again after it changed, otherwise this costs
+    one stat() call, so callers need not keep the result around.
+    :param path: yaml config file.
+    :return: a Config.
+    """
+    mtime = os.path.getmtime(path)
+    with _lock:
+        config = _configs.get(path)
+        if config is None or config.mtime != mtime:
+            if config is not None:
+                LOGGER.info('Reloading changed config {}'.format(path))
+            config = _configs[path] = Config(read_yaml(path), path, mtime)
+        return config
@@ -0,0 +1,330 @@
+"""Durable local write-ahead spool for batches on their way to S3.
+Batches are fsynced to the spool before upload and only removed once S3 has them, so S3 throttling or outages
+neither stall the stream nor lose batches. A SpoolUploader drains the spool in the background, oldest first,
+retrying with exponential backoff, and replays whatever a previous run left behind when it starts.
+Batches that cannot be uploaded, because S3 rejects the batch itself or it keeps failing, are moved to the failed/
+directory of the slot so they do not hold up the batches behind them.
+"""
+import collections
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+
+import botocore.exceptions
+
+import metrics
+
+try:
+    from urllib import quote, unquote
+except ImportError:  # Python 3
+    from urllib.parse import quote, unquote
+
+LOGGER = logging.getLogger(__name__)
+ENTRY_SUFFIX = '.batch'  # Complete, fsynced batches waiting for upload.
+TMP_SUFFIX = '.tmp'  # Batches still being written. Left over ones are from a crash and never reached the spool.
+LOCK_NAME = 'lock'
+FAILED_DIR = 'failed'  # Quarantined batches, kept for inspection and never retried.
+COPY_CHUNK_SIZE = 1024 * 1024  # Bytes copied at a time when spooling a stream.
+MAX_BACKOFF = 300  # Max seconds between upload attempts while S3 keeps failing.
+MAX_ATTEMPTS = 20  # Upload attempts of a batch before it is quarantined. About an hour at the default backoff.
+NON_RETRYABLE_CODES = ('InvalidArgument', 'InvalidRequest', 'KeyTooLongError', 'EntityTooLarge',
+                       'InvalidObjectName')  # S3 errors caused by the batch itself, which a retry cannot fix.
+DRAIN_TIMEOUT = 60  # Seconds stop() waits for the spool to drain. What is left is uploaded on the next start.
+PENDING = metrics.gauge('spool_pending_batches', 'Batches in the spool waiting for upload.')
+EVICTED = metrics.counter('spool_evicted_batches_total', 'Spooled batches evicted to stay under the disk quota.')
+QUARANTINED = metrics.counter('spool_quarantined_batches_total', 'Spooled batches moved to failed/ after failing.')
+
+
+class Spool(object):
+    """Append-only directory of batches waiting for upload. Each batch is one file named after its S3 key.
+    Every process locks its own slot subdirectory of spool_dir, so supervised collectors can share a spool_dir and
+    a restarted collector adopts the batches of a slot whose owner died.
+    """
+
+    def __init__(self, spool_dir, max_bytes=None):
+        """
+        :param spool_dir: directory of the spool. Created if missing.
+        :param max_bytes: disk quota of this process's slot. The oldest batches are evicted to stay under it.
+            None for no quota.
+        """
+        self.max_bytes = max_bytes
+        self.path, self._lock_file = _lock_slot(spool_dir)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._stats = {'spooled': 0, 'evicted': 0, 'evicted_bytes': 0, 'quarantined': 0}
+        for name in os.listdir(self.path):
+            if name.endswith(TMP_SUFFIX):
+                os.remove(os.path.join(self.path, name))
+        LOGGER.info('Spooling to {} with {} batches to replay'.format(self.path, len(self.entries())))
+
+    def append(self, data, s3_key):
+        """Durably writes a batch to the spool. Returns once the batch is on disk.
+        :param data: bytes or binary file-like object with the batch content.
+        :param s3_key: key the batch is uploaded to.
+        :return: path of the spooled batch.
+        """
+        with self._lock:
+            self._seq += 1
+            # Names sort oldest first: microsecond timestamp, then a sequence number for batches in the same tick.
+            name = '{:016d}-{:06d}-{}{}'.format(int(time.time() * 1e6), self._seq % 1000000,
+                                                quote(s3_key, safe=''), ENTRY_SUFFIX)
+        path = os.path.join(self.path, name)
+        with open(path + TMP_SUFFIX, 'wb') as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f, COPY_CHUNK_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+        size = os.path.getsize(path + TMP_SUFFIX)
+        with self._lock:
+            self._evict(size)
+            os.rename(path + TMP_SUFFIX, path)
+            _fsync_dir(self.path)
+            self._stats['spooled'] += 1
+        return path
+
+    def entries(self):
+        """Returns the spooled batches oldest first.
+        :return: list of (path, s3 key) tuples.
+        """
+        names = sorted(name for name in os.listdir(self.path) if name.endswith(ENTRY_SUFFIX))
+        return [(os.path.join(self.path, name), unquote(name.split('-', 2)[2][:-len(ENTRY_SUFFIX)]))
+                for name in names]
+
+    def remove(self, path):
+        """Removes an uploaded batch. Batches that were already evicted are ignored."""
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def quarantine(self, path):
+        """Moves a batch that cannot be uploaded to the failed/ directory of the slot, out of the upload queue.
+        Quarantined batches do not count against the quota.
+        :return: the new path of the batch.
+        """
+        failed_dir = os.path.join(self.path, FAILED_DIR)
+        if not os.path.isdir(failed_dir):
+            os.makedirs(failed_dir)
+        failed_path = os.path.join(failed_dir, os.path.basename(path))
+        os.rename(path, failed_path)
+        _fsync_dir(self.path)
+        with self._lock:
+            self._stats['quarantined'] += 1
+        QUARANTINED.inc()
+        return failed_path
+
+    def num_bytes(self):
+        """Returns the size of the spooled batches."""
+        return sum(_file_size(path) for path, _ in self.entries())
+
+    def stats(self):
+        """Returns the spooled, evicted and quarantined counters and the current backlog."""
+        with self._lock:
+            snapshot = dict(self._stats)
+        entries = self.entries()
+        snapshot['pending'] = len(entries)
+        snapshot['pending_bytes'] = sum(_file_size(path) for path, _ in entries)
+        return snapshot
+
+    def close(self):
+        """Releases the slot. Spooled batches stay on disk for the next run."""
+        self._lock_file.close()
+
+    def _evict(self, incoming_bytes):
+        """Removes the oldest batches until incoming_bytes more fit in the quota. Called with the lock held."""
+        if self.max_bytes is None:
+            return
+        entries = [(path, _file_size(path)) for path, _ in self.entries()]
+        total = sum(size for _, size in entries)
+        for path, size in entries:
+            if total + incoming_bytes <= self.max_bytes:
+                break
+            LOGGER.warning('Spool is over its {} bytes quota, evicting {}'.format(self.max_bytes, path))
+            self.remove(path)
+            total -= size
+            self._stats['evicted'] += 1
+            self._stats['evicted_bytes'] += size
+            EVICTED.inc()
+
+
+class SpoolUploader(object):
+    """Background thread uploading a Spool to S3.
+    Exposes upload_bytes and upload_stream like S3Connection, so batch sinks can write through it: both return as
+    soon as the batch is spooled.
+    """
+
+    def __init__(self, conn, spool, max_backoff=MAX_BACKOFF, max_attempts=MAX_ATTEMPTS):
+        """
+        :param conn: S3Connection to upload to.
+        :param spool: Spool to drain. Batches already in it are uploaded first.
+        :param max_backoff: max seconds between upload attempts while uploads fail.
+        :param max_attempts: upload attempts of a batch before it is quarantined. 0 to retry forever.
+        """
+        self.conn = conn
+        self.spool = spool
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._abort = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {'uploaded': 0, 'uploaded_bytes': 0, 'upload_errors': 0}
+        PENDING.set_function(lambda: len(spool.entries()))
+        self._thread = threading.Thread(target=self._run, name='spool-uploader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def upload_bytes(self, data, s3_key):
+        """Spools data for upload under s3_key.
+        :return: the s3 key.
+        """
+        self.spool.append(data, s3_key)
+        self._wake.set()
+        return s3_key
+
+    def upload_stream(self, stream, s3_key):
+        """Spools a binary file-like object for upload under s3_key.
+        :return: the s3 key.
+        """
+        return self.upload_bytes(stream, s3_key)
+
+    def stop(self, timeout=DRAIN_TIMEOUT):
+        """Waits for the spool to drain, then stops the uploader.
+        :param timeout: max seconds to wait. Batches still spooled by then are uploaded on the next start.
+        """
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self._abort.set()
+            LOGGER.warning('Stopped with {} batches left in {}'.format(len(self.spool.entries()), self.spool.path))
+        else:
+            self.spool.close()
+
+    def stats(self):
+        """Returns the upload counters merged with the spool's."""
+        with self._stats_lock:
+            snapshot = dict(self._stats)
+        snapshot.update(self.spool.stats())
+        return snapshot
+
+    def _add_stat(self, name, amount):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def _run(self):
+        """Uploads the oldest batch until the spool is empty, then waits for new ones.
+        The spool is listed once and that snapshot is uploaded before listing again, so draining a backlog of n
+        batches lists the directory once rather than n times.
+        """
+        failures = 0
+        entries = collections.deque()
+        while not self._abort.is_set():
+            if not entries:
+                self._wake.clear()
+                entries.extend(self.spool.entries())
+            if not entries:
+                if self._stopping.is_set():
+                    return
+                self._wake.wait(1)
+                continue
+            path, s3_key = entries[0]
+            try:
+                f = open(path, 'rb')
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    LOGGER.exception('Cannot read spooled {}'.format(s3_key))
+                    self.spool.quarantine(path)
+                entries.popleft()
+                continue  # Evicted since it was listed.
+            try:
+                with f:
+                    self.conn.upload_stream(f, s3_key)
+            except Exception as e:
+                failures += 1
+                self._add_stat('upload_errors', 1)
+                if _is_non_retryable(e) or (self.max_attempts and failures >= self.max_attempts):
+                    LOGGER.exception('Giving up on spooled {} after {} attempts, moving it to {}'.format(
+                        s3_key, failures, FAILED_DIR))
+                    failures = 0
+                    self.spool.quarantine(path)
+                    entries.popleft()
+                    continue
+                delay = min(self.max_backoff, 2 ** min(failures - 1, 16))
+                LOGGER.exception('Failed to upload spooled {}, retrying in {}s'.format(s3_key, delay))
+                self._abort.wait(delay)
+                continue
+            failures = 0
+            with self._stats_lock:
+                self._stats['uploaded'] += 1
+                self._stats['uploaded_bytes'] += _file_size(path)
+            self.spool.remove(path)
+            entries.popleft()
+
+
+def from_config(conn, info):
+    """Creates a SpoolUploader from the spool settings of the 'pipeline' section of the yaml config.
+    :param conn: S3Connection to upload to.
+    :param info: dictionary with spool_dir and optionally spool_max_bytes, spool_max_backoff and
+        spool_max_attempts.
+    :return: a started SpoolUploader, or None if spool_dir is not set.
+    """
+    if not info.get('spool_dir'):
+        return None
+    max_attempts = info.get('spool_max_attempts')
+    return SpoolUploader(conn, Spool(info['spool_dir'], info.get('spool_max_bytes')),
+                         info.get('spool_max_backoff') or MAX_BACKOFF,
+                         MAX_ATTEMPTS if max_attempts is None else max_attempts)
+
+
+def _is_non_retryable(error):
+    """Returns True if an upload failed because of the batch itself rather than S3 or the network."""
+    return isinstance(error, botocore.exceptions.ClientError) and \
+        error.response.get('Error', {}).get('Code') in NON_RETRYABLE_CODES
+
+
+def _lock_slot(spool_dir):
+    """Locks the first free slot subdirectory of spool_dir.
+    :return: (slot path, open lock file). The lock is held until the file is closed or the process exits.
+    """
+    slot = 0
+    while True:
+        path = os.path.join(spool_dir, 'slot{}'.format(slot))
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        lock_file = open(os.path.join(path, LOCK_NAME), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return path, lock_file
+        except IOError as e:
+            lock_file.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        slot += 1
+
+
+def _fsync_dir(path):
+    """Flushes a directory entry change such as a rename to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _file_size(path):
+    """Returns the size of a file, or 0 if it was removed in the meantime."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
@@ -0,0 +1,211 @@
+"""Runs the multiplexed collector as sharded worker processes and restarts them when they stop.
+Companies from the many_company config are split into shards. Each shard streams with its own twitter credential set
+from twitter_accounts (or the single twitter section) in a separate process, so parsing and uploads scale across
+cores and API keys. The supervisor watches the config file and restarts the workers with new shards when the
+companies or twitter accounts change.
+"""
+import logging
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import metrics
+import multi_company
+import s3_utils
+import settings
+from utils import DataPipelineException
+
+LOGGER = logging.getLogger(__name__)
+CONFIG_PATH = settings.CONFIG_PATH
+REPORT_INTERVAL = 60  # Seconds between throughput reports of each worker.
+MIN_BACKOFF = 1  # Seconds to wait before the first restart of a worker.
+MAX_BACKOFF = 300  # Max seconds to wait between restarts of a worker.
+STABLE_SECONDS = 600  # A worker that ran at least this long restarts without backoff.
+
+
+def shard_companies(company_ary, stock_ary, num_shards):
+    """Splits company and stock pairs round-robin into at most num_shards shards.
+    :param company_ary: company names.
+    :param stock_ary: stock symbol of each company.
+    :param num_shards: number of shards to create.
+    :return: list of shards, each a list of (company, stock) tuples.
+    """
+    pairs = [(company.strip(), stock.strip()) for company, stock in zip(company_ary, stock_ary) if company.strip()]
+    num_shards = max(1, min(num_shards, len(pairs)))
+    return [pairs[i::num_shards] for i in range(num_shards)]
+
+
+def run_worker(shard_id, pairs, tweet_cred, stats_queue, report_interval):
+    """Worker process entry point: streams one shard and reports its throughput to the supervisor."""
+    # Exit through the collector's finally blocks on terminate(), so open batches are flushed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    config = settings.load()
+    conn = s3_utils.S3Connection.from_config(config.aws)
+    metrics.from_config(config.section('metrics'), port_offset=shard_id)  # One endpoint per worker.
+
+    def start_reporter(listener):
+        def report():
+            last_time, last_tweets = time.time(), 0
+            while True:
+                time.sleep(report_interval)
+                now, num_tweets = time.time(), listener.num_tweets
+                stats_queue.put((shard_id, (num_tweets - last_tweets) / (now - last_time), num_tweets,
+                                 listener.num_unmatched, listener.pipeline.stats()))
+                last_time, last_tweets = now, num_tweets
+        reporter = threading.Thread(target=report, name='throughput-reporter')
+        reporter.daemon = True
+        reporter.start()
+
+    multi_company.multiplex(conn, [company for company, _ in pairs], [stock for _, stock in pairs], tweet_cred,
+                            on_start=start_reporter)
+
+
+class Worker(object):
+    """Supervisor side handle of one shard's process."""
+
+    def __init__(self, shard_id, pairs, tweet_cred):
+        self.shard_id = shard_id
+        self.pairs = pairs
+        self.tweet_cred = tweet_cred
+        self.process = None
+        self.started = None
+        self.num_failures = 0  # Consecutive short-lived runs, drives the backoff.
+        self.restart_at = 0
+
+    def start(self, stats_queue, report_interval):
+        LOGGER.info('Starting worker {} for {}'.format(self.shard_id, ','.join(c for c, _ in self.pairs)))
+        self.process = multiprocessing.Process(target=run_worker, name='collector-{}'.format(self.shard_id),
+                                               args=(self.shard_id, self.pairs, self.tweet_cred, stats_queue,
+                                                     report_interval))
+        self.process.daemon = True
+        self.process.start()
+        self.started = time.time()
+
+    def schedule_restart(self, max_backoff):
+        """Records that the process exited and picks when to start it again."""
+        ran_for = time.time() - self.started
+        self.num_failures = 0 if ran_for >= STABLE_SECONDS else self.num_failures + 1
+        backoff = min(max_backoff, MIN_BACKOFF * 2 ** self.num_failures) if self.num_failures else 0
+        LOGGER.warning('Worker {} exited with code {} after {:.0f}s, restarting in {}s'.format(
+            self.shard_id, self.process.exitcode, ran_for, backoff))
+        self.process = None
+        self.restart_at = time.time() + backoff
+
+
+class Supervisor(object):
+    """Starts one worker process per shard, restarts crashed workers with exponential backoff and logs throughput."""
+
+    def __init__(self, shards, credentials, report_interval=REPORT_INTERVAL, max_backoff=MAX_BACKOFF,
+                 config_path=None, reload_interval=settings.RELOAD_INTERVAL):
+        """
+        :param shards: list of shards from shard_companies.
+        :param credentials: list of twitter credential dicts. Shard i streams with credentials[i % len(credentials)].
+        :param report_interval: seconds between throughput reports of each worker.
+        :param max_backoff: max seconds to wait between restarts of a worker.
+        :param config_path: config file to watch. When its shards or credentials change, every worker is restarted
+            with the new ones. None to not watch.
+        :param reload_interval: seconds between checks of config_path.
+        """
+        self.workers = _create_workers(shards, credentials)
+        self.report_interval = report_interval
+        self.max_backoff = max_backoff
+        self.config_path = config_path
+        self.reload_interval = reload_interval
+        self.next_reload = time.time() + reload_interval
+        self.stats_queue = multiprocessing.Queue()
+
+    def run(self):
+        """Supervises the workers until interrupted."""
+        try:
+            while True:
+                self._check_config()
+                self._check_workers()
+                self._log_stats()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Terminates every running worker."""
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+
+    def _check_config(self):
+        """Restarts every worker if the shards or credentials in the watched config changed."""
+        if self.config_path is None or time.time() < self.next_reload:
+            return
+        self.next_reload = time.time() + self.reload_interval
+        try:
+            shards, credentials = shards_from_config(settings.load(self.config_path))
+            workers = _create_workers(shards, credentials)
+        except Exception:
+            LOGGER.exception('Keeping the current workers, failed to reload {}'.format(self.config_path))
+            return
+        if [(w.pairs, w.tweet_cred) for w in workers] != [(w.pairs, w.tweet_cred) for w in self.workers]:
+            LOGGER.info('Config changed, restarting {} workers as {}'.format(len(self.workers), len(workers)))
+            self.stop()
+            self.workers = workers
+
+    def _check_workers(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker.process is None:
+                if now >= worker.restart_at:
+                    worker.start(self.stats_queue, self.report_interval)
+            elif not worker.process.is_alive():
+                worker.schedule_restart(self.max_backoff)
+
+    def _log_stats(self):
+        """Logs the throughput reports sent by the workers, waiting up to a second for the first one."""
+        try:
+            report = self.stats_queue.get(timeout=1)
+            while True:
+                shard_id, tweets_per_sec, num_tweets, num_unmatched, pipeline_stats = report
+                LOGGER.info('Worker {}: {:.1f} tweets/sec, {} tweets, {} unmatched, pipeline {}'.format(
+                    shard_id, tweets_per_sec, num_tweets, num_unmatched, pipeline_stats))
+                report = self.stats_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+def shards_from_config(config):
+    """Shards the companies of a settings.Config over its twitter accounts.
+    :return: (list of shards from shard_companies, list of twitter credential dicts).
+    """
+    credentials = config.twitter_accounts
+    companies = config.companies
+    shards = shard_companies([c.name for c in companies], [c.stock for c in companies],
+                             config.section('supervisor').get('shards') or len(credentials))
+    return shards, credentials
+
+
+def from_config(file_path=CONFIG_PATH):
+    """Creates a Supervisor from the many_company, twitter_accounts and supervisor sections of the yaml config.
+    The Supervisor watches file_path for changes.
+    """
+    config = settings.load(file_path)
+    shards, credentials = shards_from_config(config)
+    info = config.section('supervisor')
+    return Supervisor(shards, credentials, info.get('report_interval') or REPORT_INTERVAL,
+                      info.get('max_backoff') or MAX_BACKOFF, file_path, config.reload_interval)
+
+
+def _create_workers(shards, credentials):
+    if not credentials:
+        raise DataPipelineException('At least one set of twitter credentials is required')
+    if len(shards) > len(credentials):
+        LOGGER.warning('{} shards share {} twitter credential sets'.format(len(shards), len(credentials)))
+    return [Worker(i, shard, credentials[i % len(credentials)]) for i, shard in enumerate(shards)]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    from_config().run()
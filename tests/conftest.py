@@ -0,0 +1,40 @@
+"""Shared fixtures. S3 tests run against moto's in-memory S3, so they need neither AWS credentials nor a network.
+
+    pip install pytest moto
+    python -m pytest tests
+"""
+import os
+import sys
+
+import boto3
+import pytest
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from s3_utils import S3Connection  # noqa: E402
+
+BUCKET = 'tweetstream-test'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """Mocked S3 with an empty BUCKET."""
+    for name, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_SESSION_TOKEN', 'testing'), ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(name, value)
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield
+
+
+@pytest.fixture
+def conn(s3):
+    """S3Connection to the mocked BUCKET."""
+    connection = S3Connection(BUCKET, parallel_processes=4)
+    yield connection
+    connection.close()
@@ -0,0 +1,53 @@
+import random
+
+import aggregate
+
+
+def test_tokenize_splits_hashtags_and_terms():
+    assert aggregate.tokenize('RT @rongbin: The new #iPhone from $AAPL is out 2018 https://t.co/x #') == (['#iphone'], ['$aapl'])
+
+
+def test_space_saving_is_exact_below_capacity():
+    summary = aggregate.SpaceSaving(capacity=3)
+    for item in 'abacab':
+        summary.add(item)
+
+    assert summary.top(2) == [['a', 3], ['b', 2]]
+    assert summary.top(5) == [['a', 3], ['b', 2], ['c', 1]]
+
+
+def test_space_saving_keeps_heavy_hitters_within_the_error_bound():
+    capacity = 20
+    stream = ['heavy{}'.format(i) for i in range(5) for _ in range(200)]
+    stream += ['rare{}'.format(i) for i in range(2000)]
+    random.Random(42).shuffle(stream)
+    summary = aggregate.SpaceSaving(capacity)
+    for item in stream:
+        summary.add(item)
+
+    assert len(summary.counts) == capacity
+    assert sum(summary.counts.values()) == len(stream)
+    top = dict(summary.top(5))
+    assert sorted(top) == ['heavy{}'.format(i) for i in range(5)]
+    for count in top.values():
+        assert 200 <= count <= 200 + len(stream) // capacity
+
+
+def test_sliding_window_drops_buckets_that_fall_out_of_the_window():
+    window = aggregate.SlidingWindow(seconds=60, num_buckets=6)
+    window.add(1000, ['#iphone'], ['apple'])
+    window.add(1005, ['#iphone'], ['apple'])
+    window.add(1030, [], ['earnings'])
+
+    assert window.summary(1035) == {'tweets': 3, 'hashtags': [['#iphone', 2]],
+                                    'terms': [['apple', 2], ['earnings', 1]]}
+    assert window.summary(1065) == {'tweets': 1, 'hashtags': [], 'terms': [['earnings', 1]]}
+    assert window.summary(1100) == {'tweets': 0, 'hashtags': [], 'terms': []}
+
+
+def test_sliding_window_reuses_expired_buckets():
+    window = aggregate.SlidingWindow(seconds=60, num_buckets=6)
+    window.add(1000, ['#old'], [])
+    window.add(1060, ['#new'], [])
+
+    assert window.summary(1060) == {'tweets': 1, 'hashtags': [['#new', 1]], 'terms': []}
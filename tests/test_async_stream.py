@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pytest
+
+async_stream = pytest.importorskip('async_stream')
+
+import metrics  # noqa: E402
+import pipeline  # noqa: E402
+
+
+class FullPipeline(object):
+    """BatchPipeline stand-in whose queue is always full under the drop policy."""
+    policy = pipeline.POLICY_DROP
+
+    def full(self):
+        return True
+
+    def put(self, key, record):
+        return False
+
+    def stop(self):
+        pass
+
+
+class ListSink(object):
+    def __init__(self):
+        self.records = []
+
+    async def write(self, company, record):
+        self.records.append((company, record['Text']))
+
+    async def close(self):
+        pass
+
+
+def replay_file(tmpdir, texts):
+    path = tmpdir.join('stream.jsonl')
+    path.write(''.join(json.dumps({'text': text, 'created_at': 'Wed Oct 10 20:19:24 +0000 2018'}) + '\n'
+                       for text in texts))
+    return str(path)
+
+
+def test_records_dropped_by_the_pipeline_count_as_queue_full(tmpdir):
+    other = ListSink()
+    engine = async_stream.StreamEngine(async_stream.ReplaySource(replay_file(tmpdir, ['apple up', 'apple down'])),
+                                       async_stream.Router(['Apple'], ['$AAPL']),
+                                       [async_stream.PipelineSink(FullPipeline()), other])
+    kept = metrics.TWEETS_KEPT.value(('APPLE',))
+    dropped = metrics.TWEETS_DROPPED.value(('APPLE', 'queue_full'))
+
+    stats = asyncio.new_event_loop().run_until_complete(engine.run())
+
+    assert stats['records'] == 2
+    assert stats['queue_full'] == 2
+    assert metrics.TWEETS_KEPT.value(('APPLE',)) == kept
+    assert metrics.TWEETS_DROPPED.value(('APPLE', 'queue_full')) == dropped + 2
+    assert other.records == [('APPLE', 'apple up'), ('APPLE', 'apple down')]
+
+
+def test_records_taken_by_the_pipeline_count_as_kept(tmpdir):
+    flushed = []
+    batches = pipeline.BatchPipeline(lambda key, batch: flushed.extend(batch), policy=pipeline.POLICY_DROP)
+    engine = async_stream.StreamEngine(async_stream.ReplaySource(replay_file(tmpdir, ['apple up', 'no match'])),
+                                       async_stream.Router(['Apple'], ['$AAPL']), [async_stream.PipelineSink(batches)])
+    kept = metrics.TWEETS_KEPT.value(('APPLE',))
+
+    stats = asyncio.new_event_loop().run_until_complete(engine.run())
+
+    assert stats['queue_full'] == 0
+    assert metrics.TWEETS_KEPT.value(('APPLE',)) == kept + 1
+    assert [record['Text'] for record in flushed] == ['apple up']
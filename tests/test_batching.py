@@ -0,0 +1,56 @@
+import pytest
+
+import batching
+from utils import DataPipelineException
+
+
+def test_hard_limits_flush_whatever_the_interval():
+    policy = batching.BatchPolicy(max_records=100, max_bytes=1000, max_age=60, target_bytes=500, min_interval=30)
+
+    assert policy.flush_reason(99, 999, 29) is None
+    assert policy.flush_reason(100, 10, 0) == batching.REASON_RECORDS
+    assert policy.flush_reason(10, 1000, 0) == batching.REASON_BYTES
+    assert policy.flush_reason(10, 10, 60) == batching.REASON_AGE
+
+
+def test_target_bytes_waits_for_min_interval():
+    policy = batching.BatchPolicy(max_bytes=1000, max_age=60, target_bytes=500, min_interval=30)
+
+    assert policy.flush_reason(10, 600, 29) is None
+    assert policy.flush_reason(10, 600, 30) == batching.REASON_TARGET
+    assert policy.flush_reason(10, 499, 59) is None
+
+
+def test_no_limits_never_flush():
+    policy = batching.BatchPolicy()
+
+    assert policy.flush_reason(10 ** 9, 10 ** 12, 10 ** 6) is None
+    assert not policy.tracks_bytes
+
+
+def test_min_interval_longer_than_max_age_raises():
+    with pytest.raises(DataPipelineException):
+        batching.BatchPolicy(max_age=30, min_interval=60)
+
+
+def test_from_config_defaults():
+    policy = batching.from_config({'max_records': None}, max_records=3000)
+
+    assert (policy.max_records, policy.max_bytes, policy.max_age, policy.target_bytes, policy.min_interval) == (
+        3000, batching.MAX_BYTES, batching.MAX_AGE, batching.TARGET_BYTES, batching.MIN_INTERVAL)
+
+
+def test_from_config_zero_disables_a_limit():
+    policy = batching.from_config({'max_records': 0, 'max_bytes': 0, 'max_age': 0, 'target_bytes': 0,
+                                   'min_interval': 0}, max_records=3000)
+
+    assert (policy.max_records, policy.max_bytes, policy.max_age, policy.target_bytes, policy.min_interval) == (
+        None, None, None, None, 0)
+    assert batching.from_config({'max_age': 0}).min_interval == batching.MIN_INTERVAL
+
+
+def test_from_config_clamps_the_default_min_interval_to_max_age():
+    assert batching.from_config({'max_age': 20}).min_interval == 20
+    assert batching.from_config({}, max_age=5).min_interval == 5
+    with pytest.raises(DataPipelineException):
+        batching.from_config({'max_age': 20, 'min_interval': 30})
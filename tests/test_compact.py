@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+import compact
+from conftest import BUCKET
+from s3_utils import S3Connection
+from utils import DataPipelineException
+
+PREFIX = 'company=APPLE/date=2018-10-10/hour=20/'
+
+
+def put_batch(conn, name, texts):
+    body = ''.join(json.dumps({'text': text}) + '\n' for text in texts)
+    conn.s3_client.put_object(Bucket=BUCKET, Key=PREFIX + name, Body=body.encode('utf-8'))
+
+
+def partition_texts(conn):
+    return sorted(record['text'] for key in conn.list_keys(PREFIX) for record in conn.iter_key_records(key))
+
+
+def test_compact_company_merges_each_finished_partition(conn):
+    put_batch(conn, 'a.jsonl', ['1', '2'])
+    put_batch(conn, 'b.jsonl', ['3'])
+    put_batch(conn, 'c.jsonl', ['4', '5'])
+
+    compacted = compact.compact_company(conn, 'APPLE')
+
+    assert conn.list_keys(PREFIX) == compacted
+    assert partition_texts(conn) == ['1', '2', '3', '4', '5']
+
+
+def test_compact_partition_merges_late_batches(conn):
+    put_batch(conn, 'a.jsonl', ['1'])
+    put_batch(conn, 'b.jsonl', ['2'])
+    compact.compact_company(conn, 'APPLE')
+    put_batch(conn, 'a0.jsonl', ['3'])
+
+    compact.compact_company(conn, 'APPLE')
+
+    assert len(conn.list_keys(PREFIX)) == 1
+    assert partition_texts(conn) == ['1', '2', '3']
+    assert len(conn.list_keys(compact.SOURCES_PREFIX)) == 1
+
+
+def test_compact_partition_failed_delete_is_not_merged_twice(conn, monkeypatch):
+    put_batch(conn, 'a.jsonl', ['1'])
+    put_batch(conn, 'b.jsonl', ['2'])
+    put_batch(conn, 'c.jsonl', ['3'])
+    delete_key_list = conn.delete_key_list
+    monkeypatch.setattr(conn, 'delete_key_list', lambda keys: delete_key_list([key for key in keys
+                                                                               if not key.endswith('b.jsonl')]))
+
+    with pytest.raises(DataPipelineException):
+        compact.compact_company(conn, 'APPLE')
+    assert len(conn.list_keys(PREFIX)) == 2
+
+    monkeypatch.undo()
+    assert compact.compact_company(conn, 'APPLE') == []
+    assert len(conn.list_keys(PREFIX)) == 1
+    assert partition_texts(conn) == ['1', '2', '3']
+
+
+def test_compaction_lists_past_the_manifest(s3, tmpdir):
+    with S3Connection(BUCKET, manifest_path=str(tmpdir.join('manifest.db')), manifest_full_list_interval=3600) as conn:
+        put_batch(conn, 'b.jsonl', ['1'])
+        conn.list_keys('company=APPLE/')
+        put_batch(conn, 'a.jsonl', ['2'])
+
+        assert compact.list_partitions(conn, 'APPLE') == {PREFIX: [PREFIX + 'a.jsonl', PREFIX + 'b.jsonl']}
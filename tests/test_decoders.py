@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+import decoders
+from utils import DataPipelineException
+
+TWEET = json.dumps({'text': 'apple up', 'created_at': 'Wed Oct 10 20:19:24 +0000 2018', 'id_str': '2',
+                    'user': {'screen_name': 'rongbin', 'followers_count': 10},
+                    'retweeted_status': {'id_str': '1', 'text': 'apple up'},
+                    'entities': {'hashtags': []}})
+
+
+@pytest.fixture(params=decoders.available_backends())
+def backend(request):
+    return request.param
+
+
+def test_full_decode_returns_the_whole_payload(backend):
+    decode = decoders.get_decoder(backend)
+
+    assert decode(TWEET) == json.loads(TWEET)
+
+
+def test_projection_keeps_the_dotted_fields(backend):
+    decode = decoders.get_decoder(backend, decoders.TWEET_FIELDS + ('user',))
+
+    assert decode(TWEET) == {'text': 'apple up', 'created_at': 'Wed Oct 10 20:19:24 +0000 2018', 'id_str': '2',
+                             'retweeted_status.id_str': '1',
+                             'user': {'screen_name': 'rongbin', 'followers_count': 10}}
+    assert decode(TWEET.encode('utf-8'))['text'] == 'apple up'
+
+
+def test_projection_skips_missing_fields(backend):
+    decode = decoders.get_decoder(backend, decoders.TWEET_FIELDS)
+
+    assert decode('{"delete": {"status": {"id_str": "1"}}}') == {}
+    assert decode('{"text": "hi", "retweeted_status": "not an object"}') == {'text': 'hi'}
+    assert decode('[1, 2]') == {}
+
+
+def test_invalid_json_raises_value_error(backend):
+    decode = decoders.get_decoder(backend, decoders.TWEET_FIELDS)
+
+    with pytest.raises(ValueError):
+        decode('{"text": ')
+
+
+def test_unavailable_backend_raises():
+    with pytest.raises(DataPipelineException):
+        decoders.get_decoder('yaml')
@@ -0,0 +1,65 @@
+import dedup
+
+
+def test_dedup_is_opt_in():
+    assert dedup.from_config({}) is None
+    assert dedup.from_config({'enabled': False}) is None
+    assert isinstance(dedup.from_config({'enabled': True}), dedup.Deduplicator)
+
+
+def tweet(text, id_str, retweeted_id=None):
+    tweet = {'text': text, 'id_str': id_str}
+    if retweeted_id is not None:
+        tweet['retweeted_status.id_str'] = retweeted_id
+    return tweet
+
+
+def test_drops_repeated_ids_retweets_and_texts():
+    dedup_filter = dedup.Deduplicator(max_bytes=64 * 1024)
+
+    assert not dedup_filter.is_duplicate(tweet('Apple beats estimates https://t.co/a', '1'))
+    assert dedup_filter.is_duplicate(tweet('Apple beats estimates https://t.co/a', '1'))
+    assert dedup_filter.is_duplicate(tweet('RT @rongbin: apple  beats estimates https://t.co/b', '2', '1'))
+    assert dedup_filter.is_duplicate({'text': 'quoting it', 'id_str': '3', 'retweeted_status': {'id_str': '1'}})
+    assert dedup_filter.is_duplicate(tweet('APPLE beats estimates', '4'))
+    assert not dedup_filter.is_duplicate(tweet('Intel misses estimates', '5'))
+    assert dedup_filter.stats() == {'passed': 2, 'dropped_id': 3, 'dropped_text': 1, 'rotations': 0}
+
+
+def test_keys_are_forgotten_after_two_rotations(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, 'time', lambda: now[0])
+    bloom = dedup.RotatingBloomFilter(max_bytes=1024, window=60)
+    assert bloom.add(b'id:1')
+
+    now[0] += 61
+    assert not bloom.add(b'id:1')  # Still in the previous generation.
+    now[0] += 61
+    bloom.add(b'id:2')
+
+    assert bloom.add(b'id:1')
+    assert bloom.num_rotations == 2
+
+
+def test_rotates_on_capacity():
+    bloom = dedup.RotatingBloomFilter(max_bytes=1024)
+    for i in range(bloom.capacity):
+        assert bloom.add('key {}'.format(i).encode('utf-8'))
+    assert bloom.num_rotations == 0
+
+    bloom.add(b'one more')
+
+    assert bloom.num_rotations == 1
+    assert not bloom.add(b'key 0')
+
+
+def test_false_positives_stay_within_the_error_rate_at_capacity():
+    bloom = dedup.RotatingBloomFilter(max_bytes=64 * 1024, error_rate=0.01)
+    for i in range(bloom.capacity):
+        bloom.add('seen {}'.format(i).encode('utf-8'))
+
+    num_probes = 5000
+    false_positives = sum(not bloom.add('new {}'.format(i).encode('utf-8')) for i in range(num_probes))
+
+    assert bloom.num_rotations == 1
+    assert false_positives <= 2 * 0.01 * num_probes
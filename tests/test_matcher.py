@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from matcher import KeywordMatcher, build_matcher
+
+
+def make_matcher():
+    matcher = KeywordMatcher()
+    for term, label in (('APPLE', 'APPLE'), ('$AAPL', 'APPLE'), ('Intel', 'INTEL'), ('$INTC', 'INTEL')):
+        matcher.add(term, label)
+    return matcher
+
+
+def test_match_is_case_insensitive():
+    assert make_matcher().match('apple and INTEL report today') == {'APPLE', 'INTEL'}
+
+
+def test_match_needs_the_whole_word():
+    matcher = make_matcher()
+
+    assert matcher.match('pineapples and intelligence') == set()
+    assert matcher.match('buying $AAPL.') == {'APPLE'}
+    assert matcher.match('$AAPLX is not a ticker we track') == set()
+
+
+def test_term_can_route_to_several_labels():
+    matcher = make_matcher()
+    matcher.add('chips', 'APPLE')
+    matcher.add('Chips', 'INTEL')
+
+    assert matcher.match('new chips') == {'APPLE', 'INTEL'}
+
+
+def test_longer_terms_win_over_their_prefixes():
+    matcher = KeywordMatcher()
+    matcher.add('apple', 'FRUIT')
+    matcher.add('apple watch', 'APPLE')
+
+    assert matcher.match('my apple watch broke') == {'APPLE'}
+
+
+def test_unicode_text_and_terms():
+    matcher = KeywordMatcher()
+    matcher.add(u'Nestlé', 'NESTLE')
+
+    assert matcher.match(u'NESTLÉ shares rise') == {'NESTLE'}
+    assert matcher.match(u'Nestléx') == set()
+
+
+def test_terms_labels_and_empty_input():
+    matcher = make_matcher()
+    matcher.add('   ', 'IGNORED')
+
+    assert matcher.terms() == ['$aapl', '$intc', 'apple', 'intel']
+    assert matcher.labels() == {'APPLE', 'INTEL'}
+    assert matcher.match('') == set()
+    assert matcher.match(None) == set()
+    assert KeywordMatcher().match('apple') == set()
+
+
+def test_build_matcher_routes_names_and_symbols_to_the_company():
+    matcher, stock_by_company = build_matcher([' Apple', 'Intel '], ['$aapl', ' $INTC'])
+
+    assert stock_by_company == {'APPLE': '$AAPL', 'INTEL': '$INTC'}
+    assert matcher.match('$AAPL beats intel') == {'APPLE', 'INTEL'}
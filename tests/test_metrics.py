@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import metrics
+from utils import DataPipelineException
+
+
+def test_counter_and_gauge_render_in_the_text_format():
+    registry = metrics.Registry()
+    kept = registry.counter('tweets_kept_total', 'Tweets kept.', ('company',))
+    kept.inc(labels=('INTEL',))
+    kept.inc(2, labels=('APPLE',))
+    registry.gauge('pending', 'Pending batches.').set_function(lambda: 7)
+
+    assert registry.render() == ('# HELP tweets_kept_total Tweets kept.\n'
+                                 '# TYPE tweets_kept_total counter\n'
+                                 'tweets_kept_total{company="APPLE"} 2\n'
+                                 'tweets_kept_total{company="INTEL"} 1\n'
+                                 '# HELP pending Pending batches.\n'
+                                 '# TYPE pending gauge\n'
+                                 'pending 7\n')
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = metrics.Registry()
+    latency = registry.histogram('flush_seconds', 'Flush latency.', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        latency.observe(value)
+
+    assert registry.render().splitlines()[2:] == ['flush_seconds_bucket{le="0.1"} 1',
+                                                  'flush_seconds_bucket{le="1"} 3',
+                                                  'flush_seconds_bucket{le="+Inf"} 4',
+                                                  'flush_seconds_sum 4.25',
+                                                  'flush_seconds_count 4']
+
+
+def render_label(value):
+    registry = metrics.Registry()
+    registry.counter('dropped_total', 'Dropped.', ('company',)).inc(labels=(value,))
+    return registry.render().splitlines()[2]
+
+
+def test_label_values_are_escaped_and_unicode_safe():
+    assert render_label(u'Nestlé "SA"\\\n') == u'dropped_total{company="Nestlé \\"SA\\"\\\\\\n"} 1'
+    assert render_label(u'Nestlé'.encode('utf-8')) == u'dropped_total{company="Nestlé"} 1'
+    assert render_label(42) == u'dropped_total{company="42"} 1'
+
+
+def test_label_count_and_registration_are_checked():
+    registry = metrics.Registry()
+    kept = registry.counter('kept_total', 'Kept.', ('company',))
+
+    assert registry.counter('kept_total', 'Kept.', ('company',)) is kept
+    with pytest.raises(DataPipelineException):
+        registry.gauge('kept_total', 'Kept.', ('company',))
+    with pytest.raises(DataPipelineException):
+        kept.inc(labels=())
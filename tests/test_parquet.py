@@ -0,0 +1,56 @@
+import datetime
+import io
+
+import pytest
+
+import pipeline
+import writers
+from utils import DataPipelineException
+
+pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+
+RECORDS = [{'Text': 'tweet {}'.format(i), 'Created at': 'Wed Oct 10 20:19:{:02d} +0000 2018'.format(i),
+            'Company': 'APPLE' if i % 2 else 'INTEL', 'Stock': '$AAPL' if i % 2 else '$INTC'} for i in range(6)]
+
+
+def test_write_parquet_types_the_columns():
+    buf = io.BytesIO()
+
+    assert writers.write_parquet(RECORDS + [{'Text': 'no date', 'Created at': 'garbage'}], buf) == 7
+
+    table = pyarrow_parquet.read_table(io.BytesIO(buf.getvalue()))
+    assert table.column_names == ['Text', 'Created at', 'Company', 'Stock']
+    created_type = table.schema.field('Created at').type
+    assert str(created_type).startswith('timestamp') and created_type.tz == 'UTC'
+    assert str(table.schema.field('Company').type).startswith('dictionary')
+    rows = table.to_pylist()
+    assert rows[1]['Created at'].replace(tzinfo=None) == datetime.datetime(2018, 10, 10, 20, 19, 1)
+    assert rows[1]['Company'] == 'APPLE'
+    assert rows[6]['Created at'] is None
+
+
+def test_write_parquet_requires_pyarrow(monkeypatch):
+    monkeypatch.setattr(writers, 'pyarrow', None)
+
+    with pytest.raises(DataPipelineException):
+        writers.write_parquet(RECORDS, io.BytesIO())
+
+
+@pytest.mark.parametrize('output_format', [pipeline.FORMAT_JSON, pipeline.FORMAT_JSONL])
+def test_sinks_upload_a_parquet_copy_of_each_batch(conn, output_format):
+    if output_format == pipeline.FORMAT_JSON:
+        sink, batch_factory = pipeline.S3BatchSink(conn, parquet=True), None
+    else:
+        sink = pipeline.S3JsonlSink(conn, parquet=True)
+        batch_factory = sink.new_batch
+    batches = pipeline.BatchPipeline(sink, batch_size=None, batch_factory=batch_factory)
+    for record in RECORDS:
+        batches.put('APPLE', record)
+    batches.stop()
+
+    keys = conn.list_keys('APPLE/')
+    parquet_keys = [key for key in keys if key.endswith('.parquet')]
+    assert len(keys) == 2 and len(parquet_keys) == 1
+    assert keys[0].split('.')[0] == keys[1].split('.')[0]
+    table = pyarrow_parquet.read_table(io.BytesIO(conn.get_key_contents(parquet_keys[0])))
+    assert table.column('Text').to_pylist() == [record['Text'] for record in RECORDS]
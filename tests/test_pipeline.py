@@ -0,0 +1,83 @@
+import json
+import time
+
+import pytest
+
+import batching
+import pipeline
+from utils import DataPipelineException
+
+
+def test_json_sink_keeps_batches_closed_in_the_same_second(conn):
+    batches = pipeline.BatchPipeline(pipeline.S3BatchSink(conn), batch_size=10)
+    for i in range(35):
+        batches.put('APPLE', {'text': 'tweet {}'.format(i)})
+    batches.stop()
+
+    keys = conn.list_keys('APPLE/')
+    assert batches.stats()['flushed_batches'] == 4
+    assert len(keys) == 4
+    texts = set()
+    for key in keys:
+        texts.update(record['text'] for record in json.loads(conn.get_key_contents(key).decode('utf-8')).values())
+    assert len(texts) == 35
+
+
+def test_jsonl_sink_keeps_batches_closed_in_the_same_second(conn):
+    sink = pipeline.S3JsonlSink(conn)
+    batches = pipeline.BatchPipeline(sink, batch_size=10, batch_factory=sink.new_batch, flush_workers=2)
+    for i in range(35):
+        batches.put('APPLE', {'text': 'tweet {}'.format(i)})
+    batches.stop()
+
+    assert len(conn.list_keys('APPLE/', '.jsonl.gz')) == 4
+
+
+def test_record_that_cannot_be_batched_is_dropped(conn):
+    sink = pipeline.S3JsonlSink(conn)
+
+    def batch_factory(key):
+        if key == 'BROKEN':
+            raise OSError('disk full')
+        return sink.new_batch(key)
+
+    batches = pipeline.BatchPipeline(sink, batch_size=10, batch_factory=batch_factory)
+    batches.put('BROKEN', {'text': 'lost'})
+    for i in range(10):
+        batches.put('APPLE', {'text': 'tweet {}'.format(i)})
+    batches.stop()
+
+    assert batches.stats()['record_errors'] == 1
+    assert batches.stats()['flushed_records'] == 10
+
+
+class FailingPolicy(batching.BatchPolicy):
+    """Fails every flush decision, which the batcher cannot recover from when sweeping batch ages."""
+
+    def flush_reason(self, num_records, num_bytes, age):
+        raise RuntimeError('broken policy')
+
+
+def test_stopped_batcher_makes_put_and_stop_raise():
+    flushed = []
+    batches = pipeline.BatchPipeline(lambda key, batch: flushed.append(list(batch)), queue_size=1,
+                                     batch_policy=FailingPolicy())
+    batches.put('APPLE', {'text': 'kept'})
+    deadline = time.time() + 10
+    while batches._error is None and time.time() < deadline:
+        time.sleep(0.05)
+
+    with pytest.raises(DataPipelineException):
+        batches.put('APPLE', {'text': 'refused'})
+    with pytest.raises(DataPipelineException):
+        batches.stop()
+    assert flushed == [[{'text': 'kept'}]]
+
+
+def test_blocked_put_raises_once_the_batcher_stops():
+    batches = pipeline.BatchPipeline(lambda key, batch: None, queue_size=1, batch_policy=FailingPolicy())
+    batches._queue.put(('APPLE', {'text': 'fills the queue'}))
+
+    with pytest.raises(DataPipelineException):
+        for _ in range(100):
+            batches.put('APPLE', {'text': 'waits'})
@@ -0,0 +1,183 @@
+import datetime
+import gzip
+import io
+import json
+import os
+
+import pytest
+
+from conftest import BUCKET
+from s3_utils import S3Connection
+
+PART_SIZE = 5 * 1024 * 1024  # Smallest part size S3 accepts.
+
+
+def test_upload_stream_small_stream_is_a_single_put(conn):
+    conn.upload_stream(io.BytesIO(b'small batch'), 'APPLE/small.txt', part_size=PART_SIZE)
+
+    assert conn.get_key_contents('APPLE/small.txt') == b'small batch'
+
+
+def test_upload_stream_multipart(conn):
+    data = os.urandom(2 * PART_SIZE + 1234)
+
+    conn.upload_stream(io.BytesIO(data), 'APPLE/big.txt', part_size=PART_SIZE, parallel_parts=2)
+
+    assert conn.get_key_contents('APPLE/big.txt') == data
+    assert conn.s3_client.head_object(Bucket=BUCKET, Key='APPLE/big.txt')['ETag'].endswith('-3"')
+
+
+def test_upload_stream_multipart_from_chunk_iterator(conn):
+    chunks = [os.urandom(1024 * 1024) for _ in range(11)]
+
+    conn.upload_stream(iter(chunks), 'APPLE/chunks.txt', part_size=PART_SIZE)
+
+    assert conn.get_key_contents('APPLE/chunks.txt') == b''.join(chunks)
+
+
+def test_upload_stream_aborts_failed_multipart_upload(conn):
+    def chunks():
+        yield os.urandom(PART_SIZE)
+        yield os.urandom(PART_SIZE)
+        raise IOError('stream broke')
+
+    with pytest.raises(IOError):
+        conn.upload_stream(chunks(), 'APPLE/broken.txt', part_size=PART_SIZE)
+
+    assert conn.list_keys('APPLE/') == []
+    assert conn.s3_client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+
+
+def put_objects(conn, keys, size=100):
+    for key in keys:
+        conn.s3_client.put_object(Bucket=BUCKET, Key=key, Body=os.urandom(size))
+
+
+def manifest_conn(tmpdir, **kwargs):
+    return S3Connection(BUCKET, manifest_path=str(tmpdir.join('manifest.db')), parallel_processes=4, **kwargs)
+
+
+def test_sync_prefix_downloads_only_new_keys(s3, tmpdir):
+    local_dir = str(tmpdir.join('local'))
+    with manifest_conn(tmpdir) as conn:
+        put_objects(conn, ['APPLE/k1', 'APPLE/k2'])
+        conn.sync_prefix('APPLE/', local_dir)
+        os.remove(os.path.join(local_dir, 'k1'))
+        conn.s3_client.delete_object(Bucket=BUCKET, Key='APPLE/k1')
+        put_objects(conn, ['APPLE/k3'])
+
+        local_files = conn.sync_prefix('APPLE/', local_dir)
+
+    assert [os.path.basename(path) for path in local_files] == ['k2', 'k3']
+
+
+def test_sync_prefix_finds_keys_written_below_the_last_listed_key(s3, tmpdir):
+    local_dir = str(tmpdir.join('local'))
+    with manifest_conn(tmpdir) as conn:
+        put_objects(conn, ['APPLE/k1', 'APPLE/k9'])
+        conn.sync_prefix('APPLE/', local_dir)
+        put_objects(conn, ['APPLE/k5'])
+
+        local_files = conn.sync_prefix('APPLE/', local_dir)
+
+    assert [os.path.basename(path) for path in local_files] == ['k1', 'k5', 'k9']
+    assert all(os.path.exists(path) for path in local_files)
+
+
+def test_sync_prefix_incremental_listing_until_the_next_full_listing(s3, tmpdir):
+    local_dir = str(tmpdir.join('local'))
+    with manifest_conn(tmpdir, manifest_full_list_interval=3600) as conn:
+        put_objects(conn, ['APPLE/k1', 'APPLE/k9'])
+        conn.sync_prefix('APPLE/', local_dir)
+        put_objects(conn, ['APPLE/k5', 'APPLE/k10'])
+
+        incremental = conn.sync_prefix('APPLE/', local_dir)
+        full = conn.sync_prefix('APPLE/', local_dir, full_refresh=True)
+
+    assert [os.path.basename(path) for path in incremental] == ['k1', 'k9']
+    assert [os.path.basename(path) for path in full] == ['k1', 'k10', 'k5', 'k9']
+
+
+def test_sync_prefix_eviction_keeps_the_synced_files(s3, tmpdir):
+    apple_dir, google_dir = str(tmpdir.join('apple')), str(tmpdir.join('google'))
+    with manifest_conn(tmpdir) as conn:
+        put_objects(conn, ['APPLE/k{}'.format(i) for i in range(6)] + ['GOOGLE/k1', 'GOOGLE/k2'])
+
+        apple_files = conn.sync_prefix('APPLE/', apple_dir, max_local_bytes=250)
+        assert len(apple_files) == 6
+        assert all(os.path.exists(path) for path in apple_files)
+
+        google_files = conn.sync_prefix('GOOGLE/', google_dir, max_local_bytes=250)
+
+    assert len(google_files) == 2
+    assert all(os.path.exists(path) for path in google_files)
+    assert os.listdir(apple_dir) == []
+
+
+def put_jsonl(conn, key, records, compress=False):
+    body = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+    conn.s3_client.put_object(Bucket=BUCKET, Key=key, Body=gzip.compress(body) if compress else body)
+
+
+def tweet(hour, minute, text):
+    return {'Created at': 'Wed Oct 10 {:02d}:{:02d}:00 +0000 2018'.format(hour, minute), 'text': text}
+
+
+def put_partitions(conn):
+    for hour in (19, 20, 21):
+        prefix = 'company=APPLE/date=2018-10-10/hour={}/'.format(hour)
+        put_jsonl(conn, prefix + 'a.jsonl.gz', [tweet(hour, 10, '{}a'.format(hour))], compress=True)
+        put_jsonl(conn, prefix + 'b.jsonl', [tweet(hour, 40, '{}b'.format(hour))])
+    conn.s3_client.put_object(Bucket=BUCKET, Key='company=APPLE/date=2018-10-10/hour=20/a.parquet', Body=b'PAR1')
+    conn.s3_client.put_object(Bucket=BUCKET, Key='APPLE/legacy.txt',
+                              Body=json.dumps({'0': tweet(20, 5, 'legacy')}).encode('utf-8'))
+
+
+def test_iter_records_streams_every_batch_in_key_order(conn):
+    put_partitions(conn)
+
+    assert [record['text'] for record in conn.iter_records('company=APPLE/')] == ['19a', '19b', '20a', '20b', '21a',
+                                                                                   '21b']
+    assert [record['text'] for record in conn.iter_records('APPLE/')] == ['legacy']
+
+
+def test_iter_records_between_prunes_partitions_before_download(conn, monkeypatch):
+    put_partitions(conn)
+    fetched = []
+    get_object = conn._get_object
+    monkeypatch.setattr(conn, '_get_object', lambda s3_key: fetched.append(s3_key) or get_object(s3_key))
+
+    records = list(conn.iter_records('company=APPLE/', since=datetime.datetime(2018, 10, 10, 20, 30),
+                                     until=datetime.datetime(2018, 10, 10, 21, 30)))
+
+    assert [record['text'] for record in records] == ['20b', '21a']
+    assert all('hour=19' not in key for key in fetched)
+
+
+def test_iter_records_decodes_on_spawned_processes(conn):
+    put_partitions(conn)
+
+    records = list(conn.iter_records('company=APPLE/', processes=2))
+
+    assert [record['text'] for record in records] == ['19a', '19b', '20a', '20b', '21a', '21b']
+
+
+def test_delete_keys_deletes_keys_the_manifest_has_not_seen(s3, tmpdir):
+    with manifest_conn(tmpdir, manifest_full_list_interval=3600) as conn:
+        put_objects(conn, ['APPLE/k1', 'APPLE/k9'])
+        conn.list_keys('APPLE/')
+        put_objects(conn, ['APPLE/k5'])
+
+        assert sorted(conn.delete_keys('APPLE/')) == ['APPLE/k1', 'APPLE/k5', 'APPLE/k9']
+        assert conn.list_keys('APPLE/', use_manifest=False) == []
+        assert conn.list_keys('APPLE/') == []
+
+
+def test_iter_records_between_reads_flat_batches_uploaded_late(conn):
+    put_partitions(conn)
+    put_jsonl(conn, 'APPLE/APPLErongbin.dashboard20181010203000.jsonl.gz', [tweet(20, 10, 'replayed')], compress=True)
+
+    records = list(conn.iter_records('APPLE/', since=datetime.datetime(2018, 10, 10, 20),
+                                     until=datetime.datetime(2018, 10, 10, 20, 30)))
+
+    assert [record['text'] for record in records] == ['replayed', 'legacy']
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import os
+
+import settings
+from utils import rel_path
+
+TWITTER = {'consumer_key': 'key', 'consumer_secret': 'secret', 'access_token': 'token', 'access_token_secret': 's'}
+
+
+def test_twitter_accounts_fall_back_to_the_twitter_section():
+    blank = {'consumer_key': None, 'consumer_secret': None, 'access_token': None, 'access_token_secret': None}
+
+    assert settings.Config({'twitter': TWITTER}).twitter_accounts == [TWITTER]
+    assert settings.Config({'twitter': TWITTER, 'twitter_accounts': [blank]}).twitter_accounts == [TWITTER]
+
+
+def test_twitter_accounts_skip_blank_entries():
+    account = dict(TWITTER, consumer_key='other')
+
+    config = settings.Config({'twitter': TWITTER, 'twitter_accounts': [account, {'consumer_key': ''}, None]})
+
+    assert config.twitter_accounts == [account]
+
+
+def test_companies_keep_non_ascii_names():
+    config = settings.Config({'many_company': {'company_name': u'Apple, Nestlé ,', 'stock': u'$aapl,$nsrgy,'}})
+
+    assert config.companies == [settings.Company(u'APPLE', u'$AAPL'), settings.Company(u'NESTLÉ', u'$NSRGY')]
+    assert settings.Config({'many_company': {'company_name': 3, 'stock': 4}}).companies == [
+        settings.Company('3', '4')]
+
+
+def write_config(path, companies, mtime):
+    path.write('many_company:\n  company_name: {}\n  stock: {}\n'.format(companies, companies))
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_load_reparses_only_after_the_file_changed(tmpdir):
+    path = tmpdir.join('cred.yaml')
+    write_config(path, 'apple', 1000000000)
+
+    first = settings.load(str(path))
+    assert settings.load(str(path)) is first
+
+    write_config(path, 'intel', 1000000000)
+    assert settings.load(str(path)) is first
+
+    write_config(path, 'intel', 1000000060)
+    reloaded = settings.load(str(path))
+    assert reloaded is not first
+    assert [company.name for company in reloaded.companies] == ['INTEL']
+
+
+def test_rel_path_is_relative_to_the_calling_module():
+    assert rel_path('config/cred.yaml') == os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                        'config/cred.yaml')
+    assert settings.CONFIG_PATH == os.path.join(os.path.dirname(os.path.realpath(settings.__file__)),
+                                                'config/cred.yaml')
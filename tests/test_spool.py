@@ -0,0 +1,86 @@
+import os
+
+import botocore.exceptions
+
+import spool
+
+
+def test_uploader_drains_a_backlog_with_one_listing_per_pass(conn, tmpdir):
+    batches = spool.Spool(str(tmpdir))
+    for i in range(50):
+        batches.append('batch {}'.format(i).encode('utf-8'), 'APPLE/batch{:02d}.txt'.format(i))
+    listings = []
+    entries = batches.entries
+    batches.entries = lambda: listings.append(1) or entries()
+
+    uploader = spool.SpoolUploader(conn, batches)
+    uploader.stop()
+
+    assert len(conn.list_keys('APPLE/')) == 50
+    assert conn.get_key_contents('APPLE/batch07.txt') == b'batch 7'
+    assert entries() == []
+    assert len(listings) <= 3
+
+
+def test_uploader_retries_failed_uploads_in_order(conn, tmpdir, monkeypatch):
+    batches = spool.Spool(str(tmpdir))
+    batches.append(b'first', 'APPLE/first.txt')
+    batches.append(b'second', 'APPLE/second.txt')
+    uploaded = []
+    failures = [IOError('S3 is down')]
+    upload_stream = conn.upload_stream
+
+    def flaky_upload_stream(stream, s3_key):
+        if failures:
+            raise failures.pop()
+        uploaded.append(s3_key)
+        return upload_stream(stream, s3_key)
+
+    monkeypatch.setattr(conn, 'upload_stream', flaky_upload_stream)
+    uploader = spool.SpoolUploader(conn, batches, max_backoff=0)
+    uploader.stop()
+
+    assert uploaded == ['APPLE/first.txt', 'APPLE/second.txt']
+    assert uploader.stats()['upload_errors'] == 1
+
+
+def test_uploader_quarantines_a_batch_that_keeps_failing(conn, tmpdir, monkeypatch):
+    batches = spool.Spool(str(tmpdir))
+    batches.append(b'poison', 'APPLE/poison.txt')
+    batches.append(b'second', 'APPLE/second.txt')
+    upload_stream = conn.upload_stream
+
+    def failing_upload_stream(stream, s3_key):
+        if s3_key == 'APPLE/poison.txt':
+            raise IOError('S3 is down')
+        return upload_stream(stream, s3_key)
+
+    monkeypatch.setattr(conn, 'upload_stream', failing_upload_stream)
+    uploader = spool.SpoolUploader(conn, batches, max_backoff=0, max_attempts=3)
+    uploader.stop()
+
+    assert conn.list_keys('APPLE/') == ['APPLE/second.txt']
+    assert batches.entries() == []
+    assert os.listdir(os.path.join(batches.path, spool.FAILED_DIR))[0].endswith('poison.txt' + spool.ENTRY_SUFFIX)
+    assert uploader.stats()['upload_errors'] == 3
+    assert uploader.stats()['quarantined'] == 1
+
+
+def test_uploader_quarantines_batches_s3_rejects_without_retrying(conn, tmpdir, monkeypatch):
+    batches = spool.Spool(str(tmpdir))
+    batches.append(b'rejected', 'APPLE/rejected.txt')
+    batches.append(b'second', 'APPLE/second.txt')
+    upload_stream = conn.upload_stream
+
+    def rejecting_upload_stream(stream, s3_key):
+        if s3_key == 'APPLE/rejected.txt':
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidArgument'}}, 'PutObject')
+        return upload_stream(stream, s3_key)
+
+    monkeypatch.setattr(conn, 'upload_stream', rejecting_upload_stream)
+    uploader = spool.SpoolUploader(conn, batches, max_backoff=0)
+    uploader.stop()
+
+    assert conn.list_keys('APPLE/') == ['APPLE/second.txt']
+    assert uploader.stats()['upload_errors'] == 1
+    assert uploader.stats()['quarantined'] == 1
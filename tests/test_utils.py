@@ -0,0 +1,74 @@
+import gzip
+import io
+import os
+import random
+
+import pytest
+
+import utils
+
+
+def random_lines(num_lines, seed=42):
+    rand = random.Random(seed)
+    return b''.join('{} tweet about $AAPL {}\n'.format(i, rand.random()).encode('utf-8') for i in range(num_lines))
+
+
+def gzip_members(*blocks):
+    return b''.join(utils._gzip_member(block, utils.GZIP_LEVEL) for block in blocks)
+
+
+def test_compress_to_gz_with_threads_writes_members_every_reader_accepts(tmpdir, monkeypatch):
+    monkeypatch.setattr(utils, 'GZIP_BLOCK_SIZE', 64 * 1024)
+    data = random_lines(20000)
+    filename = str(tmpdir.join('batch.jsonl'))
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+    zipped = utils.compress_to_gz(filename, threads=4)
+
+    assert len(data) > 10 * utils.GZIP_BLOCK_SIZE
+    with gzip.open(zipped, 'rb') as f:
+        assert f.read() == data
+    assert b''.join(utils.iter_decompressed(zipped)) == data
+    os.remove(filename)
+    assert open(utils.decompress_gz(zipped), 'rb').read() == data
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 10 ** 6])
+def test_iter_gunzip_reads_members_split_across_chunks(chunk_size):
+    blocks = [b'first member\n', b'', random_lines(200), b'last member\n']
+    compressed = gzip_members(*blocks)
+    chunks = [compressed[i:i + chunk_size] for i in range(0, len(compressed), chunk_size)]
+
+    assert b''.join(utils._iter_gunzip(iter(chunks))) == b''.join(blocks)
+
+
+def test_iter_gunzip_reads_a_member_ending_on_a_chunk_boundary():
+    first, second = utils._gzip_member(b'first\n', 6), utils._gzip_member(b'second\n', 6)
+
+    assert b''.join(utils._iter_gunzip(iter([first[:5], first[5:], second]))) == b'first\nsecond\n'
+
+
+def test_iter_lines_over_a_multi_member_stream():
+    stream = io.BytesIO(gzip_members(b'line 1\nline', b' 2\nline 3'))
+
+    assert list(utils.iter_lines(stream, 'batch.jsonl.gz')) == [b'line 1\n', b'line 2\n', b'line 3']
+
+
+def test_zstd_round_trip_with_threads_and_dictionary(tmpdir):
+    pytest.importorskip('zstandard')
+    samples = [random_lines(20, seed) for seed in range(500)]
+    dictionary = utils.train_zstd_dictionary(samples, dict_size=16 * 1024)
+    data = random_lines(20000)
+    filename = str(tmpdir.join('batch.jsonl'))
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+    compressed = utils.compress_to_zstd(filename, threads=2, dictionary=dictionary)
+
+    assert b''.join(utils.iter_decompressed(compressed, dictionary=dictionary)) == data
+    assert open(utils.decompress_zstd(compressed, str(tmpdir.join('out.jsonl')), dictionary=dictionary),
+                'rb').read() == data
+    with open(compressed, 'rb') as f:
+        chunks = [f.read(1000)] + list(utils.iter_chunks(f, 1000))
+    assert b''.join(utils.iter_decompressed(iter(chunks), 'batch.jsonl.zst', dictionary)) == data
@@ -0,0 +1,65 @@
+import gzip
+import io
+import json
+import os
+
+import pytest
+
+import utils
+from writers import JsonlBatch, iter_batch_records, read_batch_file
+
+RECORDS = [{'Text': u'tweet {} ☃'.format(i), 'Created at': 'Wed Oct 10 20:19:24 +0000 2018'} for i in range(12)]
+
+
+def fill(batch):
+    for record in RECORDS:
+        batch.append(record)
+    return batch
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_in_memory_batch_reads_back_its_records(compress):
+    batch = fill(JsonlBatch(compress=compress, name='APPLE/batch.jsonl'))
+
+    assert len(batch) == 12
+    assert batch.num_bytes == sum(len((json.dumps(record) + '\n').encode('utf-8')) for record in RECORDS)
+    assert list(batch.records()) == RECORDS
+    assert batch.close() is None
+
+
+def test_file_batch_is_a_regular_gzip_jsonl_file(tmpdir):
+    path = str(tmpdir.join('batch.jsonl.gz'))
+    batch = fill(JsonlBatch(path, compress=True))
+
+    assert batch.name == 'batch.jsonl.gz'
+    assert batch.close() == path
+    with gzip.open(path, 'rb') as f:
+        assert [json.loads(line.decode('utf-8')) for line in f] == RECORDS
+    assert list(read_batch_file(path)) == RECORDS
+    assert list(read_batch_file(utils.decompress_gz(path))) == RECORDS
+
+
+def test_open_streams_the_encoded_content(tmpdir):
+    batch = fill(JsonlBatch(str(tmpdir.join('batch.jsonl'))))
+
+    with batch.open() as content:
+        assert content.read().decode('utf-8').splitlines()[0] == json.dumps(RECORDS[0])
+
+
+def test_discard_removes_the_local_file(tmpdir):
+    path = str(tmpdir.join('batch.jsonl'))
+    batch = fill(JsonlBatch(path))
+
+    batch.discard()
+
+    assert not os.path.exists(path)
+
+
+def test_iter_batch_records_reads_every_batch_format():
+    jsonl = b''.join((json.dumps(record) + '\n').encode('utf-8') for record in RECORDS)
+    legacy = json.dumps(dict((str(i), record) for i, record in enumerate(RECORDS))).encode('utf-8')
+
+    assert list(iter_batch_records(io.BytesIO(jsonl), 'a.jsonl')) == RECORDS
+    assert list(iter_batch_records([gzip.compress(jsonl)], 'a.jsonl.gz')) == RECORDS
+    assert list(iter_batch_records(io.BytesIO(legacy), 'a.txt')) == RECORDS
+    assert list(iter_batch_records([gzip.compress(legacy)], 'a.txt.gz')) == RECORDS
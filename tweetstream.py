@@ -5,27 +5,42 @@ import sys
 import os
 import time
 import json
-import yaml
 import s3_utils
-from utils import rel_path
+import aggregate
+import decoders
+import dedup
+import metrics
+import pipeline
+import settings
 
-company_info = yaml.safe_load(file(rel_path('config/cred.yaml')))['company']
-company = company_info['company_name']
-stock = company_info['stock']
+config = settings.load()
+company, stock = config.company
+pipeline_info = config.section('pipeline')
+decoder_info = config.section('decoder')
+decode = decoders.get_decoder(decoder_info.get('backend') or 'auto',
+                              decoders.TWEET_FIELDS if decoder_info.get('project', True) else None)
+dedup_info = config.section('dedup')
+aggregate_info = config.section('aggregate')
+metrics_info = config.section('metrics')
 DIRECTORY = os.path.dirname(os.path.abspath(__file__))
-json_data = {}
 class StdOutListener(StreamListener):
 
     def __init__(self, api=None):
         super(StdOutListener, self).__init__()
         self.num_tweets = 0
-        self.filename = company+'rongbin.dashboard'+time.strftime("%Y%m%d%H%M%S")+'.txt'
-        self.conn = s3_utils.S3Connection.from_yaml(rel_path('config/cred.yaml'), 'aws')
+        self.conn = s3_utils.S3Connection.from_config(config.aws)
+        self.pipeline = pipeline.from_config(self.conn, pipeline_info)
+        self.dedup = dedup.from_config(dedup_info)
+        self.aggregator = aggregate.from_config(self.conn, aggregate_info)
 
+    @metrics.timed(metrics.ON_DATA_SECONDS)
     def on_data(self, data):
-        global json_data
-    	data = json.loads(data)
+        data = decode(data)
         if 'text' in data:
+            metrics.TWEETS_RECEIVED.inc()
+            if self.dedup is not None and self.dedup.is_duplicate(data):
+                metrics.TWEETS_DROPPED.inc(labels=(company, 'duplicate'))
+                return True
             text = data['text']
             created_at = data['created_at']
             record = {}
@@ -34,37 +49,43 @@ class StdOutListener(StreamListener):
             record['Company'] = company
             record['Stock'] = stock
             self.num_tweets += 1
-            if self.num_tweets < 3000:
-                # print 'Saving to json'
-                # print record
-                json_data[str(self.num_tweets)] = record
-                # print json_data
+            if self.pipeline.put(company, record):
+                metrics.TWEETS_KEPT.inc(labels=(company,))
             else:
-                print 'Saving to local file'
-                with open(self.filename,'w') as tf:
-                    json.dump(json_data, tf)
-                json_data = {}
-                print 'Uploading to S3'
-                self.conn.upload_file(self.filename, company+'/'+self.filename)
-                print 'Uploading to S3 Done'
-                os.remove(self.filename)
-                self.num_tweets = 0
-                self.filename = company+'rongbin.dashboard'+time.strftime("%Y%m%d%H%M%S")+'.txt'
+                metrics.TWEETS_DROPPED.inc(labels=(company, 'queue_full'))
+            if self.aggregator is not None:
+                self.aggregator.add(company, text)
         return True
 
     def on_error(self, status):
+        metrics.STREAM_ERRORS.inc(labels=(str(status),))
         print status
+        print self.pipeline.stats()
+        if self.dedup is not None:
+            print self.dedup.stats()
+
+    def on_timeout(self):
+        metrics.STREAM_DISCONNECTS.inc(labels=('timeout',))
+
+    def on_exception(self, exception):
+        metrics.STREAM_DISCONNECTS.inc(labels=(type(exception).__name__,))
 
 
 if __name__ == '__main__':
 
     #This handles Twitter authetification and the connection to Twitter Streaming API
+    metrics.from_config(metrics_info)
     l = StdOutListener()
-    tweet_cred = yaml.safe_load(file(rel_path('config/cred.yaml')))['twitter']
+    tweet_cred = config.twitter
     auth = OAuthHandler(tweet_cred['consumer_key'], tweet_cred['consumer_secret'])
     auth.set_access_token(tweet_cred['access_token'], tweet_cred['access_token_secret'])
-    stream = Stream(auth, l)
-    stream.filter(track=[company, stock])
+    stream = Stream(auth, l, timeout=config.stream_timeout)
+    try:
+        stream.filter(track=[company, stock], languages=config.languages)
+    finally:
+        l.pipeline.stop()
+        if l.aggregator is not None:
+            l.aggregator.stop()
 
 
 
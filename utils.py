@@ -1,18 +1,35 @@
 """Various utility functions."""
+import collections
+import functools
 import gzip
 import hashlib
-import inspect
 import logging
 import os
 import random
 import tempfile
 import shutil
+import sys
 import yaml
 import zipfile
+import zlib
 import datetime
 import uuid
+from multiprocessing.pool import ThreadPool
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional.
+    zstandard = None
 
 LOGGER = logging.getLogger(__name__)
+GZIP_BLOCK_SIZE = 1024 * 1024  # Uncompressed bytes per gzip member when compressing in parallel.
+GZIP_LEVEL = 6  # Same default as the gzip command line tool.
+ZSTD_LEVEL = 3
+ZSTD_DICT_SIZE = 112 * 1024  # Bytes of a trained zstd dictionary, zstd's default.
+READ_CHUNK_SIZE = 1024 * 1024  # Bytes read at a time by the streaming decompressors.
+_PATH_TYPES = (str, type(u''))
+_CALLER_DIRS = {}  # Source file -> resolved directory, for rel_path.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # libyaml's parser when PyYAML was built with it.
 
 
 class DataPipelineException(Exception):
@@ -25,20 +42,23 @@ def rel_path(relative_filename):
     :param relative_filename: target filename relative to the caller's containing folder.
     :return: the full path of the target relative file.
     """
-    # Extract the filename of the caller's stack frame.
-    caller_frame = inspect.stack()[1]
-    try:
-        caller_filepath = inspect.getabsfile(caller_frame[0])
-    finally:
-        del caller_frame  # Force remove frame reference to prevent garbage-collection issues.
-    return os.path.join(os.path.dirname(os.path.realpath(caller_filepath)), relative_filename)
+    # Only the caller's code object is needed. inspect.stack() reads the source of every frame on the stack.
+    caller_filepath = sys._getframe(1).f_code.co_filename
+    caller_dir = _CALLER_DIRS.get(caller_filepath)
+    if caller_dir is None:
+        caller_dir = _CALLER_DIRS[caller_filepath] = os.path.dirname(os.path.realpath(os.path.abspath(
+            caller_filepath)))
+    return os.path.join(caller_dir, relative_filename)
 
 
-def compress_to_gz(filename, zipped_filename=None, delete_original=False):
+def compress_to_gz(filename, zipped_filename=None, delete_original=False, threads=1, level=GZIP_LEVEL):
     """Compresses a file using gzip.
     :param filename: filename to gzip
     :param zipped_filename: zipped filename to output. defaults to filename + .gz
     :param delete_original: delete filename after successfully gzipping?
+    :param threads: number of blocks compressed at the same time. With more than one thread the output is a series
+        of gzip members, like pigz writes, which every gzip reader decompresses as a single stream.
+    :param level: compression level from 1 (fastest) to 9 (smallest).
     :return: the final zipped filename that was written to.
     """
     # Warn if may be already compressed.
@@ -51,8 +71,13 @@ def compress_to_gz(filename, zipped_filename=None, delete_original=False):
     if os.path.splitext(zipped_filename)[-1] != '.gz':
         LOGGER.warning('GZIP file {} does not have .gz extension'.format(zipped_filename))
     LOGGER.debug('Compressing {} to {}'.format(filename, zipped_filename))
-    with open(filename, 'rb') as f_src, gzip.open(zipped_filename, 'wb') as f_dest:
-        shutil.copyfileobj(f_src, f_dest)
+    if threads > 1:
+        with open(filename, 'rb') as f_src, open(zipped_filename, 'wb') as f_dest:
+            for member in iter_gzip_members(iter_chunks(f_src, GZIP_BLOCK_SIZE), threads, level):
+                f_dest.write(member)
+    else:
+        with open(filename, 'rb') as f_src, gzip.open(zipped_filename, 'wb', level) as f_dest:
+            shutil.copyfileobj(f_src, f_dest)
     if delete_original:
         os.remove(filename)
     return zipped_filename
@@ -93,6 +118,193 @@ def decompress_gz(gzip_filename, target_filename=None, delete_gzip=False):
     return target_filename
 
 
+def iter_gzip_members(blocks, threads, level=GZIP_LEVEL):
+    """Compresses blocks into independent gzip members on a thread pool. zlib releases the GIL, so the blocks are
+    compressed on several cores at once. The concatenated members form one valid gzip stream.
+    :param blocks: iterable of uncompressed byte strings, e.g. from iter_chunks.
+    :param threads: number of blocks compressed at the same time.
+    :param level: compression level from 1 (fastest) to 9 (smallest).
+    :return: iterator of gzip members in the order of the blocks.
+    """
+    pool = ThreadPool(processes=threads)
+    try:
+        # At most twice as many blocks as threads are held in memory.
+        for member in imap_ordered(pool, functools.partial(_gzip_member, level=level), blocks, threads * 2):
+            yield member
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def imap_ordered(pool, func, items, max_in_flight):
+    """Like pool.imap, but pulls items lazily: at most max_in_flight calls are queued, running or done but not yet
+    yielded, so memory stays bounded however long items is. pool.imap reads ahead of the consumer without limit.
+    :param pool: ThreadPool or multiprocessing Pool.
+    :param func: function of one argument. Must be picklable for a process pool.
+    :param items: iterable of arguments, e.g. a generator over a paginated listing.
+    :param max_in_flight: max calls submitted but not yet yielded.
+    :return: iterator of results in the order of items.
+    """
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def train_zstd_dictionary(samples, dict_size=ZSTD_DICT_SIZE):
+    """Trains a zstd dictionary on sample content, e.g. a few thousand encoded tweet batches or records.
+    Small batches compress several times better with a dictionary trained on similar data. Requires zstandard.
+    :param samples: list of byte strings.
+    :param dict_size: size of the dictionary in bytes.
+    :return: the dictionary as bytes, to be stored and passed to the zstd functions.
+    """
+    _require_zstandard()
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+def compress_to_zstd(filename, zstd_filename=None, delete_original=False, threads=1, level=ZSTD_LEVEL,
+                     dictionary=None):
+    """Compresses a file using zstd. Requires zstandard.
+    :param filename: filename to compress.
+    :param zstd_filename: compressed filename to output. defaults to filename + .zst
+    :param delete_original: delete filename after successfully compressing?
+    :param threads: number of threads compressing at the same time.
+    :param level: compression level from 1 (fastest) to 22 (smallest).
+    :param dictionary: optional dictionary from train_zstd_dictionary. It is needed again to decompress.
+    :return: the final compressed filename that was written to.
+    """
+    _require_zstandard()
+    zstd_filename = filename + '.zst' if zstd_filename is None else zstd_filename
+    LOGGER.debug('Compressing {} to {}'.format(filename, zstd_filename))
+    compressor = zstandard.ZstdCompressor(level=level, dict_data=_zstd_dict(dictionary),
+                                          threads=threads if threads > 1 else 0)
+    with open(filename, 'rb') as f_src, open(zstd_filename, 'wb') as f_dest:
+        compressor.copy_stream(f_src, f_dest)
+    if delete_original:
+        os.remove(filename)
+    return zstd_filename
+
+
+def decompress_zstd(zstd_filename, target_filename=None, delete_zstd=False, dictionary=None):
+    """Decompresses a zstd file into a different file. Requires zstandard.
+    :param zstd_filename: zstd file path to decompress.
+    :param target_filename: file path of decompressed contents. defaults to zstd_filename - .zst
+    :param delete_zstd: delete compressed file after successfully decompressing?
+    :param dictionary: the dictionary the file was compressed with, if any.
+    :return: the final decompressed filename that was written to.
+    """
+    target_filename = os.path.splitext(zstd_filename)[0] if target_filename is None else target_filename
+    LOGGER.debug('Decompressing {} to {}'.format(zstd_filename, target_filename))
+    with open(target_filename, 'wb') as f_dest:
+        for chunk in iter_decompressed(zstd_filename, dictionary=dictionary):
+            f_dest.write(chunk)
+    if delete_zstd:
+        os.remove(zstd_filename)
+    return target_filename
+
+
+def iter_chunks(source, chunk_size=READ_CHUNK_SIZE):
+    """Yields the content of a local file, binary file-like object or iterable of byte strings in chunks.
+    :param source: local file path, object with read() such as an S3 StreamingBody, or iterable of bytes.
+    :param chunk_size: max bytes per chunk read from files and file-like objects.
+    """
+    if isinstance(source, _PATH_TYPES):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+    elif hasattr(source, 'read'):
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            yield chunk
+    else:
+        for chunk in source:
+            yield chunk
+
+
+def iter_decompressed(source, name=None, dictionary=None):
+    """Yields the decompressed content of a gzip, zstd or uncompressed source in chunks, without temporary files.
+    Multi-member gzip streams, such as those written by compress_to_gz with several threads, are read in full.
+    :param source: local file path, binary file-like object (e.g. an S3 StreamingBody) or iterable of bytes.
+    :param name: file name or S3 key whose extension (.gz or .zst) selects the codec. Defaults to source for paths.
+    :param dictionary: zstd dictionary the source was compressed with, if any.
+    """
+    name = source if name is None and isinstance(source, _PATH_TYPES) else (name or '')
+    extension = os.path.splitext(name)[-1]
+    if extension == '.gz':
+        return _iter_gunzip(iter_chunks(source))
+    if extension == '.zst':
+        _require_zstandard()
+        reader = source if hasattr(source, 'read') else _ChunkReader(iter_chunks(source))
+        return zstandard.ZstdDecompressor(dict_data=_zstd_dict(dictionary)).read_to_iter(reader, READ_CHUNK_SIZE)
+    return iter_chunks(source)
+
+
+def iter_lines(source, name=None, dictionary=None):
+    """Yields the lines, ending with their newline, of a gzip, zstd or uncompressed source. See iter_decompressed."""
+    remainder = b''
+    for chunk in iter_decompressed(source, name, dictionary):
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if remainder:
+        yield remainder
+
+
+def _iter_gunzip(chunks):
+    """Decompresses gzip chunks, member after member. Unlike GzipFile, this never seeks, so it streams."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            chunk = decompressor.unused_data
+            if chunk:  # The member ended inside this chunk; the rest starts the next member.
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+class _ChunkReader(object):
+    """Minimal read() over an iterator of byte chunks, for decompressors that pull from a file-like object."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _zstd_dict(dictionary):
+    if dictionary is None:
+        return None
+    return dictionary if isinstance(dictionary, zstandard.ZstdCompressionDict) else zstandard.ZstdCompressionDict(
+        dictionary)
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise DataPipelineException('zstandard is required for zstd compression')
+
+
 def unzip(filename, contents_path=None, delete_original=False):
     """Unzips contents inside a .zip file.
     :param filename: path to the zip file.
@@ -115,7 +327,8 @@ def read_yaml(file_path):
     :param file_path: file path to the yaml file.
     :return: dictionary representing the contents of the file.
     """
-    return yaml.safe_load(file(file_path))
+    with open(file_path) as f:
+        return yaml.load(f, Loader=YAML_LOADER)
 
 
 def hash_string_to_int(string_to_hash, max_int_size=2147483647):
@@ -0,0 +1,170 @@
+"""Local batch file formats written by the collectors."""
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet output is optional.
+    pyarrow = None
+
+import utils
+from utils import DataPipelineException
+
+LOGGER = logging.getLogger(__name__)
+TWITTER_TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'  # created_at is always in UTC, e.g. Wed Oct 10 20:19:24 +0000 2018
+
+
+class JsonlBatch(object):
+    """A batch that is appended to newline-delimited json as records arrive.
+    Records are serialized (and compressed) immediately, so memory only holds the encoded bytes, or nothing at all
+    when the batch is backed by a local file. The content can be read line by line before the batch is finished.
+    """
+
+    def __init__(self, filepath=None, compress=False, name=None):
+        """
+        :param filepath: local file to append records to. None to keep the encoded batch in memory.
+        :param compress: write through gzip. The output is a regular .gz file readable by utils.decompress_gz.
+        :param name: name of the batch, e.g. the S3 key it is uploaded to. None to use the local filename.
+        """
+        self.filepath = filepath
+        self.name = name if name is not None else os.path.basename(filepath)
+        self.compress = compress
+        self.opened = time.time()
+        self.num_bytes = 0  # Uncompressed bytes written so far.
+        self._num_records = 0
+        self._raw = open(filepath, 'wb') if filepath is not None else io.BytesIO()
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='wb') if compress else self._raw
+        self._closed = False
+
+    def __len__(self):
+        return self._num_records
+
+    def append(self, record):
+        """Writes one record as a single json line.
+        :param record: json serializable record.
+        """
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        self._file.write(line)
+        self.num_bytes += len(line)
+        self._num_records += 1
+
+    def close(self):
+        """Finishes the batch so it can be uploaded. No records can be appended afterwards.
+        :return: the local file path of the finished batch, or None for in-memory batches.
+        """
+        if not self._closed:
+            if self.compress:
+                self._file.close()  # Writes the gzip trailer. Does not close the underlying file.
+            if self.filepath is not None:
+                self._raw.close()
+            self._closed = True
+            LOGGER.debug('Closed batch {} with {} records ({} bytes uncompressed)'.format(
+                self.name, self._num_records, self.num_bytes))
+        return self.filepath
+
+    def open(self):
+        """Closes the batch and returns a binary file-like object over its encoded content."""
+        self.close()
+        if self.filepath is not None:
+            return open(self.filepath, 'rb')
+        return io.BytesIO(self._raw.getvalue())
+
+    def records(self):
+        """Closes the batch and yields its records back."""
+        return _iter_jsonl(self.open(), self.compress)
+
+    def discard(self):
+        """Closes the batch and deletes its local file or memory."""
+        self.close()
+        if self.filepath is not None and os.path.exists(self.filepath):
+            os.remove(self.filepath)
+        self._raw = io.BytesIO()
+
+
+def read_jsonl(filepath):
+    """Yields the records of a local jsonl file, gzipped, zstd compressed or not.
+    :param filepath: jsonl file written by JsonlBatch.
+    """
+    return _iter_jsonl_lines(utils.iter_lines(filepath))
+
+
+def read_batch_file(filepath):
+    """Yields the records of a local batch file in any format the collectors upload: the legacy json object keyed
+    by record index (.txt) or jsonl, optionally gzipped.
+    :param filepath: local batch file.
+    """
+    return iter_batch_records(filepath)
+
+
+def iter_batch_records(source, name=None, dictionary=None):
+    """Yields the records of a batch without writing it to disk. jsonl batches are decompressed and parsed as they
+    stream in; legacy json batches are one object and are parsed once fully read.
+    :param source: local file path, binary file-like object such as an S3 StreamingBody, or iterable of bytes.
+    :param name: file name or S3 key of the batch, which tells its format. Defaults to source for paths.
+    :param dictionary: zstd dictionary the batch was compressed with, if any.
+    """
+    name = source if name is None else name
+    base, extension = os.path.splitext(name)
+    if extension in ('.gz', '.zst'):
+        name = base
+    if name.endswith('.jsonl'):
+        return _iter_jsonl_lines(utils.iter_lines(source, name + extension, dictionary))
+    records = json.loads(b''.join(utils.iter_decompressed(source, name + extension, dictionary)).decode('utf-8'))
+    return (records[index] for index in sorted(records, key=int))
+
+
+def _iter_jsonl(fileobj, compressed):
+    """Yields the records of a binary jsonl file object and closes it when done."""
+    with fileobj:
+        lines = gzip.GzipFile(fileobj=fileobj, mode='rb') if compressed else fileobj
+        for line in lines:
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+
+
+def _iter_jsonl_lines(lines):
+    for line in lines:
+        if line.strip():
+            yield json.loads(line.decode('utf-8'))
+
+
+def parse_created_at(created_at):
+    """Converts a tweet created_at string to a naive UTC datetime.
+    :param created_at: created_at value from the tweet payload.
+    :return: the datetime, or None if it could not be parsed.
+    """
+    try:
+        return datetime.datetime.strptime(created_at, TWITTER_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def write_parquet(records, where):
+    """Writes tweet records to a columnar parquet file. Requires pyarrow.
+    Company and Stock are dictionary encoded and Created at is stored as a UTC timestamp so queries can prune on it.
+    :param records: iterable of records with Text, Created at, Company and Stock.
+    :param where: local parquet file path or writable binary file-like object.
+    :return: number of records written.
+    """
+    if pyarrow is None:
+        raise DataPipelineException('pyarrow is required for parquet output')
+    columns = {'Text': [], 'Created at': [], 'Company': [], 'Stock': []}
+    for record in records:
+        columns['Text'].append(record.get('Text'))
+        columns['Created at'].append(parse_created_at(record.get('Created at')))
+        columns['Company'].append(record.get('Company'))
+        columns['Stock'].append(record.get('Stock'))
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.array(columns['Text'], type=pyarrow.string()),
+         pyarrow.array(columns['Created at'], type=pyarrow.timestamp('s', tz='UTC')),
+         pyarrow.array(columns['Company'], type=pyarrow.string()).dictionary_encode(),
+         pyarrow.array(columns['Stock'], type=pyarrow.string()).dictionary_encode()],
+        names=['Text', 'Created at', 'Company', 'Stock'])
+    pyarrow.parquet.write_table(table, where, use_dictionary=['Company', 'Stock'], compression='snappy')
+    return table.num_rows